@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    pdf-info.py
+# @brief   Time reading the Info dictionary of PDF files, with and without pdfrw
+# @author  Michael Hucka
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/mhucka/zowie
+#
+# Usage: python3 dev/benchmarks/pdf-info.py file.pdf [copies]
+#
+# This makes the given number of copies (default: 1000) of a PDF file in a
+# temporary folder, then times reading the Subject field of all of them the
+# way Zowie does it when checking whether a link is already present, and
+# the way it used to (using pdfrw's PdfReader). Then it times writing a new
+# Subject value into all of them, as an incremental update and by rewriting
+# the files using pdfrw.
+# =============================================================================
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from pdfrw import PdfReader, PdfWriter, PdfString
+from zowie.pdf import PdfDocument
+
+LINK = 'zotero://select/library/items/ABCDEFGH'
+
+def timed(label, function, files):
+    start = time.perf_counter()
+    for file in files:
+        function(file)
+    elapsed = time.perf_counter() - start
+    print(f'  {label:28} {elapsed:7.2f} s  ({1000 * elapsed / len(files):.2f} ms/file)')
+
+def pdfrw_read(file):
+    return PdfReader(file).Info.Subject
+
+def pdfrw_write(file):
+    trailer = PdfReader(file)
+    trailer.Info.Subject = PdfString.from_unicode(LINK)
+    PdfWriter(file, trailer = trailer).write()
+
+def main(original, copies = 1000):
+    with tempfile.TemporaryDirectory() as folder:
+        files = []
+        for n in range(copies):
+            files.append(os.path.join(folder, f'{n}.pdf'))
+            shutil.copyfile(original, files[-1])
+        size = os.path.getsize(original) / 1e6
+        print(f'{copies} copies of a {size:.1f} MB file:')
+        timed('read Subject with pdfrw', pdfrw_read, files)
+        timed('read Subject with zowie.pdf', lambda f: PdfDocument(f).info_text('Subject'), files)
+        timed('rewrite with pdfrw', pdfrw_write, files)
+        timed('incremental update', lambda f: PdfDocument(f).update_info({'Subject': LINK}), files)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f'Usage: {sys.argv[0]} file.pdf [copies]')
+        sys.exit(1)
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
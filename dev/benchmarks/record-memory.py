@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    record-memory.py
+# @brief   Measure the memory used per file by Zowie's Zotero records
+# @author  Michael Hucka
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/mhucka/zowie
+#
+# Usage: python3 dev/benchmarks/record-memory.py [number of records]
+#
+# This creates synthetic records (1,000,000 by default) in the shape that a
+# run over a large Zotero storage folder produces: 8-character item keys, a
+# few libraries, and one record per file. It compares the records used now
+# (ZoteroRecord with __slots__, link made on demand) with the namedtuple that
+# Zowie used to have, which held a formatted link for every file.
+# =============================================================================
+
+from   collections import namedtuple
+import gc
+import os
+import random
+import string
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from zowie.resolver import ZoteroRecord, select_link
+
+OldRecord = namedtuple('OldRecord', 'key parent_key file link record')
+
+def random_key():
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k = 8))
+
+def measure(label, make, items):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = [make(*item) for item in items]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    per_file = (after - before) / len(records)
+    print(f'{label:>28}: {per_file:6.1f} bytes per file'
+          f' ({(after - before)/2**20:7.1f} MB total)')
+    del records
+
+def main(count = 1_000_000):
+    libraries = [('user', '')] + [('group', str(4000 + n)) for n in range(5)]
+    items = []
+    for n in range(count):
+        (libtype, libid) = libraries[n % len(libraries)]
+        key = sys.intern(random_key())
+        file = f'/Users/someone/Zotero/storage/{key}/document.pdf'
+        items.append((key, sys.intern(random_key()), file, libtype, libid))
+    print(f'Memory used by {count:,} records, not counting shared strings:')
+    measure('namedtuple with link', lambda key, parent, file, libtype, libid:
+            OldRecord(key, parent, file, select_link(libtype, libid, parent), None),
+            items)
+    measure('__slots__, link on demand', lambda key, parent, file, libtype, libid:
+            ZoteroRecord(key, parent, file, libtype, libid),
+            items)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
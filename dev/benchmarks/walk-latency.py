@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# =============================================================================
+# @file    walk-latency.py
+# @brief   Time Zowie's search for files when file system calls are slow
+# @author  Michael Hucka
+# @license Please see the file named LICENSE in the project directory
+# @website https://github.com/mhucka/zowie
+#
+# Usage: python3 dev/benchmarks/walk-latency.py [latency in ms] [folders]
+#
+# This makes a fake Zotero storage folder with the given number of item
+# folders (default: 300), then times zowie.discovery.target_files() over it
+# using different numbers of threads. To imitate a network share (SMB, NFS),
+# every call to os.scandir() and os.stat() is delayed by the given latency
+# (default: 5 ms), and so are the os.DirEntry methods that may need a stat.
+# =============================================================================
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from zowie import discovery
+
+def make_storage(root, count):
+    os.makedirs(os.path.join(root, 'storage'))
+    open(os.path.join(root, 'zotero.sqlite'), 'w').close()
+    for n in range(count):
+        key = f'ABCD{n:04d}'.replace('0', 'A').replace('1', 'B')
+        folder = os.path.join(root, 'storage', key)
+        os.makedirs(folder, exist_ok = True)
+        for name in ['paper.pdf', '.zotero-ft-cache']:
+            open(os.path.join(folder, name), 'w').close()
+
+def slowed(function, latency):
+    def slow(*args, **kwargs):
+        time.sleep(latency)
+        return function(*args, **kwargs)
+    return slow
+
+def main(latency_ms = 5, count = 300):
+    latency = latency_ms / 1000
+    with tempfile.TemporaryDirectory() as root:
+        make_storage(root, count)
+        (scandir, stat, access) = (os.scandir, os.stat, os.access)
+        os.scandir = slowed(scandir, latency)
+        os.stat = slowed(stat, latency)
+        os.access = slowed(access, latency)
+        print(f'{count} item folders, {latency_ms} ms per file system call:')
+        baseline = None
+        for threads in [1, 2, 4, 8, 16]:
+            start = time.perf_counter()
+            files = list(discovery.target_files([root], threads = threads))
+            elapsed = time.perf_counter() - start
+            baseline = baseline or files
+            same = 'same order' if files == baseline else 'DIFFERENT ORDER'
+            print(f'  {threads:2} threads: {elapsed:6.2f} s, {len(files)} files, {same}')
+        (os.scandir, os.stat, os.access) = (scandir, stat, access)
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,33 @@
+import os
+import pytest
+import sys
+from   time import time
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from zowie.cache import ItemCache
+
+def test_items(tmp_path):
+    cache = ItemCache(str(tmp_path / 'items.sqlite'))
+    cache.put([('ABCD2345', 'user', '1', 'PARENT23'), ('EFGH6789', 'group', '9', None)])
+    assert cache.get('ABCD2345') == ('user', '1', 'PARENT23')
+    assert cache.get('EFGH6789') == ('group', '9', None)
+    cache.delete(['ABCD2345'])
+    assert cache.get('ABCD2345') is None
+    cache.close()
+
+def test_versions(tmp_path):
+    cache = ItemCache(str(tmp_path / 'items.sqlite'))
+    assert cache.version('user', '1') is None
+    cache.set_version('user', '1', 42)
+    cache.put([('EFGH6789', 'user', '1', None)])
+    assert cache.version('user', '1') == 42
+    assert cache.libraries() == [('user', '1')]
+    cache.forget_library('user', '1')
+    assert cache.libraries() == []
+    assert cache.get('EFGH6789') is None
+    cache.close()
@@ -0,0 +1,83 @@
+import os
+import pytest
+import sys
+import time
+from   datetime import datetime, timedelta
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from zowie.discovery import target_files
+
+def make_tree(root, names):
+    for name in names:
+        os.makedirs(os.path.dirname(root / name), exist_ok = True)
+        (root / name).write_text('')
+    return [str(root / name) for name in names]
+
+def test_order_and_ignored(tmp_path):
+    files = make_tree(tmp_path, ['b/c.pdf', 'b-x.pdf', 'b.pdf', 'a/.hidden.pdf',
+                                 'a/z.html', 'zotero.sqlite', 'styles/apa.csl'])
+    found = list(target_files([str(tmp_path)]))
+    # Same order as sorting the list of all files, without ignored files.
+    assert found == sorted(files[0:3] + files[4:5])
+
+def test_threads(tmp_path):
+    files = make_tree(tmp_path, [f'{a}/{b}/{c}.pdf' for a in 'abcd'
+                                 for b in 'wxyz' for c in range(3)])
+    assert list(target_files([str(tmp_path)], threads = 4)) == sorted(files)
+
+def test_exclude_and_date(tmp_path):
+    (old, new, alias) = make_tree(tmp_path, ['k/old.pdf', 'k/new.pdf', 'k/alias'])
+    hour_ago = time.time() - 3600
+    os.utime(old, (hour_ago, hour_ago))
+    cutoff = datetime.now() - timedelta(minutes = 10)
+    found = target_files([str(tmp_path)], after_date = cutoff,
+                         skip = lambda file: file.endswith('alias'))
+    assert list(found) == [new]
+
+def test_lazy(tmp_path):
+    make_tree(tmp_path, ['a/1.pdf', 'b/2.pdf'])
+    found = target_files([str(tmp_path)])
+    assert next(found) == str(tmp_path / 'a' / '1.pdf')
+    # Folders not yet reached when the first file is produced aren't read yet.
+    make_tree(tmp_path, ['b/3.pdf'])
+    assert list(found) == [str(tmp_path / 'b' / '2.pdf'), str(tmp_path / 'b' / '3.pdf')]
+
+def test_zotero_layout(tmp_path):
+    files = make_tree(tmp_path, ['zotero.sqlite', 'styles/apa.txt',
+                                 'storage/ABCD2345/paper.pdf',
+                                 'storage/ABCD2345/sub/image.png',
+                                 'storage/not-a-key/notes.txt',
+                                 'storage/WXYZ6789/old/snapshot.html',
+                                 'storage/WXYZ6789/paper.pdf'])
+    os.link(files[-1], tmp_path / 'storage' / 'WXYZ6789' / 'hardlink.pdf')
+    os.symlink(files[-1], tmp_path / 'storage' / 'WXYZ6789' / 'symlink.pdf')
+    # The 3 names of the same file come in the order hardlink, paper, symlink.
+    linked = str(tmp_path / 'storage' / 'WXYZ6789' / 'hardlink.pdf')
+    for item in [tmp_path, tmp_path / 'storage']:
+        found = target_files([str(item)], exclude = ['old'])
+        assert list(found) == [files[2], linked]
+
+def test_since(tmp_path):
+    files = make_tree(tmp_path, ['zotero.sqlite', 'storage/ABCD2345/old.pdf',
+                                 'storage/ABCD2345/touched.pdf',
+                                 'storage/WXYZ6789/new.pdf'])
+    (old, touched, new) = files[1:]
+    hour_ago = time.time() - 3600
+    for file in [old, touched, new]:
+        os.utime(file, (hour_ago, hour_ago))
+    os.utime(os.path.dirname(old), (hour_ago, hour_ago))
+    last_run = time.time() - 600
+    # The new file keeps an old modification time, as Zotero does when it
+    # syncs files, but its folder has changed.
+    found = target_files([str(tmp_path)], since = {str(tmp_path): last_run})
+    assert list(found) == [new]
+    # Without pruning, a file modified inside an old item folder is found.
+    os.utime(touched)
+    found = target_files([str(tmp_path / 'storage' / 'ABCD2345')],
+                         since = {str(tmp_path / 'storage' / 'ABCD2345'): last_run})
+    assert list(found) == [touched]
@@ -0,0 +1,44 @@
+import os
+import pytest
+import sys
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from test_pdf import classic_pdf
+from xattr import setxattr
+from zowie.file_context import FileContext
+
+def test_file_context(tmp_path):
+    file = tmp_path / 'paper.pdf'
+    classic_pdf(file)
+    try:
+        setxattr(str(file), b'user.zowie', b'value')
+    except OSError:
+        pytest.skip('extended attributes are not supported here')
+    with FileContext(str(file)) as context:
+        assert context.stat.st_size == file.stat().st_size
+        assert b'user.zowie' in context.xattrs
+        assert context.xattr(b'user.zowie') == b'value'
+        assert context.xattr(b'user.other') is None
+        document = context.pdf
+        assert document.info_text('Title') == 'A (nested) title'
+        # Things are read only once.
+        assert context.pdf is document
+        stat = context.stat
+        assert context.stat is stat
+        # Changing metadata only doesn't discard what was read from the contents.
+        setxattr(str(file), b'user.zowie', b'new')
+        context.forget(contents = False)
+        assert context.xattr(b'user.zowie') == b'new'
+        assert context.pdf is document
+        document.update_info({'Subject': 'x'})
+        context.forget()
+        assert context.pdf.info_text('Subject') == 'x'
+        assert context.stat.st_size == file.stat().st_size
+        fd = context.fd
+    with pytest.raises(OSError):
+        os.fstat(fd)
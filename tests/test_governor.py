@@ -0,0 +1,84 @@
+import os
+import pytest
+import sys
+import time
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+import zowie.governor
+from zowie.exceptions import ServiceFailure
+from zowie.governor import Governor
+
+def test_backoff_header():
+    governor = Governor()
+    governor.acquire()
+    governor.release(0.1, 200, {'backoff': '0.5'})
+    start = time.monotonic()
+    governor.acquire()
+    assert time.monotonic() - start >= 0.4
+
+def test_retry():
+    governor = Governor()
+    assert governor.retry(1, 429)
+    assert governor.retry(1, 503)
+    assert governor.retry(1, None)
+    assert not governor.retry(1, 404)
+    assert not governor.retry(zowie.governor._MAX_ATTEMPTS, 429)
+
+def test_aimd(monkeypatch):
+    monkeypatch.setattr(zowie.governor, '_BASE_DELAY', 0)
+    governor = Governor(maximum = 8)
+    assert governor.limit == 8
+    governor.acquire()
+    governor.release(0.1, 503)
+    assert governor.limit == 4
+    for _ in range(40):
+        governor.acquire()
+        governor.release(0.1, 200)
+    assert governor.limit == 8
+    # A response much slower than the others is a sign of congestion.
+    governor.acquire()
+    governor.release(1.0, 200)
+    assert governor.limit == 4
+
+def test_mixed_requests():
+    governor = Governor(maximum = 8)
+    # Small requests (e.g., for one item) mixed with large ones (e.g., for
+    # 50 keys) are not taken as congestion.
+    for latency in [0.05, 0.05, 0.6, 0.05, 0.7, 0.6, 0.05, 0.6] * 10:
+        governor.acquire()
+        governor.release(latency, 200)
+    assert governor.limit == 8
+
+def test_one_decrease_per_window(monkeypatch):
+    monkeypatch.setattr(zowie.governor, '_BASE_DELAY', 0)
+    governor = Governor(maximum = 8)
+    for _ in range(10):
+        governor.acquire()
+        governor.release(0.1, 200)
+    # The responses to requests in progress when congestion is noticed
+    # don't decrease the limit again.
+    for _ in range(3):
+        governor.acquire()
+        governor.release(1.0, 200)
+    assert governor.limit == 4
+    # After "limit" more responses, the limit can be decreased again.
+    governor.acquire()
+    governor.release(0.1, 200)
+    governor.acquire()
+    governor.release(0.1, 503)
+    assert governor.limit == 2
+
+def test_breaker(monkeypatch):
+    monkeypatch.setattr(zowie.governor, '_BASE_DELAY', 0)
+    monkeypatch.setattr(zowie.governor, '_BREAKER_PAUSE', 0)
+    monkeypatch.setattr(zowie.governor, 'warn', lambda *args: None)
+    governor = Governor()
+    with pytest.raises(ServiceFailure):
+        while True:
+            governor.acquire()
+            governor.release(0.1, 500)
@@ -0,0 +1,145 @@
+import os
+import pytest
+import sqlite3
+import sys
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from bun import UI
+from test_pdf import classic_pdf
+from test_zotero_db import _FIXTURE
+import zowie.file_context
+import zowie.main_body
+import zowie.methods.pdfbase
+from zowie.main_body import MainBody
+from zowie.manifest import Manifest
+from zowie.pdf import PdfDocument, open_pdf
+
+UI('Zowie', be_quiet = True, use_color = False)
+
+# Item folders for the fixture Zotero database. The attachments ATTACH23 and
+# GATTACH2 have parents; the others are not in the database or lack parents.
+_KEYS = ['ATTACH23', 'BUNKNWN2', 'GATTACH2', 'SINGLE23']
+_NAMES = ['a.pdf', 'b.pdf', 'c.pdf']
+
+_LINKS = {'ATTACH23': 'zotero://select/library/items/PARENT23',
+          'GATTACH2': 'zotero://select/groups/4455/items/GPARENT2'}
+
+@pytest.fixture
+def messages(tmp_path, monkeypatch):
+    # The manifest goes in the cache folder.
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setattr(zowie.main_body, 'file_is_alias', lambda item: False)
+    messages = []
+    for module in [zowie.main_body, zowie.methods.pdfbase]:
+        monkeypatch.setattr(module, 'inform', messages.append)
+        monkeypatch.setattr(module, 'warn', messages.append)
+    return messages
+
+def data_folder(folder):
+    os.makedirs(folder)
+    db = sqlite3.connect(str(folder / 'zotero.sqlite'))
+    db.executescript(_FIXTURE)
+    db.close()
+    for key in _KEYS:
+        os.makedirs(folder / 'storage' / key)
+        for name in _NAMES:
+            classic_pdf(folder / 'storage' / key / name)
+    return str(folder)
+
+def pdf_files(folder):
+    return [os.path.join(folder, 'storage', key, name)
+            for key in _LINKS for name in _NAMES]
+
+def contents(file):
+    with open(file, 'rb') as f:
+        return f.read()
+
+def zowie_run(folder, **options):
+    settings = dict(files = [folder], file_ext = None, api_key = None,
+                    user_id = None, local_api = False, use_keyring = False,
+                    use_cache = False, jobs = None, use_async = False,
+                    after_date = None, since_last_run = False, changed = False,
+                    exclude = None, walkers = None, watch = False,
+                    methods = ['pdfsubject', 'pdfproducer'], dry_run = False,
+                    overwrite = False, prefetch = False, processes = None,
+                    reverify = False, add_space = False,
+                    zotero_db = os.path.join(folder, 'zotero.sqlite'))
+    settings.update(options)
+    body = MainBody(**settings)
+    body.run()
+    if body.exception:
+        raise body.exception[1]
+    return body
+
+def test_one_update(tmp_path, messages):
+    folder = data_folder(tmp_path / 'zotero')
+    zowie_run(folder)
+    for file in pdf_files(folder):
+        link = _LINKS[os.path.basename(os.path.dirname(file))]
+        document = PdfDocument(file)
+        assert document.info_text('Subject') == link
+        assert document.info_text('Producer') == link
+        # Both fields were written in one incremental update.
+        assert contents(file).count(b'%%EOF') == 2
+    assert 'Processed 12 files.' in messages
+    assert len([m for m in messages if 'Unable to retrieve' in m]) == 3
+    assert len([m for m in messages if 'lacks a parent' in m]) == 3
+
+def test_second_run(tmp_path, messages, monkeypatch):
+    folder = data_folder(tmp_path / 'zotero')
+    zowie_run(folder)
+    stats = [os.stat(file) for file in pdf_files(folder)]
+    # The manifest shows that the links are there, so no file is read.
+    def no_reading(file, fd = None):
+        raise AssertionError(f'{file} was read')
+    monkeypatch.setattr(zowie.file_context, 'open_pdf', no_reading)
+    messages.clear()
+    zowie_run(folder)
+    assert '(6 files had not changed since links were written in a previous run.)' in messages
+    assert [os.stat(file) for file in pdf_files(folder)] == stats
+    # With -r, the files are read again, but not written.
+    monkeypatch.setattr(zowie.file_context, 'open_pdf', open_pdf)
+    zowie_run(folder, reverify = True)
+    assert ([os.stat(file).st_size for file in pdf_files(folder)]
+            == [stat.st_size for stat in stats])
+
+def test_processes(tmp_path, messages):
+    serial = data_folder(tmp_path / 'serial')
+    pooled = data_folder(tmp_path / 'pooled')
+    zowie_run(serial)
+    serial_messages = [m.replace(serial, 'ROOT') for m in messages]
+    messages.clear()
+    assert zowie_run(pooled, processes = '2')._pool
+    assert [m.replace(pooled, 'ROOT') for m in messages] == serial_messages
+    for file in pdf_files(pooled):
+        assert contents(file) == contents(file.replace(pooled, serial))
+
+def test_stop(tmp_path, messages, monkeypatch):
+    folder = data_folder(tmp_path / 'zotero')
+    write_links = MainBody._write_links
+    def write_and_stop(self, *args):
+        write_links(self, *args)
+        self.stop()
+    monkeypatch.setattr(MainBody, '_write_links', write_and_stop)
+    zowie_run(folder)
+    # Only the first file was done, and the run is not recorded as complete.
+    assert contents(pdf_files(folder)[0]).count(b'%%EOF') == 2
+    for file in pdf_files(folder)[1:]:
+        assert contents(file).count(b'%%EOF') == 1
+    manifest = Manifest()
+    assert manifest.last_run(folder) is None
+    manifest.close()
+
+def test_nothing_new(tmp_path, messages):
+    folder = data_folder(tmp_path / 'zotero')
+    zowie_run(folder, since_last_run = True)
+    messages.clear()
+    # A run that finds nothing new since the last one is not an error.
+    zowie_run(folder, since_last_run = True)
+    assert 'No files are new since the last run.' in messages
+    assert 'Processed 0 files.' in messages
@@ -0,0 +1,44 @@
+import os
+import pytest
+import sys
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from zowie.manifest import Manifest
+
+LINK = 'zotero://select/library/items/PARENT23'
+
+def test_manifest(tmp_path):
+    file = tmp_path / 'paper.pdf'
+    file.write_text('content')
+    manifest = Manifest(str(tmp_path / 'manifest.sqlite'))
+    stat = os.stat(file)
+    assert not manifest.has_link(str(file), stat, 'pdfsubject', LINK)
+    manifest.add_link(str(file), stat, 'pdfsubject', LINK)
+    assert manifest.has_link(str(file), stat, 'pdfsubject', LINK)
+    assert not manifest.has_link(str(file), stat, 'pdfproducer', LINK)
+    assert not manifest.has_link(str(file), stat, 'pdfsubject', LINK + 'X')
+    manifest.close()
+
+    # The record persists, but doesn't apply once the file is changed.
+    manifest = Manifest(str(tmp_path / 'manifest.sqlite'))
+    assert manifest.has_link(str(file), stat, 'pdfsubject', LINK)
+    file.write_text('new content')
+    assert not manifest.has_link(str(file), os.stat(file), 'pdfsubject', LINK)
+    manifest.close()
+
+def test_library_versions(tmp_path):
+    manifest = Manifest(str(tmp_path / 'manifest.sqlite'))
+    assert manifest.library_versions(str(tmp_path), 'web') == {}
+    manifest.set_library_versions(str(tmp_path), 'web', {('user', '1'): 12,
+                                                         ('group', '4455'): 7})
+    manifest.close()
+    manifest = Manifest(str(tmp_path / 'manifest.sqlite'))
+    versions = manifest.library_versions(str(tmp_path), 'web')
+    assert versions == {('user', '1'): 12, ('group', '4455'): 7}
+    assert manifest.library_versions(str(tmp_path), 'database') == {}
+    manifest.close()
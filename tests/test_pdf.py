@@ -0,0 +1,172 @@
+import os
+import pytest
+import random
+import sys
+import zlib
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from pdfrw import PdfReader
+from zowie.exceptions import PdfFormatError
+from zowie.pdf import PdfDocument, open_pdf
+
+LINK = 'zotero://select/library/items/PARENT23'
+
+_OBJECTS = [b'<< /Type /Catalog /Pages 2 0 R >>',
+            b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>']
+
+def classic_pdf(file, info = b'<< /Title (A \\(nested\\) title) /Author <FEFF00C9> >>'):
+    '''Writes a PDF file with a cross-reference table.'''
+    content = b'%PDF-1.4\n'
+    offsets = []
+    for (num, body) in enumerate(_OBJECTS + [info], start = 1):
+        offsets.append(len(content))
+        content += b'%d 0 obj\n%s\nendobj\n' % (num, body)
+    xref = len(content)
+    content += b'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets) + 1)
+    content += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    content += (b'trailer\n<< /Size %d /Root 1 0 R /Info 4 0 R /ID [<0102> <0102>] >>\n'
+                % (len(offsets) + 1))
+    content += b'startxref\n%d\n%%%%EOF\n' % xref
+    file.write_bytes(content)
+
+
+def stream_pdf(file):
+    '''Writes a PDF file with a compressed cross-reference stream, in which
+    the Info dictionary is in an object stream.'''
+    content = b'%PDF-1.5\n'
+    offsets = {}
+    for (num, body) in enumerate(_OBJECTS, start = 1):
+        offsets[num] = len(content)
+        content += b'%d 0 obj\n%s\nendobj\n' % (num, body)
+    info = b'<< /Subject (Old subject) /Producer (Some program) >>'
+    header = b'4 0 '
+    objects = zlib.compress(header + info)
+    offsets[5] = len(content)
+    content += (b'5 0 obj\n<< /Type /ObjStm /N 1 /First %d /Length %d'
+                b' /Filter /FlateDecode >>\nstream\n' % (len(header), len(objects))
+                + objects + b'\nendstream\nendobj\n')
+    offsets[6] = len(content)
+    # Entries: type (1 byte), offset or object stream (2 bytes), generation
+    # or index (1 byte), encoded using the PNG "Up" predictor.
+    rows = [bytes([0, 0, 0, 255])]
+    rows += [bytes([1]) + offsets[num].to_bytes(2, 'big') + b'\x00' for num in [1, 2, 3]]
+    rows += [bytes([2, 0, 5, 0])]
+    rows += [bytes([1]) + offsets[num].to_bytes(2, 'big') + b'\x00' for num in [5, 6]]
+    encoded = b''
+    previous = bytes(4)
+    for row in rows:
+        encoded += b'\x02' + bytes((a - b) & 0xff for (a, b) in zip(row, previous))
+        previous = row
+    stream = zlib.compress(encoded)
+    content += (b'6 0 obj\n<< /Type /XRef /Size 7 /W [1 2 1] /Root 1 0 R /Info 4 0 R'
+                b' /Filter /FlateDecode /DecodeParms << /Predictor 12 /Columns 4 >>'
+                b' /Length %d >>\nstream\n' % len(stream)
+                + stream + b'\nendstream\nendobj\n')
+    content += b'startxref\n%d\n%%%%EOF\n' % offsets[6]
+    file.write_bytes(content)
+
+
+def test_classic(tmp_path):
+    file = tmp_path / 'classic.pdf'
+    classic_pdf(file)
+    original = file.read_bytes()
+    document = PdfDocument(str(file))
+    assert document.info_text('Title') == 'A (nested) title'
+    assert document.info_text('Author') == 'É'
+    assert document.info_text('Subject') is None
+    document.update_info({'Subject': LINK})
+    # The original content is untouched; the update is appended.
+    assert file.read_bytes().startswith(original)
+    document = PdfDocument(str(file))
+    assert document.info_text('Subject') == LINK
+    assert document.info_text('Title') == 'A (nested) title'
+    # A second update is chained to the first.
+    document.update_info({'Producer': 'Ünïcode ' + LINK})
+    document = PdfDocument(str(file))
+    assert document.info_text('Producer') == 'Ünïcode ' + LINK
+    assert document.info_text('Subject') == LINK
+    # Other PDF software reads the result.
+    trailer = PdfReader(str(file))
+    assert trailer.Info.Subject.to_unicode() == LINK
+    assert trailer.Info.Producer.to_unicode() == 'Ünïcode ' + LINK
+    assert len(trailer.pages) == 1
+
+
+def test_stream(tmp_path):
+    file = tmp_path / 'stream.pdf'
+    stream_pdf(file)
+    document = PdfDocument(str(file))
+    assert document.info_text('Subject') == 'Old subject'
+    document.update_info({'Subject': LINK})
+    document = PdfDocument(str(file))
+    assert document.info_text('Subject') == LINK
+    assert document.info_text('Producer') == 'Some program'
+    trailer = PdfReader(str(file))
+    assert trailer.Info.Subject.to_unicode() == LINK
+    assert len(trailer.pages) == 1
+    # A second update is chained to the first.
+    PdfDocument(str(file)).update_info({'Subject': 'Newer ' + LINK})
+    assert PdfDocument(str(file)).info_text('Subject') == 'Newer ' + LINK
+    assert PdfReader(str(file)).Info.Subject.to_unicode() == 'Newer ' + LINK
+
+
+def test_no_info(tmp_path):
+    file = tmp_path / 'noinfo.pdf'
+    classic_pdf(file)
+    # Remove the Info entry from the trailer.
+    file.write_bytes(file.read_bytes().replace(b'/Info 4 0 R', b'           '))
+    document = PdfDocument(str(file))
+    assert document.info_text('Title') is None
+    document.update_info({'Subject': LINK})
+    assert PdfDocument(str(file)).info_text('Subject') == LINK
+    assert PdfReader(str(file)).Info.Subject.to_unicode() == LINK
+
+
+def test_fallback(tmp_path):
+    file = tmp_path / 'damaged.pdf'
+    classic_pdf(file)
+    # Make the offset of the Info object wrong; pdfrw can still read it.
+    content = file.read_bytes()
+    offset = content.index(b'4 0 obj')
+    file.write_bytes(content.replace(b'%010d 00000 n' % offset,
+                                     b'%010d 00000 n' % (offset + 2)))
+    document = open_pdf(str(file))
+    assert not isinstance(document, PdfDocument)
+    assert document.info_text('Title') == 'A (nested) title'
+    document.update_info({'Subject': LINK})
+    assert PdfReader(str(file)).Info.Subject.to_unicode() == LINK
+
+
+def test_damaged_trailer(tmp_path):
+    file = tmp_path / 'damaged.pdf'
+    classic_pdf(file)
+    # An entry of the wrong type in the trailer; pdfrw ignores it.
+    file.write_bytes(file.read_bytes().replace(b'/Size 5', b'/Size 5 /XRefStm /x'))
+    document = open_pdf(str(file))
+    assert not isinstance(document, PdfDocument)
+    assert document.info_text('Title') == 'A (nested) title'
+
+
+@pytest.mark.parametrize('make', [classic_pdf, stream_pdf])
+def test_random_damage(tmp_path, make):
+    file = tmp_path / 'damaged.pdf'
+    make(file)
+    original = file.read_bytes()
+    rand = random.Random(1)
+    for _ in range(500):
+        content = bytearray(original)
+        for _ in range(rand.randint(1, 3)):
+            content[rand.randrange(len(content))] = rand.choice(b'0123456789 /<>[]()R\n')
+        file.write_bytes(bytes(content))
+        # Damage that isn't understood is reported in one way only, so that
+        # open_pdf() can fall back to using pdfrw.
+        try:
+            PdfDocument(str(file))
+        except PdfFormatError:
+            pass
@@ -0,0 +1,66 @@
+import os
+import pytest
+import sys
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from bun import UI
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from test_pdf import classic_pdf, LINK
+from zowie.methods.pdfproducer import PDFProducer
+from zowie.methods.pdfbase import write_pdf_links, write_pdf_file_links
+from zowie.methods.pdfsubject import PDFSubject
+from zowie.file_context import FileContext
+from zowie.pdf import PdfDocument
+
+UI('Zowie', be_quiet = True, use_color = False)
+
+def test_write_link(tmp_path):
+    file = tmp_path / 'paper.pdf'
+    classic_pdf(file)
+    assert PDFSubject().write_link(str(file), LINK)
+    assert PdfDocument(str(file)).info_text('Subject') == LINK
+    size = file.stat().st_size
+    # Nothing is written when the link is already there.
+    assert PDFSubject().write_link(str(file), LINK)
+    assert file.stat().st_size == size
+    # Nothing is written in dry-run mode.
+    assert not PDFSubject(dry_run = True, overwrite = True).write_link(str(file), 'x')
+    assert file.stat().st_size == size
+
+
+def test_shared_document(tmp_path):
+    file = tmp_path / 'paper.pdf'
+    classic_pdf(file, info = b'<< /Producer (Some program) >>')
+    methods = [PDFSubject(), PDFProducer(), PDFProducer(overwrite = True)]
+    with FileContext(str(file)) as context:
+        results = write_pdf_links(context, LINK, methods, False)
+    # The Producer field has other content, and is only changed when
+    # overwriting.
+    assert [done for (done, _) in results] == [True, False, True]
+    assert [level for (_, (level, _)) in results] == ['inform', 'warn', 'inform']
+    # Both changes are in one update.
+    assert file.read_bytes().count(b'%%EOF') == 2
+    document = PdfDocument(str(file))
+    assert document.info_text('Subject') == LINK
+    assert document.info_text('Producer') == LINK
+
+
+def test_process_pool(tmp_path):
+    files = [str(tmp_path / f'{n}.pdf') for n in range(4)]
+    for file in files:
+        classic_pdf(Path(file))
+    with ProcessPoolExecutor(max_workers = 2) as pool:
+        methods = [PDFSubject(dry_run = True)]
+        futures = [pool.submit(write_pdf_file_links, f, LINK, methods, True) for f in files]
+        assert [future.result()[0][0] for future in futures] == [False] * 4
+        assert all(PdfDocument(f).info_text('Subject') is None for f in files)
+        methods = [PDFSubject()]
+        futures = [pool.submit(write_pdf_file_links, f, LINK, methods, False) for f in files]
+        assert [future.result()[0][0] for future in futures] == [True] * 4
+        assert all(PdfDocument(f).info_text('Subject') == LINK for f in files)
@@ -0,0 +1,55 @@
+import os
+import pytest
+import sys
+import threading
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from zowie.pipeline import Pipeline
+
+def produce(count, output):
+    for n in range(count):
+        output.put(n)
+
+def square(input, output):
+    for n in input:
+        output.put(n * n)
+
+def test_stages():
+    with Pipeline(threading.Event()) as pipeline:
+        numbers = pipeline.pipe(size = 3)
+        squares = pipeline.pipe(size = 3)
+        pipeline.start(produce, 1000, output = numbers)
+        pipeline.start(square, numbers, output = squares)
+        results = list(squares)
+    assert results == [n * n for n in range(1000)]
+
+def test_failure():
+    def fail(input, output):
+        for n in input:
+            if n == 5:
+                raise ValueError('bad number')
+            output.put(n)
+    with pytest.raises(ValueError):
+        with Pipeline(threading.Event()) as pipeline:
+            numbers = pipeline.pipe(size = 3)
+            checked = pipeline.pipe(size = 3)
+            pipeline.start(produce, 1000000, output = numbers)
+            pipeline.start(fail, numbers, output = checked)
+            results = list(checked)
+    assert results == [0, 1, 2, 3, 4]
+
+def test_stop():
+    stopped = threading.Event()
+    with Pipeline(stopped) as pipeline:
+        numbers = pipeline.pipe(size = 3)
+        pipeline.start(produce, 1000000, output = numbers)
+        for n in numbers:
+            if n == 10:
+                stopped.set()
+    # The producer was blocked on the full pipe and has ended.
+    assert not any(thread.name == 'produce' for thread in threading.enumerate())
@@ -0,0 +1,87 @@
+import os
+import pytest
+import shutil
+import sys
+import threading
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+import zowie.watcher
+from zowie.watcher import Watcher
+
+def no_inotify(storage):
+    raise OSError('not available')
+
+@pytest.mark.parametrize('polling', [False, True])
+def test_watcher(tmp_path, monkeypatch, polling):
+    monkeypatch.setattr(zowie.watcher, '_WAIT', 0.1)
+    if polling:
+        monkeypatch.setattr(zowie.watcher, '_Inotify', no_inotify)
+    storage = tmp_path / 'storage'
+    os.makedirs(storage / 'OLDITEM2')
+    (storage / 'OLDITEM2' / 'old.pdf').write_text('')
+    watcher = Watcher(str(storage), settle = 0.3, interval = 0)
+    stopped = threading.Event()
+    timer = threading.Timer(10, stopped.set)
+    timer.start()
+    try:
+        os.makedirs(storage / 'NEWITEM2')
+        os.makedirs(storage / 'not-an-item')
+        (storage / 'NEWITEM2' / 'paper.pdf').write_text('partial')
+        (storage / 'not-an-item' / 'other.pdf').write_text('')
+        (storage / 'NEWITEM2' / 'paper.pdf').write_text('complete')
+        batches = watcher.batches(stopped)
+        new = str(storage / 'NEWITEM2' / 'paper.pdf')
+        # The file is reported once, and files that were already there and
+        # files outside of item folders are not reported.
+        assert next(batches) == [new]
+        watcher.requeue(new, 0.2)
+        assert next(batches) == [new]
+    finally:
+        timer.cancel()
+        watcher.close()
+
+@pytest.mark.parametrize('polling', [False, True])
+def test_folder_removed(tmp_path, monkeypatch, polling):
+    monkeypatch.setattr(zowie.watcher, '_WAIT', 0.1)
+    storage = tmp_path / 'storage'
+    os.makedirs(storage)
+    gone = storage / 'DELETED2'
+    # The item folder is removed after the watcher notices it but before it
+    # looks inside, as when an item is deleted in Zotero right after adding.
+    if polling:
+        monkeypatch.setattr(zowie.watcher, '_Inotify', no_inotify)
+        scan = zowie.watcher._Poller._scan
+        def scan_and_remove(self):
+            folders = scan(self)
+            if gone.exists():
+                shutil.rmtree(gone)
+            return folders
+        monkeypatch.setattr(zowie.watcher._Poller, '_scan', scan_and_remove)
+    else:
+        watch = zowie.watcher._Inotify._watch
+        def watch_and_remove(self, folder):
+            watched = watch(self, folder)
+            if folder == str(gone):
+                shutil.rmtree(gone)
+            return watched
+        monkeypatch.setattr(zowie.watcher._Inotify, '_watch', watch_and_remove)
+    watcher = Watcher(str(storage), settle = 0.3, interval = 0)
+    stopped = threading.Event()
+    timer = threading.Timer(10, stopped.set)
+    timer.start()
+    try:
+        os.makedirs(gone)
+        (gone / 'paper.pdf').write_text('')
+        os.makedirs(storage / 'NEWITEM2')
+        (storage / 'NEWITEM2' / 'paper.pdf').write_text('')
+        # Watching goes on, and files in the other folders are reported.
+        batches = watcher.batches(stopped)
+        assert next(batches) == [str(storage / 'NEWITEM2' / 'paper.pdf')]
+    finally:
+        timer.cancel()
+        watcher.close()
@@ -0,0 +1,104 @@
+import os
+import pytest
+import sqlite3
+import sys
+from   threading import Event
+from   time import time
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from zowie.pipeline import Pipeline
+from zowie.zotero_db import ZoteroDatabase
+
+# The tables and columns below are the subset of the Zotero database schema
+# that Zowie uses.
+
+_FIXTURE = '''
+CREATE TABLE libraries (libraryID INTEGER PRIMARY KEY, type TEXT NOT NULL);
+CREATE TABLE groups (groupID INTEGER PRIMARY KEY, libraryID INT NOT NULL UNIQUE);
+CREATE TABLE items (itemID INTEGER PRIMARY KEY, libraryID INT NOT NULL, key TEXT NOT NULL);
+CREATE TABLE itemAttachments (itemID INTEGER PRIMARY KEY, parentItemID INT);
+INSERT INTO libraries VALUES (1, 'user'), (2, 'group'), (3, 'feed');
+INSERT INTO groups VALUES (4455, 2);
+INSERT INTO items VALUES (1, 1, 'PARENT23'), (2, 1, 'ATTACH23'), (3, 1, 'SINGLE23'),
+                         (4, 2, 'GPARENT2'), (5, 2, 'GATTACH2'), (6, 3, 'FEEDITM2');
+INSERT INTO itemAttachments VALUES (2, 1), (3, NULL), (5, 4), (6, NULL);
+'''
+
+@pytest.fixture
+def database(tmp_path):
+    file = str(tmp_path / 'zotero.sqlite')
+    db = sqlite3.connect(file)
+    db.executescript(_FIXTURE)
+    db.close()
+    return file
+
+def storage_file(tmp_path, key):
+    os.makedirs(tmp_path / 'storage' / key)
+    file = tmp_path / 'storage' / key / 'paper.pdf'
+    file.write_text('')
+    return str(file)
+
+def test_records(tmp_path, database):
+    resolver = ZoteroDatabase(database)
+    files = [storage_file(tmp_path, key) for key in
+             ['ATTACH23', 'SINGLE23', 'GATTACH2', 'FEEDITM2', 'MISSING2']]
+    results = list(resolver.records(files))
+    assert [file for (file, _, _) in results] == files
+    assert results[0][1].link == 'zotero://select/library/items/PARENT23'
+    assert 'lacks a parent' in results[1][2]
+    assert results[2][1].link == 'zotero://select/groups/4455/items/GPARENT2'
+    assert results[3][1] is None
+    assert results[4][1] is None
+
+def test_files_sharing_a_folder(tmp_path, database):
+    resolver = ZoteroDatabase(database)
+    files = []
+    for key in ['ATTACH23', 'MISSING2']:
+        files.append(storage_file(tmp_path, key))
+        for name in ['paper.html', 'paper.pdf.html']:
+            files.append(str(tmp_path / 'storage' / key / name))
+            (tmp_path / 'storage' / key / name).write_text('')
+    results = list(resolver.records(files))
+    assert [file for (file, _, _) in results] == files
+    assert [record.file for (_, record, _) in results[:3]] == files[:3]
+    # Each failure names its own file, even when one name contains another.
+    for (file, _, failure) in results[3:]:
+        assert failure.endswith(file)
+
+
+def test_records_in_pipeline(tmp_path, database):
+    # Lookups are done in a thread other than the one opening the database.
+    resolver = ZoteroDatabase(database)
+    def look_up(files, output):
+        for result in resolver.records(files):
+            output.put(result)
+    for key in ['ATTACH23', 'GATTACH2']:
+        with Pipeline(Event()) as pipeline:
+            results = pipeline.pipe()
+            pipeline.start(look_up, [storage_file(tmp_path, key)], output = results)
+            (_, record, failure) = next(iter(results))
+        assert failure is None and record.key == key
+        # The reopened database can be used in other threads too.
+        resolver.refresh()
+
+
+def test_prefetch(tmp_path, database):
+    resolver = ZoteroDatabase(database)
+    resolver.prefetch()
+    (record, failure) = resolver.record_for_file(storage_file(tmp_path, 'GATTACH2'))
+    assert record.parent_key == 'GPARENT2'
+
+def test_changed_attachments(tmp_path, database):
+    resolver = ZoteroDatabase(database)
+    (keys, versions) = resolver.changed_attachments({})
+    assert sorted(keys) == ['ATTACH23', 'GATTACH2', 'SINGLE23']
+    assert versions == {('user', ''): 3, ('group', '4455'): 5}
+    (keys, _) = resolver.changed_attachments({('user', ''): 2, ('group', '4455'): 5})
+    assert keys == ['SINGLE23']
+    (record, failure) = resolver.record_for_file(storage_file(tmp_path, 'ATTACH23'))
+    assert record.parent_key == 'PARENT23'
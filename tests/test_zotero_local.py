@@ -0,0 +1,371 @@
+import json
+import os
+import pytest
+import random
+import sys
+import threading
+from   http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import time
+from   urllib.parse import urlencode, urlparse, parse_qs
+
+try:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.append(os.path.join(thisdir, '..'))
+except:
+    sys.path.append('..')
+
+from commonpy.interrupt import interrupt, reset_interrupts
+from zowie.cache import ItemCache
+from zowie.zotero import Zotero
+from zowie.zotero_async import AsyncZotero
+
+# This server imitates the few parts of the local API of Zotero desktop that
+# Zowie uses: counting items, listing groups, listing the keys of items,
+# retrieving items by key or by version, in pages, and listing deleted items.
+
+_ITEMS = {
+    '/api/users/0/items': [
+        {'key': 'ATTACH23', 'library': {'type': 'user', 'id': 0}, 'version': 5,
+         'data': {'parentItem': 'PARENT23'}}],
+    '/api/groups/4455/items': [
+        {'key': 'GATTACH2', 'library': {'type': 'group', 'id': 4455}, 'version': 7,
+         'data': {'parentItem': 'GPARENT2'}}],
+}
+
+_DELETED = {}
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.server.requests.append(self.path)
+        if url.path == '/api/users/0/groups':
+            body = [{'id': 4455}]
+        elif url.path.endswith('/deleted'):
+            body = {'items': _DELETED.get(url.path, [])}
+        elif url.path in _ITEMS and query.get('format') == ['keys']:
+            if not self.server.key_lists:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            content = '\n'.join(i['key'] for i in _ITEMS[url.path]).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        elif url.path in _ITEMS:
+            keys = query.get('itemKey', [''])[0].split(',')
+            since = int(query.get('since', ['0'])[0])
+            body = [i for i in _ITEMS[url.path] if i['version'] > since
+                    and ('itemKey' not in query or i['key'] in keys)]
+            if self.server.delay:
+                time.sleep(random.random() * self.server.delay)
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        total = len(body)
+        links = ''
+        if isinstance(body, list) and query.get('limit', [''])[0].isdigit():
+            start = int(query.get('start', ['0'])[0])
+            limit = int(query['limit'][0])
+            body = body[start : start + limit]
+            if start + limit < total:
+                query['start'] = [str(start + limit)]
+                host = self.headers['Host']
+                links = (f'<http://{host}{url.path}?{urlencode(query, True)}>;'
+                         ' rel="next"')
+        content = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Total-Results', str(total))
+        if links:
+            self.send_header('Link', links)
+        self.send_header('Last-Modified-Version', str(self.server.version))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('localhost', 0), _Handler)
+    server.connections = 0
+    server.requests = []
+    server.version = 9
+    server.key_lists = True
+    server.delay = 0
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+def storage_files(tmp_path, keys = ('ATTACH23', 'GATTACH2', 'MISSING2')):
+    files = []
+    for key in keys:
+        os.makedirs(tmp_path / key, exist_ok = True)
+        (tmp_path / key / 'paper.pdf').write_text('')
+        files.append(str(tmp_path / key / 'paper.pdf'))
+    return files
+
+def attachments(libtype, libid, prefix, count):
+    # Makes "count" attachment records with item keys starting with "prefix".
+    digits = '23456789ABCDEFGHIJKLMNPQRSTUVWXYZ'
+    records = []
+    for n in range(count):
+        key = prefix + ''.join(digits[(n // len(digits)**i) % len(digits)]
+                               for i in reversed(range(8 - len(prefix))))
+        records.append({'key': key, 'library': {'type': libtype, 'id': libid},
+                        'version': 5, 'data': {'parentItem': 'P' + key[1:]}})
+    return records
+
+def link(record):
+    if record['library']['type'] == 'user':
+        return f'zotero://select/library/items/{record["data"]["parentItem"]}'
+    return (f'zotero://select/groups/{record["library"]["id"]}/items/'
+            + record['data']['parentItem'])
+
+def lookups(server):
+    # Returns the lists of keys asked for in itemKey requests.
+    return [parse_qs(urlparse(r).query)['itemKey'][0].split(',')
+            for r in server.requests if 'itemKey' in r]
+
+def test_local_api(tmp_path, server):
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    zotero = Zotero(None, None, False, endpoint = endpoint)
+    results = list(zotero.records(storage_files(tmp_path)))
+    assert results[0][1].link == 'zotero://select/library/items/PARENT23'
+    assert results[1][1].link == 'zotero://select/groups/4455/items/GPARENT2'
+    assert results[2][1] is None
+    # All requests should have gone over one kept-alive connection.
+    assert server.connections == 1
+    # Each key should have been looked up only in the library that has it,
+    # and the key that's in no library should not have been looked up.
+    lookups = [r for r in server.requests if 'itemKey' in r]
+    assert len(lookups) == 2
+    assert not any('MISSING2' in r for r in lookups)
+
+def test_async_local_api(tmp_path, server):
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    zotero = AsyncZotero(None, None, False, endpoint = endpoint)
+    results = list(zotero.records(storage_files(tmp_path)))
+    zotero.close()
+    assert results[0][1].link == 'zotero://select/library/items/PARENT23'
+    assert results[1][1].link == 'zotero://select/groups/4455/items/GPARENT2'
+    assert results[2][1] is None
+
+@pytest.mark.parametrize('resolver', [Zotero, AsyncZotero])
+def test_refresh(tmp_path, server, monkeypatch, resolver):
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    zotero = resolver(None, None, False, endpoint = endpoint)
+    files = storage_files(tmp_path)
+    list(zotero.records(files))
+    # An attachment is added to Zotero after the key lists were retrieved.
+    items = dict(_ITEMS)
+    items['/api/users/0/items'] = items['/api/users/0/items'] + [
+        {'key': 'MISSING2', 'library': {'type': 'user', 'id': 0}, 'version': 8,
+         'data': {'parentItem': 'PARENT23'}}]
+    monkeypatch.setattr(sys.modules[__name__], '_ITEMS', items)
+    zotero.refresh()
+    results = list(zotero.records(files[2:]))
+    zotero.close()
+    assert results[0][1].link == 'zotero://select/library/items/PARENT23'
+    # The key lists were not retrieved again.
+    assert len([r for r in server.requests if 'format=keys' in r]) == 2
+
+@pytest.mark.parametrize('resolver', [Zotero, AsyncZotero])
+def test_changed_attachments(server, resolver):
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    zotero = resolver(None, None, False, endpoint = endpoint)
+    (keys, versions) = zotero.changed_attachments({('user', '0'): 6})
+    zotero.close()
+    assert keys == ['GATTACH2']
+    assert versions == {('user', '0'): 9, ('group', '4455'): 9}
+
+@pytest.mark.parametrize('resolver', [Zotero, AsyncZotero])
+def test_no_record_json_kept(tmp_path, server, resolver):
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    zotero = resolver(None, None, False, endpoint = endpoint)
+    results = list(zotero.records(storage_files(tmp_path)))
+    zotero.close()
+    # Only the key, library and parent of each item are kept, not the JSON.
+    assert all(record.record is None for (_, record, _) in results[:2])
+    assert zotero._index['ATTACH23'] == ('user', '0', 'PARENT23')
+    assert zotero._index['GATTACH2'] == ('group', '4455', 'GPARENT2')
+
+@pytest.mark.parametrize('resolver', [Zotero, AsyncZotero])
+def test_cache_first_run(tmp_path, server, resolver):
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    cache = ItemCache(str(tmp_path / 'items.sqlite'))
+    zotero = resolver(None, None, False, cache = cache, endpoint = endpoint)
+    zotero.close()
+    # Only the current versions are recorded; nothing is downloaded.
+    assert cache.version('user', '0') == 9
+    assert cache.version('group', '4455') == 9
+    assert cache.get('ATTACH23') is None
+    assert not any('since=' in r or '/deleted' in r for r in server.requests)
+
+@pytest.mark.parametrize('resolver', [Zotero, AsyncZotero])
+def test_cache_later_run(tmp_path, server, monkeypatch, resolver):
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    cache = ItemCache(str(tmp_path / 'items.sqlite'))
+    cache.set_version('user', '0', 6)
+    cache.set_version('group', '4455', 6)
+    cache.put([('DELETED2', 'user', '0', 'PARENT23')])
+    monkeypatch.setattr(sys.modules[__name__], '_DELETED',
+                        {'/api/users/0/deleted': ['DELETED2']})
+    server.version = 12
+    zotero = resolver(None, None, False, cache = cache, endpoint = endpoint)
+    zotero.close()
+    # Only the attachment changed after version 6 is downloaded, and the
+    # deleted one is removed.
+    assert cache.get('GATTACH2') == ('group', '4455', 'GPARENT2')
+    assert cache.get('ATTACH23') is None
+    assert cache.get('DELETED2') is None
+    assert cache.version('user', '0') == 12
+    assert cache.version('group', '4455') == 12
+    deleted = [r for r in server.requests if '/deleted' in r]
+    assert len(deleted) == 2 and all('since=6' in r for r in deleted)
+    # Lookups are answered from the cache afterwards.
+    server.requests.clear()
+    zotero = resolver(None, None, False, cache = cache, endpoint = endpoint)
+    results = list(zotero.records(storage_files(tmp_path)[1:2]))
+    zotero.close()
+    assert results[0][1].link == 'zotero://select/groups/4455/items/GPARENT2'
+    assert not any('itemKey' in r for r in server.requests)
+
+@pytest.mark.parametrize('resolver', [Zotero, AsyncZotero])
+def test_cache_lost_library(tmp_path, server, resolver):
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    cache = ItemCache(str(tmp_path / 'items.sqlite'))
+    cache.set_version('group', '9999', 3)
+    cache.put([('OLDITEM2', 'group', '9999', 'PARENT23')])
+    zotero = resolver(None, None, False, cache = cache, endpoint = endpoint)
+    zotero.close()
+    # The user can no longer access group 9999, so its data is forgotten.
+    assert ('group', '9999') not in cache.libraries()
+    assert cache.get('OLDITEM2') is None
+
+@pytest.mark.parametrize('resolver', [Zotero, AsyncZotero])
+def test_prefetch(tmp_path, server, monkeypatch, resolver):
+    items = {'/api/users/0/items': attachments('user', 0, 'USR', 250),
+             '/api/groups/4455/items': attachments('group', 4455, 'GRP', 30)}
+    monkeypatch.setattr(sys.modules[__name__], '_ITEMS', items)
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    zotero = resolver(None, None, False, endpoint = endpoint)
+    zotero.prefetch()
+    # 250 attachments take 3 pages of 100, and 30 attachments take 1.
+    pages = [r for r in server.requests if 'itemType=attachment' in r]
+    assert len(pages) == 4
+    wanted = [items['/api/users/0/items'][249], items['/api/groups/4455/items'][0]]
+    files = storage_files(tmp_path, [r['key'] for r in wanted] + ['MISSING2'])
+    results = list(zotero.records(files))
+    zotero.close()
+    assert [record.link for (_, record, _) in results[:2]] == [link(r) for r in wanted]
+    assert results[2][1] is None
+    # Everything was answered from the index.
+    assert not lookups(server)
+
+@pytest.mark.parametrize('resolver', [Zotero, AsyncZotero])
+def test_batches(tmp_path, server, monkeypatch, resolver):
+    items = {'/api/users/0/items': attachments('user', 0, 'USR', 120),
+             '/api/groups/4455/items': attachments('group', 4455, 'GRP', 2)}
+    monkeypatch.setattr(sys.modules[__name__], '_ITEMS', items)
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    zotero = resolver(None, None, False, endpoint = endpoint)
+    records = items['/api/users/0/items']
+    files = storage_files(tmp_path, [r['key'] for r in records])
+    # Put second files in the item folders on both sides of the 50th key, so
+    # that a key is in two groups of files.
+    for n in [49, 50]:
+        other = os.path.join(os.path.dirname(files[n]), 'second.pdf')
+        open(other, 'w').close()
+        files.insert(files.index(files[n]) + 1, other)
+    files.sort()
+    results = list(zotero.records(files))
+    zotero.close()
+    assert [file for (file, _, _) in results] == files
+    key_links = {r['key']: link(r) for r in records}
+    assert all(record.link == key_links[os.path.basename(os.path.dirname(file))]
+               for (file, record, _) in results)
+    # Each key is asked for once, in batches of at most 50 keys. Zotero is
+    # given groups of files with 50 keys, so the key in the first two groups
+    # is left out of the second batch; AsyncZotero is given all the keys.
+    batches = lookups(server)
+    sizes = [50, 49, 21] if resolver is Zotero else [50, 50, 20]
+    assert sorted(map(len, batches)) == sorted(sizes)
+    assert sorted(sum(batches, [])) == sorted(key_links)
+
+def test_batches_without_key_lists(tmp_path, server, monkeypatch):
+    items = {'/api/users/0/items': attachments('user', 0, 'USR', 30),
+             '/api/groups/4455/items': attachments('group', 4455, 'GRP', 30)}
+    monkeypatch.setattr(sys.modules[__name__], '_ITEMS', items)
+    server.key_lists = False
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    zotero = Zotero(None, None, False, endpoint = endpoint)
+    records = items['/api/users/0/items'] + items['/api/groups/4455/items']
+    files = storage_files(tmp_path, [r['key'] for r in records])
+    results = list(zotero.records(files))
+    assert [record.link for (_, record, _) in results] == [link(r) for r in records]
+    # The owners of keys are not known, so the keys not found in the user
+    # library are carried over to the group library, and nothing else is.
+    group = [parse_qs(urlparse(r).query)['itemKey'][0].split(',')
+             for r in server.requests if '/groups/4455/items?' in r
+             and 'itemKey' in r]
+    assert sorted(sum(group, [])) == [r['key'] for r in items['/api/groups/4455/items']]
+
+def test_jobs(tmp_path, server, monkeypatch):
+    items = {'/api/users/0/items': attachments('user', 0, 'USR', 300),
+             '/api/groups/4455/items': attachments('group', 4455, 'GRP', 60)}
+    monkeypatch.setattr(sys.modules[__name__], '_ITEMS', items)
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    keys = [r['key'] for r in items['/api/users/0/items'] + items['/api/groups/4455/items']]
+    random.Random(1).shuffle(keys)
+    files = storage_files(tmp_path, keys + ['MISSING2'])
+    zotero = Zotero(None, None, False, endpoint = endpoint)
+    serial = list(zotero.records(files))
+    serial_batches = lookups(server)
+    # Make lookups finish in a different order than they were started.
+    server.delay = 0.05
+    server.requests.clear()
+    zotero = Zotero(None, None, False, endpoint = endpoint, jobs = 4)
+    threaded = list(zotero.records(files))
+    assert [file for (file, _, _) in threaded] == files
+    assert ([(r and r.link, failure) for (_, r, failure) in threaded]
+            == [(r and r.link, failure) for (_, r, failure) in serial])
+    assert sorted(map(sorted, lookups(server))) == sorted(map(sorted, serial_batches))
+
+def test_jobs_interrupted(tmp_path, server):
+    endpoint = f'http://localhost:{server.server_address[1]}/api'
+    zotero = Zotero(None, None, False, endpoint = endpoint, jobs = 2)
+    keys = [r['key'] for r in attachments('user', 0, 'USR', 500)]
+    files = [str(tmp_path / key / 'paper.pdf') for key in keys]
+    calls = []
+    def slow_resolve_keys(keys):
+        calls.append(keys)
+        time.sleep(2)
+    zotero.resolve_keys = slow_resolve_keys
+    # Interrupt while the first 2 of 10 groups are being looked up and the
+    # next 2 are waiting.
+    timer = threading.Timer(0.2, interrupt)
+    timer.start()
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            list(zotero.records(files))
+    finally:
+        timer.cancel()
+        reset_interrupts()
+    # The groups that were waiting were cancelled, and no more were started.
+    assert len(calls) == 2
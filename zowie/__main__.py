@@ -17,6 +17,7 @@ Please see the file "LICENSE" for more information.
 # Note: this program uses lazy importing of Python packages. Other imports
 # are present throughout the rest of the code.
 
+from   multiprocessing import freeze_support
 import plac
 import sys
 from   sys import exit as exit
@@ -33,26 +34,43 @@ if __debug__:
 
 @plac.annotations(
     api_key    = ('use API key "A" to access the Zotero API service',        'option', 'a'),
+    use_async  = ('send many lookups at once using asynchronous requests',   'flag',   'A'),
+    changed    = ('only act on attachments changed in Zotero since last run', 'flag', 'c'),
     no_color   = ('do not color-code terminal output',                       'flag',   'C'),
     after_date = ('only act on files created or modified after date "D"',    'option', 'd'),
     file_ext   = ('only act on files with extensions in "F" (default: all)', 'option', 'f'),
     identifier = ('use Zotero user ID "I" for API calls',                    'option', 'i'),
+    jobs       = ('look up "J" groups of files at a time (default: 1)',      'option', 'j'),
     no_keyring = ('do not store credentials in the keyring service',         'flag',   'K'),
     list       = ('print list of known methods',                             'flag',   'l'),
+    local_api  = ('use the local API of the Zotero desktop application',     'flag',   'L'),
     method     = ('select method to store links (default: finder comments)', 'option', 'm'),
     dry_run    = ('report what would be done without actually doing it',     'flag',   'n'),
+    no_cache   = ('do not use or update the cache of Zotero data',           'flag',   'N'),
     overwrite  = ('forcefully overwrite previous content',                   'flag',   'o'),
+    prefetch   = ('download all attachment records before processing files', 'flag',   'p'),
+    processes  = ('write into "P" PDF files at a time (default: 1)',         'option', 'P'),
     quiet      = ('be less chatty -- only print important messages',         'flag',   'q'),
+    reverify   = ('check all files, even those done and unchanged since',    'flag',   'r'),
     space      = ('add a trailing space character to Finder comments',       'flag',   's'),
+    since_last_run = ('only act on files added or changed since the last run', 'flag', 'S'),
     version    = ('print version info and exit',                             'flag',   'V'),
+    walkers    = ('read "W" folders at a time when looking for files',       'option', 'w'),
+    watch      = ('keep running and act on new files as they appear',        'flag',   'W'),
+    exclude    = ('skip files & folders matching patterns "X" (comma-separated)', 'option', 'x'),
+    zotero_db  = ('read Zotero data from database file "Z" instead of network', 'option', 'Z'),
     debug      = ('write detailed trace to "OUT" ("-" means console)',       'option', '@'),
     files      = 'file(s) and/or folder(s) containing Zotero attachment files',
 )
 
-def main(api_key = 'A', no_color = False, after_date = 'D', file_ext = 'F',
-         identifier = 'I', no_keyring = False, list = False, method = 'M',
-         dry_run = False, overwrite = False, quiet = False, space = False,
-         version = False, debug = 'OUT', *files):
+def main(api_key = 'A', use_async = False, changed = False, no_color = False,
+         after_date = 'D', file_ext = 'F', identifier = 'I', jobs = 'J',
+         no_keyring = False, list = False, local_api = False, method = 'M',
+         dry_run = False, no_cache = False, overwrite = False,
+         prefetch = False, processes = 'P', quiet = False, reverify = False,
+         space = False, since_last_run = False, version = False,
+         walkers = 'W', watch = False, exclude = 'X', zotero_db = 'Z',
+         debug = 'OUT', *files):
     '''Zowie ("ZOtero link WrItEr") is a tool for Zotero users.
 
 Zowie writes Zotero select links into the files and/or the macOS Finder
@@ -77,6 +95,19 @@ also given). This is also how you can replace previously-stored values: use
 To find out your Zotero userID and create an API key, log in to your Zotero
 account at Zotero.org and visit https://www.zotero.org/settings/keys
 
+Alternatively, Zowie can read the information it needs directly from the
+database file of the Zotero desktop application, without using the network
+and without needing credentials. Use the option -Z to give Zowie the path to
+the database file; it is typically ~/Zotero/zotero.sqlite. The file is only
+read, never modified, and it can be read while Zotero is running.
+
+Another alternative is available if you use Zotero 7 or later: the option -L
+makes Zowie use the local API offered by the Zotero desktop application at
+http://localhost:23119/api/. This requires Zotero to be running and the
+option "Allow other applications on this computer to communicate with
+Zotero" to be enabled in the Advanced section of the Zotero settings. The
+local API does not need credentials and is much faster than the network API.
+
 Basic usage
 ~~~~~~~~~~~
 
@@ -151,6 +182,26 @@ multiple file extensions separated by commas, without spaces and without the
 leading periods.  Note that Zowie always ignores certain files, such as those
 ending with .css, .js, .json, .bak, .csl, and a few others.
 
+When given a Zotero data folder (one that contains zotero.sqlite and a
+storage subfolder), Zowie only looks in the item folders under storage/, and
+skips the other folders such as styles/ and translators/. Files in folders
+whose names are not Zotero item keys are not looked up. Files reached more
+than once through hard or symbolic links are only processed once.
+
+The option -x makes Zowie skip files and folders whose names or paths match
+any of the given patterns, separated by commas. The patterns use shell-style
+wildcards; a folder that matches is not examined at all. For example,
+
+  zowie -x '*.html,old-*' ~/Zotero
+
+will skip all .html files and every file and folder whose name starts with
+"old-".
+
+If the files are on a network share, where every access to the file system
+takes a while, looking for files can take a long time. The option -w makes
+Zowie read several folders at the same time; for example, -w 8 makes it read
+up to 8 folders at once. The files are processed in the same order as usual.
+
 Filtering by date
 ~~~~~~~~~~~~~~~~~
 
@@ -165,6 +216,83 @@ quotes. Examples:
  zowie -d "12 Dec 2014" ....
  zowie -d "July 4, 2013" ....
 
+Zowie remembers when it was last run on each file or folder. If given the
+option -S, Zowie only acts on the files that were added or modified since
+the start of the last complete run on the same file or folder (that is, the
+last run that was not a dry run, was not interrupted, and did not fail to
+look up files because of network problems). This is convenient for regular
+runs, for example from cron. When used on a Zotero data folder, -S also
+skips the item folders in Zotero's storage folder where no files have been
+added since the last run, without looking inside them. The options -d and
+-S cannot be used together.
+
+Zowie can also ask Zotero what changed, instead of looking at the files.
+If given the option -c and a Zotero data folder (or the storage folder in
+it), Zowie asks Zotero for the attachments that were added or modified since
+the last complete run with -c on the same folder, and only examines the item
+folders of those attachments in the storage folder. This is much faster than
+-S for large libraries in which little changes, because the time it takes
+depends on the number of changed attachments rather than the number of
+files. (When used with -Z, only added attachments are found.) The first run
+with -c examines all attachments. Files of attachments that Zotero had not
+yet downloaded at the time of a run are not picked up by later runs with -c,
+but are by runs with -S. The option -c cannot be used with -d, -S or -W.
+
+Watching for new files
+~~~~~~~~~~~~~~~~~~~~~~
+
+If given the option -W and a Zotero data folder (or the storage folder in
+it), Zowie does not look at the files already there. Instead, it keeps
+running and acts on new files as they are added to the storage folder, until
+interrupted with ^C. Files are processed once they have stopped changing for
+a few seconds, and files that appear together are looked up together. A new
+attachment may appear in the storage folder before Zotero has synced it to
+the Zotero servers; files that cannot be looked up are tried again a few
+times over the next 20 minutes or so, and only then reported. On Linux, Zowie is
+notified of new files by the operating system; elsewhere, it checks the
+storage folder every 10 seconds. To catch up on the files added while Zowie
+was not running, run it once with -S before starting it with -W.
+
+Working with large libraries
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+By default, Zowie asks the Zotero servers about each file separately. If you
+are processing a large number of files, the -p option will make Zowie first
+download the (minimal) records of all attachments in your user library and
+group libraries, 100 at a time, and then look up every file in that local
+index instead of contacting the servers once per file. This is much faster
+when processing thousands of files, but slower when processing only a few.
+
+Zowie keeps a cache of the Zotero data it retrieves, in a database file in
+the user's cache directory (~/Library/Caches/zowie/ on macOS). On subsequent
+runs, Zowie only asks the Zotero servers for the attachments that changed
+since the previous run, and uses the cache for everything else. The option
+-N makes Zowie neither use nor update the cache.
+
+Most of the time spent looking up files is spent waiting for the network.
+Zowie looks up the next files while it writes links into earlier ones, so
+that writing and waiting overlap, but on its own, it sends one request at a
+time. The option -j makes Zowie send several requests at the same time; for
+example, "-j 4" makes Zowie look up 4 groups of files at once. The results
+are still processed in the same order as without -j. The option -A makes
+Zowie use asynchronous network requests instead of threads; this sends each
+group of files to all of the user's libraries at the same time, and can
+keep more requests in progress at once. With -A, the value given to -j is
+the maximum number of requests in progress at any time (default: 8).
+
+When the methods pdfsubject or pdfproducer are used, reading and updating
+the PDF files takes processor time. The option -P makes Zowie do that work
+in several processes at the same time, to use more processor cores; for
+example, "-P 8" makes it work on up to 8 PDF files at once. The messages
+about the files are still printed in the same order as without -P.
+
+Zowie also keeps a record of the links it has written into files, in the
+same directory as the cache. When it's run again on the same files, it skips
+writing a link if the file has not changed since Zowie last wrote that same
+link into it with the same method; this avoids reading the metadata of every
+file again. The option -r makes Zowie check and update every file anyway, as
+does the overwrite option (-o).
+
 Special-case behavior
 ~~~~~~~~~~~~~~~~~~~~~
 
@@ -278,6 +406,7 @@ Command-line arguments summary
     from commonpy.data_utils import timestamp
     from commonpy.interrupt import config_interrupt
     from zowie.exceptions import UserCancelled, FileError, CannotProceed
+    from zowie.exceptions import ServiceFailure
     from zowie.main_body import MainBody
 
     if __debug__: log('='*8 + f' started {timestamp()} ' + '='*8)
@@ -287,11 +416,24 @@ Command-line arguments summary
                         file_ext    = None if file_ext == 'F' else file_ext,
                         api_key     = None if api_key == 'A' else api_key,
                         user_id     = None if identifier == 'I' else identifier,
+                        zotero_db   = None if zotero_db == 'Z' else zotero_db,
+                        local_api   = local_api,
                         use_keyring = not no_keyring,
+                        use_cache   = not no_cache,
+                        jobs        = None if jobs == 'J' else jobs,
+                        use_async   = use_async,
                         after_date  = None if after_date == 'D' else after_date,
+                        since_last_run = since_last_run,
+                        changed     = changed,
+                        exclude     = None if exclude == 'X' else exclude,
+                        walkers     = None if walkers == 'W' else walkers,
+                        watch       = watch,
                         methods     = methods_list,
                         dry_run     = dry_run,
                         overwrite   = overwrite,
+                        prefetch    = prefetch,
+                        processes   = None if processes == 'P' else processes,
+                        reverify    = reverify,
                         add_space   = space)
         config_interrupt(body.stop, UserCancelled(ExitCode.user_interrupt))
         body.run()
@@ -310,6 +452,9 @@ Command-line arguments summary
         elif exception[0] == FileError:
             alert_fatal(antiformat(exception[1]))
             exit_code = ExitCode.file_error
+        elif exception[0] == ServiceFailure:
+            alert_fatal(antiformat(exception[1]))
+            exit_code = ExitCode.server_error
         elif exception[0] in [KeyboardInterrupt, UserCancelled]:
             warn('Interrupted.')
             exit_code = ExitCode.user_interrupt
@@ -338,9 +483,12 @@ Command-line arguments summary
 # option to setuptools.  The entry point for console_scripts has to be a
 # function that takes zero arguments.
 def console_scripts_main():
+    # Let the worker processes of -P start in frozen (PyInstaller) programs.
+    freeze_support()
     plac.call(main)
 
 
 # The following allows users to invoke this using "python3 -m zowie".
 if __name__ == '__main__':
+    freeze_support()
     plac.call(main)
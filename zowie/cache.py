@@ -0,0 +1,140 @@
+'''
+cache.py: persistent cache of Zotero attachment data
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2020 by Michael Hucka and the California Institute of Technology.
+This code is open-source software released under a 3-clause BSD license.
+Please see the file "LICENSE" for more information.
+'''
+
+import os
+from   os import path
+import sqlite3
+import sys
+from   threading import Lock
+
+if __debug__:
+    from sidetrack import log
+
+
+# Internal constants.
+# .............................................................................
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    key       TEXT PRIMARY KEY,
+    libtype   TEXT NOT NULL,
+    libid     TEXT NOT NULL,
+    parent    TEXT
+);
+CREATE TABLE IF NOT EXISTS libraries (
+    libtype   TEXT NOT NULL,
+    libid     TEXT NOT NULL,
+    version   INTEGER NOT NULL,
+    PRIMARY KEY (libtype, libid)
+);
+'''
+
+
+# Exported classes.
+# .............................................................................
+
+class ItemCache():
+    '''Persistent cache mapping Zotero item keys to their library and parent.
+
+    The cache also records, for each library, the Zotero library version at
+    which the cached data was known to be current. Callers use that version
+    to ask the Zotero API only for the changes made since then.
+    '''
+
+    def __init__(self, file = None):
+        if not file:
+            file = path.join(cache_dir(), 'items.sqlite')
+        os.makedirs(path.dirname(file), exist_ok = True)
+        if __debug__: log(f'opening item cache {file}')
+        # The cache may be used from several threads, so access is serialized.
+        self._db = sqlite3.connect(file, check_same_thread = False)
+        self._db.executescript(_SCHEMA)
+        self._lock = Lock()
+
+
+    def get(self, key):
+        '''Returns a tuple (library type, library id, parent key), or None.'''
+        with self._lock:
+            cursor = self._db.execute('SELECT libtype, libid, parent FROM items'
+                                      ' WHERE key = ?', (key,))
+            row = cursor.fetchone()
+        if not row:
+            return None
+        # Share the strings of library types and ids, as index_entry() does.
+        return (sys.intern(row[0]), sys.intern(row[1]), row[2])
+
+
+    def put(self, entries):
+        '''Stores tuples (key, library type, library id, parent key).'''
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO items VALUES (?,?,?,?)',
+                                 entries)
+
+
+    def delete(self, keys):
+        '''Removes the entries for the given item keys, if they exist.'''
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM items WHERE key = ?',
+                                 ((key,) for key in keys))
+
+
+    def libraries(self):
+        '''Returns a list of (library type, library id) for cached libraries.'''
+        with self._lock:
+            return self._db.execute('SELECT libtype, libid FROM libraries').fetchall()
+
+
+    def forget_library(self, libtype, libid):
+        '''Removes all data about the given library.'''
+        if __debug__: log(f'removing cached data for {libtype} {libid}')
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM items WHERE libtype = ? AND libid = ?',
+                             (libtype, libid))
+            self._db.execute('DELETE FROM libraries WHERE libtype = ? AND libid = ?',
+                             (libtype, libid))
+
+
+    def version(self, libtype, libid):
+        '''Returns the library version at which the cache was current, or None.'''
+        with self._lock:
+            cursor = self._db.execute('SELECT version FROM libraries'
+                                      ' WHERE libtype = ? AND libid = ?',
+                                      (libtype, libid))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+
+    def set_version(self, libtype, libid, version):
+        '''Records the library version at which the cache is current.'''
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO libraries VALUES (?,?,?)',
+                             (libtype, libid, int(version)))
+
+
+    def close(self):
+        self._db.close()
+
+
+# Miscellaneous utilities.
+# .............................................................................
+
+def cache_dir():
+    '''Returns the path of the directory where Zowie keeps cached data.'''
+    if sys.platform.startswith('darwin'):
+        base = path.join(path.expanduser('~'), 'Library', 'Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or path.expanduser('~/.cache')
+    return path.join(base, 'zowie')
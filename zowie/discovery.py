@@ -0,0 +1,312 @@
+'''
+discovery.py: find the files that Zowie should work on
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2020 by Michael Hucka and the California Institute of Technology.
+This code is open-source software released under a 3-clause BSD license.
+Please see the file "LICENSE" for more information.
+'''
+
+from   bun import warn
+from   collections import deque
+from   commonpy.file_utils import filename_extension
+from   commonpy.string_utils import antiformat
+from   concurrent.futures import ThreadPoolExecutor
+from   fnmatch import fnmatch
+import os
+from   os import path
+
+from .resolver import valid_key
+
+if __debug__:
+    from sidetrack import log
+
+
+# Internal constants.
+# .............................................................................
+
+_IGNORED_EXT = ['.sqlite', '.sqlite-journal', '.bak', '.ico', '.json', '.csl',
+                '.pl', '.js', '.css', '.config_resp']
+
+
+# Exported functions.
+# .............................................................................
+
+def target_files(items, extensions = None, after_date = None, skip = None,
+                 exclude = None, threads = 1, since = None):
+    '''Generator yielding the files to work on, as they are found.
+
+    Each of the "items" can be a file or a folder; folders are traversed
+    recursively, and the files in them are produced in sorted order. Hidden
+    files and files with extensions in _IGNORED_EXT are skipped. If given,
+    "extensions" is a list of file name extensions (with leading periods)
+    that files must have; "after_date" is a datetime that file modification
+    times must be equal to or later than; "skip" is a function that is called
+    on a file path and returns True if the file should be skipped; and
+    "exclude" is a list of glob patterns for files and folders to leave out.
+    A pattern is matched against both the name and the full path of a file
+    or folder (including the "items" themselves); a folder that matches is
+    not traversed at all. If "threads" is more than 1, folders are read
+    concurrently by that many threads.
+
+    If given, "since" is a dict mapping some of the "items" to POSIX times:
+    files in those items modified before that time are skipped. If the item
+    is a Zotero data directory or storage folder, the item folders in it
+    that were last modified before then are skipped instead, and all the
+    files in the other item folders are used, whatever their modification
+    times. (A folder's modification time changes when files are added to it
+    or removed from it, so nothing new was added to the skipped folders.)
+
+    A folder that is a Zotero data directory (i.e., it contains the files
+    "zotero.sqlite" and "storage") is handled specially: only the folders
+    inside "storage" whose names are Zotero item keys are looked at, and not
+    the other folders (e.g., "styles" and "translators"). Files that are
+    reached more than once, through hard or symbolic links, are produced
+    only the first time.
+    '''
+    # The comparison is done the way Zowie has always done it: using the
+    # wall-clock time of the modification date, ignoring time zones.
+    after = after_date.replace(tzinfo = None).timestamp() if after_date else None
+    since = since or {}
+    walker = _Walker(exclude or [], threads, stat = bool(after or since))
+    try:
+        for item in items:
+            cutoff = max(after or 0, since.get(item) or 0) or None
+            if _excluded(item, exclude or []):
+                continue
+            if path.isfile(item):
+                if walker.first_visit(item) and _wanted(item, None, extensions,
+                                                         cutoff, skip):
+                    yield item
+            elif path.isdir(item):
+                if __debug__: log(f'looking for files in {antiformat(item)}')
+                if storage_folder(item):
+                    # Zotero keeps the original modification times of files
+                    # it syncs or imports, so a new file can look old. The
+                    # item folders that changed since then are found by
+                    # pruning the others, and all their files are used.
+                    cutoff = after
+                for (file, entry) in walker.walk(item, since.get(item)):
+                    if _wanted(file, entry, extensions, cutoff, skip):
+                        yield file
+            else:
+                warn(f'Not a file nor a folder of files: "{antiformat(item)}"')
+    finally:
+        walker.close()
+
+
+def storage_folder(directory):
+    '''Returns the Zotero storage folder that "directory" is or contains.
+
+    If "directory" is a Zotero data directory, the path of the "storage"
+    folder in it is returned; if it's the "storage" folder of a Zotero data
+    directory, it's returned as-is. Otherwise, the result is None.
+    '''
+    if _is_data_dir(directory):
+        return path.join(directory, 'storage')
+    if (path.basename(path.normpath(directory)) == 'storage'
+            and _is_data_dir(path.dirname(path.abspath(directory)))):
+        return directory
+    return None
+
+
+# Internal classes.
+# .............................................................................
+
+class _Walker():
+    '''Traverses folders, remembering what has been seen.
+
+    If "threads" is more than 1, the folders coming up next in the traversal
+    are read ahead of time by a pool of that many threads. This helps when
+    each file system call is slow, such as on network shares. The results are
+    produced in the same order either way. If "stat" is True, the files are
+    also stat'ed while reading folders; the results are kept in the DirEntry
+    objects, where DirEntry.stat() finds them later.
+    '''
+
+    def __init__(self, exclude, threads = 1, stat = False):
+        self._exclude = exclude
+        self._stat = stat
+        # Tuples (device, inode) of the files and folders visited so far.
+        self._seen = set()
+        self._executor = None
+        # Futures of folders being read ahead that haven't been reached yet.
+        self._pending = set()
+        if threads > 1:
+            if __debug__: log(f'reading folders using {threads} threads')
+            self._executor = ThreadPoolExecutor(max_workers = threads)
+            # Number of subfolders of a folder to read before they're reached.
+            self._ahead = 4 * threads
+
+
+    def close(self):
+        if self._executor:
+            # Folders not reached yet (e.g., if the traversal was stopped)
+            # don't need to be read. Shutdown() only does this in Python 3.9+.
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait = False)
+
+
+    def first_visit(self, file):
+        '''Returns True if the file has not been seen before.'''
+        stat = os.stat(file)
+        return self._first((stat.st_dev, stat.st_ino))
+
+
+    def walk(self, directory, prune = None):
+        '''Generator yielding (path, DirEntry) for the files in "directory".
+
+        Files are yielded in the order of their full paths, the same order that
+        sorting the list of all the files would produce. If "prune" is given,
+        it's a POSIX time, and Zotero item folders last modified before then
+        are left out.
+        '''
+        storage = storage_folder(directory)
+        if storage:
+            if __debug__: log(f'{antiformat(storage)} is a Zotero storage folder')
+            yield from self._walk(storage, 'storage', prune)
+        else:
+            yield from self._walk(directory, None, prune)
+
+
+    def _walk(self, directory, layout, prune, future = None):
+        # The value of "layout" is 'storage' when traversing the storage folder
+        # of a Zotero data directory, 'item' when traversing one of the item
+        # folders in it, and None otherwise. If the folder is being read by
+        # another thread, "future" is the Future for the result of _read().
+        if future:
+            contents = future.result()
+        else:
+            contents = self._read(directory, layout, prune)
+        if not contents:
+            return
+        (id, entries) = contents
+        # Checking here rather than in _read() makes the outcome the same
+        # regardless of the order in which threads finish.
+        if not self._first(id):
+            if __debug__: log(f'already visited {antiformat(directory)}')
+            return
+        sublayout = 'item' if layout == 'storage' else None
+        folders = iter([entry.path for (entry, id) in entries if id is None])
+        started = deque()
+        for (entry, id) in entries:
+            if id is None:
+                if self._executor:
+                    # Start reading the next few subfolders, then wait for this
+                    # one (which was started earlier) to be read.
+                    while len(started) < self._ahead:
+                        folder = next(folders, None)
+                        if folder is None:
+                            break
+                        started.append(self._executor.submit(self._read, folder,
+                                                              sublayout, prune))
+                        self._pending.add(started[-1])
+                    future = started.popleft()
+                    self._pending.discard(future)
+                yield from self._walk(entry.path, sublayout, prune, future)
+            elif self._first(id):
+                yield (entry.path, entry)
+
+
+    def _read(self, directory, layout, prune):
+        '''Returns (folder id, list of entries) for the folder, or None.
+
+        The folder id is a tuple (device, inode). The list contains tuples
+        (DirEntry, id), sorted in the order in which they're traversed, with
+        id = None for folders and id = (device, inode) for files. All of the
+        file system calls needed for the folder are made here, so that they
+        can be done in another thread.
+        '''
+        try:
+            stat = os.stat(directory)
+            with os.scandir(directory) as scanner:
+                entries = [entry for entry in scanner
+                           if not _excluded(entry.path, self._exclude)]
+        except OSError as ex:
+            if __debug__: log(f'unable to read {antiformat(directory)}: {str(ex)}')
+            return None
+        contents = []
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if layout is None:
+                        contents.append((entry, None))
+                    elif layout == 'storage' and valid_key(entry.name):
+                        if prune and entry.stat().st_mtime < prune:
+                            if __debug__: log(f'pruning unchanged {antiformat(entry.path)}')
+                            continue
+                        contents.append((entry, None))
+                elif (layout != 'storage' and entry.is_file()
+                      and os.access(entry.path, os.R_OK)):
+                    # The inode number in the directory entry is that of the
+                    # link if the entry is a symbolic link, so stat those.
+                    if entry.is_symlink() or self._stat:
+                        file_stat = entry.stat()
+                        contents.append((entry, (file_stat.st_dev, file_stat.st_ino)))
+                    else:
+                        contents.append((entry, (stat.st_dev, entry.inode())))
+            except OSError as ex:
+                if __debug__: log(f'unable to read {antiformat(entry.path)}: {str(ex)}')
+        # A subdirectory's files start with its name + '/', and so sort after a
+        # file whose name is its name + '.', etc. Sorting with '/' appended to
+        # the names of directories keeps that order.
+        contents.sort(key = lambda item: item[0].name + ('/' if item[1] is None else ''))
+        return ((stat.st_dev, stat.st_ino), contents)
+
+
+    def _first(self, id):
+        if id in self._seen:
+            return False
+        self._seen.add(id)
+        return True
+
+
+# Miscellaneous utilities.
+# .............................................................................
+
+def _is_data_dir(directory):
+    '''Returns True if the directory looks like a Zotero data directory.'''
+    return (path.isfile(path.join(directory, 'zotero.sqlite'))
+            and path.isdir(path.join(directory, 'storage')))
+
+
+def _excluded(item, patterns):
+    '''Returns True if the name or path of "item" matches any of "patterns".'''
+    name = path.basename(path.normpath(item))
+    for pattern in patterns:
+        if fnmatch(name, pattern) or fnmatch(item, pattern):
+            if __debug__: log(f'excluding {antiformat(item)}')
+            return True
+    return False
+
+
+def _wanted(file, entry, extensions, cutoff, skip):
+    '''Returns True if the file passes all the tests.
+
+    If "entry" is not None, it's the os.DirEntry for the file, and the
+    result of its stat() method is used so that the file isn't stat'ed twice.
+    '''
+    ext = filename_extension(file)
+    if path.basename(file).startswith('.') or ext in _IGNORED_EXT:
+        if __debug__: log(f'ignoring ignorable file {antiformat(file)}')
+        return False
+    if extensions and ext not in extensions:
+        warn(f'Skipping file without desired extension: {antiformat(file)}')
+        return False
+    if skip and skip(file):
+        if __debug__: log(f'skipping {antiformat(file)}')
+        return False
+    if cutoff is not None:
+        stat = entry.stat() if entry else os.stat(file)
+        if stat.st_mtime < cutoff:
+            return False
+        if __debug__: log(f'keeping {antiformat(file)}')
+    return True
@@ -44,6 +44,10 @@ class ServiceFailure(ZowieException):
     '''Unrecoverable problem involving a remote service.'''
     pass
 
+class RequestFailure(ZowieException):
+    '''A network request failed even after being retried.'''
+    pass
+
 class AuthenticationFailure(ZowieException):
     '''Problem obtaining or using authentication credentials.'''
     pass
@@ -59,3 +63,7 @@ class NotFound(ZowieException):
 class FileError(ZowieException):
     '''Problem reading or writing a file or its attributes.'''
     pass
+
+class PdfFormatError(FileError):
+    '''The structure of a PDF file could not be understood.'''
+    pass
@@ -0,0 +1,119 @@
+'''
+file_context.py: metadata about a file, shared by the methods writing to it
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2020 by Michael Hucka and the California Institute of Technology.
+This code is open-source software released under a 3-clause BSD license.
+Please see the file "LICENSE" for more information.
+'''
+
+from   commonpy.string_utils import antiformat
+import os
+
+from .pdf import open_pdf
+
+if __debug__:
+    from sidetrack import log
+
+
+# Exported classes.
+# .............................................................................
+
+class FileContext():
+    '''Metadata of a file, read when first needed and then kept.
+
+    One FileContext is given to all the methods writing links into a file,
+    so that things they all need (e.g., the list of extended attributes) are
+    read from the file only once. The file is opened when first needed, and
+    kept open until close() is called or the context of a "with" statement
+    using the FileContext is left.
+
+    Methods that change the file must call forget() afterwards, so that what
+    changed is read again the next time it's needed.
+    '''
+
+    def __init__(self, file):
+        self.file = file
+        self._fd = None
+        self._pdf = None
+        self.forget()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+    def forget(self, contents = True):
+        '''Discards what has been read, after the file has been changed.
+
+        If "contents" is False, only the metadata of the file (e.g., extended
+        attributes) changed, and what was read from its contents is kept.
+        '''
+        self._stat = None
+        self._xattrs = None
+        self._xattr_values = {}
+        if contents:
+            self._pdf = None
+
+
+    @property
+    def fd(self):
+        '''A file descriptor of the file, opened for reading.'''
+        if self._fd is None:
+            if __debug__: log(f'opening {antiformat(self.file)}')
+            self._fd = os.open(self.file, os.O_RDONLY)
+        return self._fd
+
+
+    @property
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.fstat(self.fd)
+        return self._stat
+
+
+    @property
+    def xattrs(self):
+        '''The names of the extended attributes of the file, as bytes.'''
+        if self._xattrs is None:
+            # Imported here because not all methods need extended attributes.
+            from xattr import listxattr
+            self._xattrs = listxattr(self.fd)
+        return self._xattrs
+
+
+    def xattr(self, name):
+        '''Returns the value of extended attribute "name", or None.'''
+        if name not in self.xattrs:
+            return None
+        if name not in self._xattr_values:
+            from xattr import getxattr
+            self._xattr_values[name] = getxattr(self.fd, name)
+        return self._xattr_values[name]
+
+
+    @property
+    def pdf(self):
+        '''The result of pdf.open_pdf() on the file.'''
+        if self._pdf is None:
+            if __debug__: log(f'reading PDF file {antiformat(self.file)}')
+            self._pdf = open_pdf(self.file, self.fd)
+        return self._pdf
@@ -0,0 +1,237 @@
+'''
+governor.py: adaptive rate control for requests to the Zotero API
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2020 by Michael Hucka and the California Institute of Technology.
+This code is open-source software released under a 3-clause BSD license.
+Please see the file "LICENSE" for more information.
+'''
+
+import asyncio
+from   bun import warn
+from   commonpy.interrupt import raise_for_interrupts
+import random
+import threading
+import time
+
+from .exceptions import ServiceFailure
+
+if __debug__:
+    from sidetrack import log
+
+
+# Internal constants.
+# .............................................................................
+
+_MAX_ATTEMPTS = 6
+'''Number of times a request is attempted before giving up on it.'''
+
+_BASE_DELAY = 1.0
+'''Seconds to wait after the first failure; doubled after each failure.'''
+
+_MAX_DELAY = 60.0
+'''Maximum seconds to wait between attempts, unless the server asks for more.'''
+
+_BREAKER_THRESHOLD = 10
+'''Number of consecutive failures after which all requests are paused.'''
+
+_BREAKER_PAUSE = 120.0
+'''Seconds for which all requests are paused when the breaker trips.'''
+
+_BREAKER_MAX_TRIPS = 3
+'''Number of times the breaker can trip without a success in between.'''
+
+_CONGESTION_FACTOR = 3.0
+'''A response this many times slower than the average means congestion.'''
+
+_AVERAGE_WEIGHT = 0.1
+'''Weight of the newest response time in the moving average of response times.'''
+
+_DECREASE_FACTOR = 0.5
+'''Factor by which the concurrency limit is multiplied upon congestion.'''
+
+_WAIT_INTERVAL = 0.5
+'''Seconds between checks for interrupts while waiting to send a request.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class Governor():
+    '''Controls the rate and concurrency of requests to a Zotero API server.
+
+    All requests to a server are meant to go through the same Governor
+    object: callers call acquire() (or acquire_async()) before sending a
+    request and release() after getting a response or an error.
+
+    The governor does the following:
+      * honors the Backoff and Retry-After headers sent by the server by
+        pausing all requests for the time requested;
+      * after a 429 or 5xx response or a network error, waits exponentially
+        longer before the next attempt (see retry());
+      * adjusts the number of requests allowed in progress at once using
+        AIMD (additive increase, multiplicative decrease): the limit grows
+        by about 1 for every "limit" fast responses, and is halved when a
+        response is much slower than the moving average of response times
+        or fails, at most once for every "limit" responses;
+      * acts as a circuit breaker: after many consecutive failures, it
+        pauses all requests for a while, and gives up entirely if the
+        failures continue after several such pauses.
+    '''
+
+    def __init__(self, maximum = 1):
+        self._maximum = maximum
+        self._limit = float(maximum)
+        self._active = 0
+        self._resume_time = 0
+        self._failures = 0
+        self._trips = 0
+        # Exponential moving average of response times. Requests differ in
+        # cost (e.g., one item vs. 50 keys), so a moving average is used
+        # rather than the fastest time ever seen.
+        self._average = None
+        # Number of responses since the last decrease of the limit.
+        self._responses = maximum
+        self._condition = threading.Condition()
+
+
+    @property
+    def limit(self):
+        '''The current number of requests allowed to be in progress at once.'''
+        return max(1, int(self._limit))
+
+
+    def acquire(self):
+        '''Blocks until a request may be sent.'''
+        with self._condition:
+            while True:
+                raise_for_interrupts()
+                wait = self._wait_time()
+                if wait == 0:
+                    self._active += 1
+                    return
+                self._condition.wait(min(wait, _WAIT_INTERVAL))
+
+
+    async def acquire_async(self):
+        '''Waits, without blocking the event loop, until a request may be sent.'''
+        while True:
+            raise_for_interrupts()
+            with self._condition:
+                wait = self._wait_time()
+                if wait == 0:
+                    self._active += 1
+                    return
+            await asyncio.sleep(min(wait, _WAIT_INTERVAL))
+
+
+    def release(self, latency, status = None, headers = {}):
+        '''Records the outcome of a request that was allowed by acquire().
+
+        "latency" is the time in seconds the request took, "status" is the
+        HTTP status code of the response (None if there was no response) and
+        "headers" are the response headers.
+        '''
+        now = time.monotonic()
+        with self._condition:
+            self._active -= 1
+            self._responses += 1
+            pause = _seconds(headers.get('backoff') or headers.get('retry-after'))
+            if pause:
+                if __debug__: log(f'server asked to pause for {pause} s')
+                self._resume_time = max(self._resume_time, now + pause)
+            if status is None or status == 429 or status >= 500:
+                self._failed(now)
+            else:
+                self._succeeded(latency)
+            self._condition.notify_all()
+
+
+    def retry(self, attempt, status = None):
+        '''Returns True if a request should be tried again.
+
+        "attempt" is the number of attempts made so far and "status" is the
+        HTTP status of the last response (None if there was no response). The
+        delay before the next attempt is enforced by the next acquire().
+        '''
+        if status is not None and status != 429 and status < 500:
+            return False
+        if attempt >= _MAX_ATTEMPTS:
+            if __debug__: log(f'giving up after {attempt} attempts')
+            return False
+        return True
+
+
+    def _wait_time(self):
+        # Must be called with the lock held.
+        delay = self._resume_time - time.monotonic()
+        if delay > 0:
+            return delay
+        if self._active >= self.limit:
+            return _WAIT_INTERVAL
+        return 0
+
+
+    def _succeeded(self, latency):
+        # Must be called with the lock held.
+        self._failures = 0
+        self._trips = 0
+        average = self._average
+        if average is None:
+            self._average = latency
+        else:
+            self._average = average + _AVERAGE_WEIGHT * (latency - average)
+        if average is not None and latency > _CONGESTION_FACTOR * average:
+            self._decrease()
+        elif self._limit < self._maximum:
+            self._limit = min(self._maximum, self._limit + 1/self._limit)
+
+
+    def _failed(self, now):
+        # Must be called with the lock held.
+        self._failures += 1
+        self._decrease()
+        if self._failures >= _BREAKER_THRESHOLD:
+            self._trips += 1
+            if self._trips > _BREAKER_MAX_TRIPS:
+                raise ServiceFailure('The Zotero server keeps failing; giving up.')
+            warn(f'Zotero server requests keep failing; pausing for'
+                 f' {int(_BREAKER_PAUSE)} seconds.')
+            self._failures = 0
+            self._resume_time = max(self._resume_time, now + _BREAKER_PAUSE)
+        else:
+            # Exponential backoff with jitter, so that concurrent requests
+            # don't all retry at the same moment.
+            delay = min(_MAX_DELAY, _BASE_DELAY * 2 ** (self._failures - 1))
+            delay *= random.uniform(0.5, 1.0)
+            self._resume_time = max(self._resume_time, now + delay)
+        if __debug__: log(f'request failed; {self._failures} consecutive failures')
+
+
+    def _decrease(self):
+        # Must be called with the lock held. Requests sent before a decrease
+        # meet the same congestion, so their responses don't count for more.
+        if self._responses < self.limit:
+            return
+        self._responses = 0
+        self._limit = max(1.0, self._limit * _DECREASE_FACTOR)
+        if __debug__: log(f'concurrency limit decreased to {self.limit}')
+
+
+# Miscellaneous utilities.
+# .............................................................................
+
+def _seconds(value):
+    '''Returns the number of seconds in a Backoff or Retry-After value.'''
+    # Retry-After may also be an HTTP date, but the Zotero API doesn't use it.
+    try:
+        return float(value) if value else 0
+    except ValueError:
+        return 0
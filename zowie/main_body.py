@@ -14,22 +14,33 @@ This code is open-source software released under a 3-clause BSD license.
 Please see the file "LICENSE" for more information.
 '''
 
-from   AppKit import NSWorkspace
 from   bun import inform, warn, alert, alert_fatal
+from   collections import deque
 from   commonpy.data_utils import DATE_FORMAT, pluralized, parsed_datetime
-from   commonpy.file_utils import filename_extension, filename_basename
-from   commonpy.file_utils import files_in_directory
-from   commonpy.network_utils import net, network_available
+from   commonpy.file_utils import filename_extension
+from   commonpy.network_utils import network_available
 from   commonpy.string_utils import antiformat
-from   datetime import datetime
+from   concurrent.futures import ProcessPoolExecutor
+from   itertools import chain
+from   multiprocessing import get_context
+import os
 from   os import path
-from   pathlib import Path
 import sys
+from   threading import Event
+import time
 
+from .cache import ItemCache
+from .discovery import target_files, storage_folder
 from .exceptions import CannotProceed
 from .exit_codes import ExitCode
+from .file_context import FileContext
+from .manifest import Manifest
 from .methods import method_names, method_object
-from .zotero import Zotero
+from .methods.pdfbase import PDFMethod, write_pdf_links, write_pdf_file_links, show
+from .pipeline import Pipeline
+from .zotero import Zotero, LOCAL_API
+from .watcher import Watcher
+from .zotero_db import ZoteroDatabase
 
 if __debug__:
     from sidetrack import log
@@ -38,8 +49,8 @@ if __debug__:
 # Internal constants.
 # .............................................................................
 
-_IGNORED_EXT = ['.sqlite', '.sqlite-journal', '.bak', '.ico', '.json', '.csl',
-                '.pl', '.js', '.css', '.config_resp']
+_RETRY_DELAYS = [15, 60, 300, 900]
+'''Seconds to wait before each new attempt to look up a file in watch mode.'''
 
 
 # Exported classes.
@@ -60,6 +71,15 @@ class MainBody():
         # if the thread finished normally or with an exception.
         self.exception = None
 
+        # The persistent cache of Zotero data is only opened if it's used.
+        self._cache = None
+        self._zotero = None
+        self._manifest = None
+        self._pool = None
+
+        # Set by stop() to tell the watch mode loop to end.
+        self._stopped = Event()
+
         # Create and initialize objects for the URI writers we will use.
         self._writers = []
         for method_name in self.methods:
@@ -75,22 +95,38 @@ class MainBody():
         try:
             self._do_preflight()
             self._do_main_work()
+            self._record_run()
         except Exception as ex:
             if __debug__: log(f'exception in main body: {str(ex)}')
             self.exception = sys.exc_info()
+        finally:
+            if self._zotero:
+                self._zotero.close()
+            if self._cache:
+                self._cache.close()
+            if self._manifest:
+                self._manifest.close()
+            if self._pool:
+                self._pool.shutdown()
         if __debug__: log('finished MainBody')
 
 
     def stop(self):
         '''Stop the main body.'''
         if __debug__: log('stopping ...')
-        pass
+        self._stopped.set()
 
 
     def _do_preflight(self):
         '''Check the option values given by the user, and do other prep.'''
 
-        if not network_available():
+        # Files changed after this will be picked up by a later run.
+        self._start_time = time.time()
+
+        # The local Zotero database and the local API of the Zotero desktop
+        # application are alternatives to the network API.
+        offline = bool(self.zotero_db) or self.local_api
+        if not offline and not network_available():
             alert_fatal('No network connection.')
             raise CannotProceed(ExitCode.no_network)
 
@@ -105,10 +141,17 @@ class MainBody():
             bad = next(item for item in self.files if item.startswith('-'))
             alert_fatal(f'Unrecognized option "{bad}" in arguments. {hint}')
             raise CannotProceed(ExitCode.bad_arg)
-        if not self.use_keyring and not any([self.api_key, self.user_id]):
+        if not offline and not self.use_keyring and not any([self.api_key, self.user_id]):
             alert_fatal(f"Need Zotero credentials if not using keyring. {hint}")
             raise CannotProceed(ExitCode.bad_arg)
 
+        if self.after_date and self.since_last_run:
+            alert_fatal(f'Options -d and -S cannot be used together. {hint}')
+            raise CannotProceed(ExitCode.bad_arg)
+        if self.changed and (self.after_date or self.since_last_run or self.watch):
+            alert_fatal(f'Option -c cannot be used with -d, -S or -W. {hint}')
+            raise CannotProceed(ExitCode.bad_arg)
+
         if self.after_date:
             try:
                 # Convert user's input into a canonical format.
@@ -122,57 +165,132 @@ class MainBody():
                 alert_fatal(f'Unable to parse after_date: "{str(ex)}". {hint}')
                 raise CannotProceed(ExitCode.bad_arg)
 
+        if self.jobs is not None:
+            if not str(self.jobs).isdigit() or int(self.jobs) < 1:
+                alert_fatal(f'The number of jobs must be a positive integer. {hint}')
+                raise CannotProceed(ExitCode.bad_arg)
+            self.jobs = int(self.jobs)
+
+        if self.watch or self.changed:
+            if len(self.files) != 1 or not storage_folder(self.files[0]):
+                option = '-W' if self.watch else '-c'
+                alert_fatal(f'Option {option} needs one Zotero data folder or'
+                            + f' Zotero storage folder as argument. {hint}')
+                raise CannotProceed(ExitCode.bad_arg)
+            self._storage = storage_folder(self.files[0])
+
+        if self.walkers is not None:
+            if not str(self.walkers).isdigit() or int(self.walkers) < 1:
+                alert_fatal(f'The number of walkers must be a positive integer. {hint}')
+                raise CannotProceed(ExitCode.bad_arg)
+            self.walkers = int(self.walkers)
+
+        if self.processes is not None:
+            if not str(self.processes).isdigit() or int(self.processes) < 1:
+                alert_fatal(f'The number of processes must be a positive integer. {hint}')
+                raise CannotProceed(ExitCode.bad_arg)
+            self.processes = int(self.processes)
+            if self.processes > 1 and any(isinstance(m, PDFMethod) for m in self._writers):
+                if __debug__: log(f'using {self.processes} processes for PDF files')
+                # The processes are started while other threads are running,
+                # which forking doesn't handle safely, so they're spawned.
+                self._pool = ProcessPoolExecutor(max_workers = self.processes,
+                                                 mp_context = get_context('spawn'))
+
+        if self.exclude:
+            self.exclude = self.exclude.split(',')
+
         if self.file_ext:
             self.file_ext = self.file_ext.lower().split(',')
             self.file_ext = ['.' + e for e in self.file_ext if not e.startswith('.')]
 
         # Set up Zotero connection and gather files for work ~~~~~~~~~~~~~~~~~~
 
-        inform('Connecting to Zotero network servers ...')
-        self._zotero = Zotero(self.api_key, self.user_id, self.use_keyring)
+        if self.zotero_db:
+            inform(f'Reading Zotero database {antiformat(self.zotero_db)} ...')
+            self._zotero = ZoteroDatabase(self.zotero_db)
+            self._source = 'database'
+        else:
+            if self.local_api:
+                inform('Connecting to the Zotero desktop application ...')
+                (endpoint, self._cache) = (LOCAL_API, None)
+                self._source = 'local'
+            else:
+                inform('Connecting to Zotero network servers ...')
+                endpoint = None
+                self._source = 'web'
+                if self.use_cache:
+                    self._cache = ItemCache()
+            if self.use_async:
+                from .zotero_async import AsyncZotero
+                self._zotero = AsyncZotero(self.api_key, self.user_id,
+                                           self.use_keyring, cache = self._cache,
+                                           endpoint = endpoint, limit = self.jobs)
+            else:
+                self._zotero = Zotero(self.api_key, self.user_id, self.use_keyring,
+                                      cache = self._cache, endpoint = endpoint,
+                                      jobs = self.jobs or 1)
+        # The manifest records what was written in past runs, so that files
+        # that haven't changed since then can be skipped without reading them.
+        self._manifest = Manifest()
+
+        if self.prefetch:
+            inform('Reading all attachment records from Zotero ...')
+            self._zotero.prefetch()
+
+        if self.watch:
+            # Only files that appear from now on are of interest.
+            return
+
+        if self.changed:
+            self._targets = self._changed_files()
+            return
 
         if len(self.files) > 1 or path.isdir(self.files[0]):
             inform('Examining folders and looking for files ...')
-        # 2 passes: traverse subdirectories recursively, then filter results.
-        candidates = []
-        for item in self.files:
-            if path.isfile(item):
-                candidates.append(item)
-            elif path.isdir(item):
-                if __debug__: log(f'adding files in subdir {antiformat(item)}')
-                candidates += files_in_directory(item)
-            else:
-                warn(f'Not a file nor a folder of files: "{antiformat(item)}"')
-        if __debug__: log('gathering list of files ...')
-        self._targets = []
-        for file in candidates:
-            ext = filename_extension(file)
-            if path.basename(file).startswith('.') or ext in _IGNORED_EXT:
-                if __debug__: log(f'ignoring ignorable file {antiformat(file)}')
-                continue
-            if self.file_ext and ext not in self.file_ext:
-                warn(f'Skipping file without desired extension: {antiformat(file)}')
-                continue
-            if file_is_alias(file):
-                if __debug__: log(f'ignoring macOS alias {antiformat(file)}')
-                continue
-            self._targets.append(file)
-        if __debug__: log(f'gathered {pluralized("file", self._targets, True)}')
-
-        if self.after_date:
-            if __debug__: log(f'filtering files by date {self.after_date_str}')
-            kept = []
-            tzinfo = self.after_date.tzinfo
-            for file in self._targets:
-                mtime = datetime.fromtimestamp(Path(file).stat().st_mtime)
-                if mtime.replace(tzinfo = tzinfo) >= self.after_date:
-                    if __debug__: log(f'keeping {file}')
-                    kept.append(file)
-            self._targets = kept
-
-        if not self._targets:
+        # Files are found as they're needed by the lookup and writing stages,
+        # so that work starts right away even on large trees. Check that there
+        # is at least one file by getting the first one now.
+        since = None
+        if self.since_last_run:
+            since = {item: self._manifest.last_run(item) for item in self.files}
+            for item in [item for (item, time) in since.items() if not time]:
+                inform(f'No record of a previous run on {antiformat(item)};'
+                       + ' all files in it will be examined.')
+        targets = target_files(self.files, extensions = self.file_ext,
+                               after_date = self.after_date,
+                               skip = file_is_alias, exclude = self.exclude,
+                               threads = self.walkers or 1, since = since)
+        first = next(targets, None)
+        if first is None and self.since_last_run:
+            # The usual case for a scheduled run on a quiet day.
+            inform('No files are new since the last run.')
+            self._targets = iter([])
+            return
+        if first is None:
             alert_fatal('No files to process; quitting.')
             raise CannotProceed(ExitCode.bad_arg)
+        self._targets = chain([first], targets)
+
+
+    def _changed_files(self):
+        '''Returns an iterator over the files of the attachments that changed.'''
+        versions = self._manifest.library_versions(self._storage, self._source)
+        if versions:
+            inform('Asking Zotero for the attachments changed since the last run ...')
+        else:
+            inform('No record of a previous run with -c on this folder;'
+                   + ' all attachments will be examined.')
+        (keys, self._versions) = self._zotero.changed_attachments(versions)
+        # Attachments that are links to files elsewhere, and files that Zotero
+        # hasn't downloaded, have no folder in the storage folder.
+        folders = [path.join(self._storage, key) for key in sorted(set(keys))]
+        folders = [folder for folder in folders if path.isdir(folder)]
+        inform(f'{pluralized("changed attachment", keys, True)} found,'
+               + f' {len(folders)} with files in the storage folder.')
+        return target_files(folders, extensions = self.file_ext,
+                            skip = file_is_alias, exclude = self.exclude,
+                            threads = self.walkers or 1)
 
 
     def _do_main_work(self):
@@ -180,43 +298,265 @@ class MainBody():
             warn('Overwrite mode in effect.')
         if self.dry_run:
             warn('Running in dry run mode – will not modify files.')
-        inform(f'Will process {pluralized("file", self._targets, True)}'
-               + f' using {pluralized("method", self.methods)}'
+        inform(f'Processing files using {pluralized("method", self.methods)}'
                + f' [cyan2]{", ".join(self.methods)}[/].')
-        if len(self._targets) > 10000:
-            inform("(That's a huge number of files – this will take a long time.)")
-        elif len(self._targets) > 1000:
-            inform("(That's a lot of files – this will take some time.)")
-
-        for file in self._targets:
-            (record, failure) = self._zotero.record_for_file(file)
-            if failure:
+
+        self._skipped = 0
+        if self.watch:
+            self._do_watch()
+            return
+        def failed(file, failure):
+            warn(failure)
+        count = self._process(self._targets, failed)
+        inform(f'Processed {pluralized("file", count, True)}.')
+        if self._skipped:
+            inform(f'({pluralized("file", self._skipped, True)} had not changed'
+                   + ' since links were written in a previous run.)')
+
+
+    def _do_watch(self):
+        '''Process new files in the storage folder as they appear.
+
+        The resolver, its network connections, and the writers stay in use
+        across batches of new files. A new attachment can show up in the
+        storage folder before Zotero has synced it to the servers, or before
+        its parent record has been made, so files that can't be looked up
+        are tried again a few times, with increasing delays, before giving up.
+        '''
+        inform(f'Watching {antiformat(self._storage)} for new files;'
+               + ' press ^C to stop.')
+        watcher = Watcher(self._storage)
+        attempts = {}
+        retrying = set()
+        def failed(file, failure):
+            attempts[file] = attempts.get(file, 0) + 1
+            if attempts[file] > len(_RETRY_DELAYS):
+                del attempts[file]
                 warn(failure)
-                continue
-            ext = filename_extension(file)
-            for method in self._writers:
-                if method.file_extension() and ext != method.file_extension():
-                    f = antiformat(f'[steel_blue3]{file}[/]')
-                    warn(f"Method [cyan2]{method.name()}[/] can't be used on {f}")
-                else:
-                    method.write_link(file, record.link)
+                return
+            delay = _RETRY_DELAYS[attempts[file] - 1]
+            if __debug__: log(f'will try {antiformat(file)} again in {delay} s')
+            watcher.requeue(file, delay)
+            retrying.add(file)
+
+        try:
+            for batch in watcher.batches(self._stopped):
+                targets = list(target_files(batch, extensions = self.file_ext,
+                                            skip = file_is_alias,
+                                            exclude = self.exclude))
+                if not targets:
+                    continue
+                # Items may have been added to Zotero since the last batch.
+                self._zotero.refresh()
+                count = self._process(targets, failed)
+                for file in targets:
+                    if file not in retrying:
+                        attempts.pop(file, None)
+                retrying.clear()
+                inform(f'Processed {pluralized("new file", count, True)}.')
+        finally:
+            watcher.close()
+
+
+    def _process(self, files, failed):
+        '''Look up the files and write links into them.
+
+        Files that can't be looked up are passed to the function "failed",
+        together with the message explaining why. Returns the number of files.
+
+        Finding files, looking them up, and writing links are done in stages
+        that run at the same time, connected by bounded queues: while the
+        links of some files are being written (in this thread), the next
+        files are being looked up, and files after those are being found.
+
+        If there is a process pool, the PDF methods are run on each file in
+        the pool as soon as the file has been looked up. The rest of the work
+        on the files, including printing messages, is done in this thread in
+        the order of the files, when the work in the pool has finished.
+        '''
+        count = 0
+        pending = deque()
+        limit = 4 * self.processes if self._pool else 0
+        with Pipeline(self._stopped) as pipeline:
+            found = pipeline.pipe()
+            results = pipeline.pipe()
+            pipeline.start(self._find, files, output = found)
+            pipeline.start(self._look_up, found, output = results)
+            try:
+                for (file, record, failure) in results:
+                    count += 1
+                    if failure:
+                        pending.append((file, None, failure, None))
+                    else:
+                        pending.append((file, record, None,
+                                        self._start_pdf_work(file, record)))
+                    while pending and (len(pending) > limit or _finished(pending[0])):
+                        self._finish(pending.popleft(), failed)
+                while pending:
+                    self._finish(pending.popleft(), failed)
+            finally:
+                # If something failed, work not started in the pool is dropped.
+                for (_, _, _, pdf_work) in pending:
+                    if pdf_work:
+                        pdf_work[1].cancel()
+        return count
+
+
+    def _start_pdf_work(self, file, record):
+        '''Starts running the PDF methods on "file" in the process pool.
+
+        Returns None if there's no pool or nothing to do, and otherwise a
+        tuple (stat, future), where "stat" is the result of os.stat() on
+        the file before any changes.
+        '''
+        if not self._pool:
+            return None
+        stat = os.stat(file)
+        methods = self._pdf_methods(file, stat, record.link)
+        if not methods:
+            return None
+        future = self._pool.submit(write_pdf_file_links, file, record.link,
+                                   methods, self.dry_run)
+        return (stat, future)
+
+
+    def _finish(self, entry, failed):
+        (file, record, failure, pdf_work) = entry
+        if failure:
+            failed(file, failure)
+        elif pdf_work:
+            (stat, future) = pdf_work
+            self._write_links(file, record, stat, future.result())
+        else:
+            self._write_links(file, record)
+
+
+    def _find(self, files, output):
+        for file in files:
+            output.put(file)
+
+
+    def _look_up(self, files, output):
+        # Several files can share one storage folder (e.g., a PDF and a web
+        # snapshot), and thus one item key. The resolver looks up each key
+        # only once, and produces the result (or the failure) for each file.
+        for result in self._zotero.records(files):
+            output.put(result)
+
+
+    def _record_run(self):
+        '''Record the start of this run as the time of the last complete run.'''
+        if self.dry_run or self.watch or self._stopped.is_set():
+            return
+        if self._zotero.request_failures:
+            # Some files could not be looked up, and they may not have been
+            # changed by the time of the next run. Don't let it skip them.
+            if __debug__: log('not recording run time due to request failures')
+            return
+        for item in self.files:
+            self._manifest.set_last_run(item, self._start_time)
+        if self.changed:
+            self._manifest.set_library_versions(self._storage, self._source,
+                                                self._versions)
+
+
+    def _write_links(self, file, record, stat = None, pdf_results = None):
+        '''Runs the writer methods on "file" and records what they did.
+
+        If the PDF methods have been run on the file in the process pool,
+        "stat" is the result of os.stat() on the file from before, and
+        "pdf_results" is what write_pdf_file_links() returned.
+        '''
+        # The methods share what they read from the file through the context.
+        with FileContext(file) as context:
+            self._write_links_with(context, record, stat, pdf_results)
+
+
+    def _write_links_with(self, context, record, stat, pdf_results):
+        file = context.file
+        ext = filename_extension(file)
+        stat = stat or context.stat
+        # The PDF methods are run together, so that their changes are written
+        # in one update. Their messages are printed below in the usual order.
+        pdf_methods = self._pdf_methods(file, stat, record.link)
+        if pdf_results is None and pdf_methods:
+            pdf_results = write_pdf_links(context, record.link, pdf_methods,
+                                          self.dry_run)
+        pdf_results = {m.name(): result for (m, result) in zip(pdf_methods, pdf_results or [])}
+        # Names of methods for which the file has the link, and whether any
+        # method may have changed the file.
+        done = []
+        touched = False
+        for method in self._writers:
+            if method.file_extension() and ext != method.file_extension():
+                f = antiformat(f'[steel_blue3]{file}[/]')
+                warn(f"Method [cyan2]{method.name()}[/] can't be used on {f}")
+            elif self._done_before(method, file, stat, record.link):
+                if __debug__: log(f'{method.name()} done before on {antiformat(file)}')
+                done.append(method.name())
+            elif isinstance(method, PDFMethod):
+                touched = True
+                (has_link, notice) = pdf_results[method.name()]
+                show(notice)
+                if has_link:
+                    done.append(method.name())
+            else:
+                touched = True
+                if method.write_link(file, record.link, context):
+                    done.append(method.name())
+        if not touched:
+            if done:
+                self._skipped += 1
+            return
+        if not self.dry_run and done:
+            # Writing changes the size and modification time of some files, so
+            # the manifest entries of all methods are updated to the final state.
+            stat = context.stat
+            for name in done:
+                self._manifest.add_link(file, stat, name, record.link)
+
+
+    def _done_before(self, method, file, stat, link):
+        '''Returns True if the manifest shows "method" was done on "file".'''
+        return (not self.reverify and not self.overwrite
+                and self._manifest.has_link(file, stat, method.name(), link))
+
+
+    def _pdf_methods(self, file, stat, link):
+        '''Returns the PDF methods that need to be run on "file".'''
+        ext = filename_extension(file)
+        return [method for method in self._writers
+                if isinstance(method, PDFMethod) and ext == method.file_extension()
+                and not self._done_before(method, file, stat, link)]
+
 
-
 # Misc. utilities
 # .............................................................................
 
-_WORKSPACE = NSWorkspace.sharedWorkspace()
+_WORKSPACE = None
 
 # The code below is based in part on code posted by user "kuzzoooroo" on
 # 2014-01-23 to Stack Overflow at https://stackoverflow.com/a/21245832/743730
 
 def file_is_alias(item):
     '''Returns True if the given "item" is a macOS Alias file.'''
+    global _WORKSPACE
     # mac alias files test positive as files but negative as links.
     if path.islink(item) or not path.isfile(item):
         return False
+    if _WORKSPACE is None:
+        # AppKit is imported when first needed, so that the rest of this
+        # module can be loaded (e.g., by tests) where AppKit is not available.
+        from AppKit import NSWorkspace
+        _WORKSPACE = NSWorkspace.sharedWorkspace()
     uti, err = _WORKSPACE.typeOfFile_error_(path.realpath(item), None)
     if err:
         return False
     else:
         return uti == "com.apple.alias-file"
+
+
+def _finished(entry):
+    '''Returns True if the work on the file in "entry" in the pool is done.'''
+    pdf_work = entry[3]
+    return pdf_work is None or pdf_work[1].done()
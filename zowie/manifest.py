@@ -0,0 +1,152 @@
+'''
+manifest.py: record of the links that Zowie has written into files
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2020 by Michael Hucka and the California Institute of Technology.
+This code is open-source software released under a 3-clause BSD license.
+Please see the file "LICENSE" for more information.
+'''
+
+import os
+from   os import path
+import sqlite3
+from   threading import Lock
+
+from .cache import cache_dir
+
+if __debug__:
+    from sidetrack import log
+
+
+# Internal constants.
+# .............................................................................
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path      TEXT NOT NULL,
+    method    TEXT NOT NULL,
+    inode     INTEGER NOT NULL,
+    size      INTEGER NOT NULL,
+    mtime     INTEGER NOT NULL,
+    link      TEXT NOT NULL,
+    PRIMARY KEY (path, method)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    root      TEXT PRIMARY KEY,
+    time      REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS versions (
+    root      TEXT NOT NULL,
+    source    TEXT NOT NULL,
+    libtype   TEXT NOT NULL,
+    libid     TEXT NOT NULL,
+    version   INTEGER NOT NULL,
+    PRIMARY KEY (root, source, libtype, libid)
+);
+'''
+
+_COMMIT_INTERVAL = 500
+'''Number of changes after which they're committed to the database file.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class Manifest():
+    '''Persistent record of the links written into files by each method.
+
+    For every file and method, the manifest stores the link that the method
+    last put into the file, together with the inode number, size and
+    modification time (in ns) of the file right after that. If the file
+    still has the same inode, size and modification time, the link is
+    assumed to be still there, so the file doesn't need to be read again.
+
+    The manifest also records, for each file or folder that Zowie was run
+    on, the time at which the last complete run on it started, and the
+    versions of the Zotero libraries that the run brought it up to date with.
+    Versions are kept separately for each source of Zotero data (e.g., the
+    Zotero servers or the Zotero database file), because they're not
+    comparable with each other.
+    '''
+
+    def __init__(self, file = None):
+        if not file:
+            file = path.join(cache_dir(), 'manifest.sqlite')
+        os.makedirs(path.dirname(file), exist_ok = True)
+        if __debug__: log(f'opening manifest {file}')
+        self._db = sqlite3.connect(file, check_same_thread = False)
+        self._db.executescript(_SCHEMA)
+        self._lock = Lock()
+        self._changes = 0
+
+
+    def has_link(self, file, stat, method, link):
+        '''Returns True if "method" wrote "link" into the unchanged "file".
+
+        The value of "stat" is the result of os.stat() on the file.
+        '''
+        with self._lock:
+            cursor = self._db.execute('SELECT inode, size, mtime, link FROM files'
+                                      ' WHERE path = ? AND method = ?',
+                                      (file, method))
+            row = cursor.fetchone()
+        return row == (stat.st_ino, stat.st_size, stat.st_mtime_ns, link)
+
+
+    def add_link(self, file, stat, method, link):
+        '''Records that "method" left "link" in "file", whose stat is "stat".'''
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?)',
+                             (file, method, stat.st_ino, stat.st_size,
+                              stat.st_mtime_ns, link))
+            self._changes += 1
+            if self._changes >= _COMMIT_INTERVAL:
+                self._db.commit()
+                self._changes = 0
+
+
+    def last_run(self, root):
+        '''Returns the start time of the last complete run on "root", or None.'''
+        with self._lock:
+            cursor = self._db.execute('SELECT time FROM runs WHERE root = ?',
+                                      (path.realpath(root),))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+
+    def set_last_run(self, root, time):
+        '''Records "time" as the start time of the last complete run on "root".'''
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO runs VALUES (?,?)',
+                             (path.realpath(root), time))
+
+
+    def library_versions(self, root, source):
+        '''Returns a dict mapping (library type, library id) to versions.'''
+        with self._lock:
+            cursor = self._db.execute('SELECT libtype, libid, version FROM versions'
+                                      ' WHERE root = ? AND source = ?',
+                                      (path.realpath(root), source))
+            rows = cursor.fetchall()
+        return {(libtype, libid): version for (libtype, libid, version) in rows}
+
+
+    def set_library_versions(self, root, source, versions):
+        '''Records the library versions that "root" is up to date with.'''
+        root = path.realpath(root)
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO versions VALUES (?,?,?,?,?)',
+                                 [(root, source, libtype, libid, int(version))
+                                  for ((libtype, libid), version) in versions.items()])
+
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
@@ -106,6 +106,15 @@ class WriterMethod(ABC):
 
 
     @abstractmethod
-    def write_link(self, file, uri):
-        '''Write the link into the file.'''
+    def write_link(self, file, uri, context = None):
+        '''Write the link into the file.
+
+        The value of "context" is a FileContext for the file, shared by all
+        the methods writing into it. If it's None, the method makes its own.
+
+        Returns True if the file has the link when this is done, either
+        because it was written or because it was already there, and False
+        if it doesn't (e.g., because of dry-run mode or existing content
+        that was not overwritten).
+        '''
         pass
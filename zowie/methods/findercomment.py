@@ -92,7 +92,7 @@ class FinderComment(WriterMethod):
         return None
 
 
-    def write_link(self, file_path, uri):
+    def write_link(self, file_path, uri, context = None):
         '''Writes the "uri" into the Finder comments of file "file_path".
 
         If there's an existing comment, read it.  If there's a Zotero select
@@ -110,14 +110,14 @@ class FinderComment(WriterMethod):
             comments = _FINDER_SCRIPTS.call('get_comments', file_path)
             if comments and uri in comments:
                 inform(f'Zotero link already present in Finder comments of {file}')
-                return
+                return True
             elif comments and 'zotero://select' in comments:
                 inform(f'Replacing existing Zotero link in Finder comments of {file}')
                 if __debug__: log(f'overwriting existing Zotero link with {uri}')
                 comments = re.sub(r'(zotero://\S+)', uri, comments)
             elif comments:
                 warn(f'Not overwriting existing Finder comments of {file}')
-                return
+                return False
             else:
                 inform(f'Writing Zotero link into empty Finder comments of {file}')
                 comments = uri
@@ -133,3 +133,4 @@ class FinderComment(WriterMethod):
             _FINDER_SCRIPTS.call('clear_comments', file_path)
             if __debug__: log(f'invoking AS function to set comment on {fp}')
             _FINDER_SCRIPTS.call('set_comments', file_path, comments)
+        return not self.dry_run
@@ -0,0 +1,134 @@
+'''
+pdfbase.py: base class for methods that write links into PDF Info fields
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2020 by Michael Hucka and the California Institute of Technology.
+This code is open-source software released under a 3-clause BSD license.
+Please see the file "LICENSE" for more information.
+'''
+
+from   bun import inform, warn
+from   commonpy.string_utils import antiformat
+import re
+
+from .base import WriterMethod
+from ..file_context import FileContext
+
+if __debug__:
+    from sidetrack import log
+
+
+# Class definitions.
+# .............................................................................
+
+class PDFMethod(WriterMethod):
+    '''Base class for methods that write the link into a field of the PDF
+    document information dictionary.
+
+    Subclasses set "field" to the name of the field (e.g., "Subject"). When
+    several of these methods are used on the same file, the caller can run
+    them all using write_pdf_links(), which writes their changes in one
+    update.
+    '''
+
+    field = None
+
+
+    @classmethod
+    def file_extension(cls):
+        return '.pdf'
+
+
+    def write_link(self, file_path, uri, context = None):
+        '''Write the "uri" into the Info field of PDF file "file_path".'''
+
+        if context is None:
+            with FileContext(file_path) as context:
+                return self.write_link(file_path, uri, context)
+        (done, notice) = write_pdf_links(context, uri, [self], self.dry_run)[0]
+        show(notice)
+        return done
+
+
+    def info_change(self, context, uri):
+        '''Returns the Info changes needed to put "uri" in the field.
+
+        "context" is the FileContext of the PDF file. The value is a tuple
+        (changes, notice). The first element is a dict mapping the field name
+        to its new value, or an empty dict if the field already has the link,
+        or None if the field has other content that is not to be overwritten.
+        The second element is the message for the user, to be given to
+        show(). Nothing is written to the file and nothing is printed.
+        '''
+        fp = antiformat(context.file)
+        file = antiformat(f'[steel_blue3]{context.file}[/]')
+        field = self.field
+        if self.overwrite:
+            return ({field: uri}, ('inform', f'Overwriting PDF "{field}" field of {file}'))
+
+        value = context.pdf.info_text(field) or ''
+        if __debug__: log(f'found PDF {field} value {value} on {fp}')
+        if uri in value:
+            text = f'Zotero link already present in PDF "{field}" field of {file}'
+            return ({}, ('inform', text))
+        elif value.startswith('zotero://select'):
+            text = f'Replacing existing Zotero link in PDF "{field}" field of {file}'
+            return ({field: re.sub(r'(zotero://\S+)', uri, value)}, ('inform', text))
+        elif value:
+            return (None, ('warn', f'Not overwriting existing PDF "{field}" value in {file}'))
+        else:
+            if __debug__: log(f'no prior PDF {field} field found on {fp}')
+            text = f'Writing Zotero link into PDF "{field}" field of {file}'
+            return ({field: uri}, ('inform', text))
+
+
+# Exported functions.
+# .............................................................................
+
+def write_pdf_links(context, uri, methods, dry_run):
+    '''Runs the PDFMethods "methods" on the file of FileContext "context".
+
+    The changes of all the methods are appended to the file in one update,
+    unless "dry_run" is True. Returns a list of tuples (done, notice), one
+    for each method, in which "done" is True if the file has the link for
+    that method afterward, and "notice" is the message for the user, to be
+    given to show(). Nothing is printed, so that this can be run in another
+    process and the messages shown in the right order by the caller.
+    '''
+    results = []
+    all_changes = {}
+    for method in methods:
+        (changes, notice) = method.info_change(context, uri)
+        if changes is not None:
+            all_changes.update(changes)
+        results.append((changes is not None and not (changes and dry_run), notice))
+    if all_changes and not dry_run:
+        if __debug__: log(f'updating PDF file {antiformat(context.file)}')
+        context.pdf.update_info(all_changes)
+        context.forget()
+    return results
+
+
+def write_pdf_file_links(file, uri, methods, dry_run):
+    '''Like write_pdf_links(), but given a file name instead of a context.
+
+    This is meant for running in a worker process of a process pool.
+    '''
+    with FileContext(file) as context:
+        return write_pdf_links(context, uri, methods, dry_run)
+
+
+def show(notice):
+    '''Prints a message returned by write_pdf_links() or info_change().'''
+    (level, text) = notice
+    if level == 'warn':
+        warn(text)
+    else:
+        inform(text)
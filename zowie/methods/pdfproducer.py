@@ -14,23 +14,18 @@ This code is open-source software released under a 3-clause BSD license.
 Please see the file "LICENSE" for more information.
 '''
 
-from   bun import inform, warn
-from   commonpy.string_utils import antiformat
-from   pdfrw import PdfReader, PdfWriter
-import re
-
-from .base import WriterMethod
-
-if __debug__:
-    from sidetrack import log
+from .pdfbase import PDFMethod
 
 
 # Class definitions.
 # .............................................................................
 
-class PDFProducer(WriterMethod):
+class PDFProducer(PDFMethod):
     '''Implements writing Zotero links into the PDF file's Producer property.'''
 
+    field = 'Producer'
+
+
     @classmethod
     def name(cls):
         return 'pdfproducer'
@@ -53,41 +48,3 @@ class PDFProducer(WriterMethod):
                 + ' However, note that some users (archivists, forensics'
                 + ' investigators, possibly others) do use the "Producer" field,'
                 + ' and overwriting it may be undesirable.')
-
-
-    @classmethod
-    def file_extension(cls):
-        return '.pdf'
-
-
-    def write_link(self, file_path, uri):
-        '''Write the "uri" into the Producer attribute of PDF file "file_path".'''
-
-        fp = antiformat(file_path)
-        if __debug__: log(f'reading PDF file {fp}')
-        trailer = PdfReader(file_path)
-        file = antiformat(f'[steel_blue3]{file_path}[/]')
-        if not self.overwrite:
-            producer = trailer.Info.Producer or ''
-            if __debug__: log(f'found PDF Producer value {producer} on {fp}')
-            if uri in producer:
-                inform(f'Zotero link already present in PDF "Producer" field of {file}')
-                return
-            elif producer.startswith('zotero://select'):
-                inform(f'Replacing existing Zotero link in PDF "Producer" field of {file}')
-                producer = re.sub(r'(zotero://\S+)', uri, producer)
-                trailer.Info.Producer = producer
-            elif producer is not None:
-                warn(f'Not overwriting existing PDF "Producer" value in {file}')
-                return
-            else:
-                if __debug__: log(f'no prior PDF Producer field found on {fp}')
-                inform(f'Writing Zotero link into PDF "Producer" field of {file}')
-                trailer.Info.Producer = uri
-        else:
-            inform(f'Overwriting PDF "Producer" field of {file}')
-            trailer.Info.Producer = uri
-
-        if not self.dry_run:
-            if __debug__: log(f'writing PDF file with new "Producer" field: {fp}')
-            PdfWriter(file_path, trailer = trailer).write()
@@ -19,10 +19,11 @@ import biplist
 from   bun import inform, warn
 from   commonpy.string_utils import antiformat
 import re
-from   xattr import getxattr, setxattr, listxattr
+from   xattr import setxattr
 
 from .base import WriterMethod
 from ..exceptions import FileError
+from ..file_context import FileContext
 
 if __debug__:
     from sidetrack import log
@@ -68,14 +69,18 @@ class WhereFrom(WriterMethod):
         return None
 
 
-    def write_link(self, file_path, uri):
+    def write_link(self, file_path, uri, context = None):
         '''Write the "uri" into the "Where From" metadata attribute of "file_path".'''
 
+        if context is None:
+            with FileContext(file_path) as context:
+                return self.write_link(file_path, uri, context)
+
         # file pathname string may contain '{' and '}', so guard against it.
         fp = antiformat(file_path)
         file = antiformat(f'[steel_blue3]{file_path}[/]')
         if not self.overwrite:
-            (wherefroms, malformed) = self._wherefroms(file_path)
+            (wherefroms, malformed) = self._wherefroms(context)
             if wherefroms:
                 if wherefroms[0] == uri:
                     inform(f'Zotero link already present in "Where from" of {file}')
@@ -84,7 +89,7 @@ class WhereFrom(WriterMethod):
                     # version of Zowie or manual experiments by the user). We
                     # should proceed to correct it even if -o is not in effect.
                     if not malformed:
-                        return
+                        return True
                 elif type(wherefroms[0]) is str and wherefroms[0].startswith('zotero://'):
                     inform(f'Updating existing Zotero link in "Where from" of {file}')
                     wherefroms[0] = uri
@@ -99,16 +104,19 @@ class WhereFrom(WriterMethod):
             inform(f'Overwriting "Where From" metadata with Zotero link in {file}')
             wherefroms = [uri]
 
-        self._write_wherefroms(file_path, wherefroms)
+        if not self.dry_run:
+            self._write_wherefroms(file_path, wherefroms)
+            context.forget(contents = False)
+        return not self.dry_run
 
 
-    def _wherefroms(self, file_path):
+    def _wherefroms(self, context):
         '''Returns a tuple (wherefroms, malformed), where the second element
         indicates where the content was malformed in some way.'''
 
-        fp = antiformat(file_path)
-        if b'com.apple.metadata:kMDItemWhereFroms' in listxattr(file_path):
-            wherefroms = getxattr(file_path, b'com.apple.metadata:kMDItemWhereFroms')
+        fp = antiformat(context.file)
+        wherefroms = context.xattr(b'com.apple.metadata:kMDItemWhereFroms')
+        if wherefroms is not None:
             if not wherefroms.startswith(b'bplist'):
                 # There's content, but it's not a list. We don't know how to
                 # parse it and can't anticipate every possible variation, but
@@ -0,0 +1,651 @@
+'''
+pdf.py: read and update the document information of PDF files
+
+Zowie only needs the document information dictionary (the "Info" entry of
+the trailer) of PDF files, and only changes a field or two in it. Rewriting
+a whole file to do that takes time proportional to the size of the file,
+and undoes some of the structure of the file (e.g., linearization). The PDF
+standard allows changes to be appended to a file as an "incremental update"
+instead: the changed objects, followed by a new cross-reference section and
+trailer that point back to the original ones. That is what this module does.
+
+Only the small part of PDF needed for this is implemented: finding the
+cross-reference sections (tables or streams), reading the trailer, and
+reading the Info dictionary (which may be in an object stream). Files that
+this can't handle are read and rewritten using pdfrw instead.
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2020 by Michael Hucka and the California Institute of Technology.
+This code is open-source software released under a 3-clause BSD license.
+Please see the file "LICENSE" for more information.
+'''
+
+from   collections import namedtuple
+from   commonpy.string_utils import antiformat
+import mmap
+import os
+from   pdfrw import PdfReader, PdfWriter, PdfDict, PdfName, PdfString
+import re
+import zlib
+
+from .exceptions import PdfFormatError
+
+if __debug__:
+    from sidetrack import log
+
+
+# Internal constants.
+# .............................................................................
+
+_WHITESPACE = b'\x00\t\n\x0c\r '
+_DELIMITERS = b'()<>[]{}/%'
+_SEPARATORS = _WHITESPACE + _DELIMITERS
+
+_TAIL_SIZE = 2048
+'''Number of bytes at the end of a file in which to look for "startxref".'''
+
+_STARTXREF = re.compile(rb'startxref\s+(\d+)')
+_OBJ_HEADER = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj\b')
+_REF_TAIL = re.compile(rb'\s*(\d+)\s+R(?![^\x00\t\n\x0c\r ()<>\[\]{}/%])')
+_TABLE_ENTRY = re.compile(rb'(\d{10}) (\d{5}) ([nf])[\r\n ]{2}')
+_SUBSECTION = re.compile(rb'\s*(\d+)\s+(\d+)')
+_NUMBER = re.compile(rb'[+-]?(\d+\.?\d*|\.\d+)$')
+
+# Entries of trailers that are specific to one cross-reference section.
+_SECTION_KEYS = ['Prev', 'XRefStm', 'Type', 'W', 'Index', 'Length', 'Filter',
+                 'DecodeParms', 'Size']
+
+
+# Exported functions.
+# .............................................................................
+
+def open_pdf(file, fd = None):
+    '''Returns an object for reading and updating the Info of PDF "file".
+
+    The object has methods info_text(key), returning the text of an Info
+    entry (or None), and update_info(changes), where "changes" is a dict
+    mapping Info keys to new text values. If the file can be updated
+    incrementally, the object is a PdfDocument; otherwise, it's one that
+    uses pdfrw to read and rewrite the whole file. If "fd" is given, it's
+    a file descriptor of "file" opened for reading, and it's used to read it.
+    '''
+    try:
+        return PdfDocument(file, fd)
+    except (PdfFormatError, OSError, ValueError) as ex:
+        if __debug__: log(f'using pdfrw for {antiformat(file)}: {str(ex)}')
+        return _RewrittenDocument(file)
+
+
+# Exported classes.
+# .............................................................................
+
+Ref = namedtuple('Ref', 'num gen')
+'''An indirect reference to an object in a PDF file.'''
+
+
+class Name(str):
+    '''A PDF name object, without its leading slash.'''
+    pass
+
+
+class PdfDocument():
+    '''The parts of a PDF file needed to read and update its Info dictionary.
+
+    Raises PdfFormatError if the structure of the file isn't understood or
+    the file is encrypted.
+    '''
+
+    def __init__(self, file, fd = None):
+        self.file = file
+        if fd is None:
+            with open(file, 'rb') as f:
+                self._data = _mapped(f.fileno())
+        else:
+            self._data = _mapped(fd)
+        try:
+            self._load()
+        except (KeyError, TypeError, AttributeError, IndexError, ValueError,
+                RecursionError) as ex:
+            # The checks in _load() can't anticipate every kind of damage.
+            raise PdfFormatError(f'unable to read PDF structure: {str(ex)}')
+        finally:
+            # Everything needed later is read by now.
+            self._data.close()
+            self._data = None
+
+
+    def info_text(self, key):
+        '''Returns the text of the Info entry "key", or None if it's not set.'''
+        value = self._info.get(key)
+        return _text(value) if isinstance(value, bytes) else None
+
+
+    def update_info(self, changes):
+        '''Appends an incremental update that sets the Info entries in "changes".
+
+        The value of "changes" is a dict mapping keys (e.g., "Subject") to text.
+        '''
+        info = dict(self._info)
+        info.update({Name(key): text for (key, text) in changes.items()})
+        with open(self.file, 'ab') as f:
+            start = f.tell()
+            if __debug__: log(f'appending update at {start} to {antiformat(self.file)}')
+            f.write(self._update(start, info))
+
+
+    def _load(self):
+        data = self._data
+        tail = data[max(0, len(data) - _TAIL_SIZE):]
+        found = list(_STARTXREF.finditer(tail))
+        if not found:
+            raise PdfFormatError('no startxref')
+        self._startxref = int(found[-1].group(1))
+        self._ends_with_eol = tail[-1:] in (b'\r', b'\n')
+
+        # The trailers of all the cross-reference sections are read, from the
+        # newest to the oldest, but the entries in the sections are only read
+        # when they're needed. That's usually only the entry of Info.
+        self._sections = []
+        self._streams = {}
+        self._trailer = {}
+        self._xref_stream = None
+        offset = self._startxref
+        visited = set()
+        while offset is not None:
+            if offset in visited:
+                raise PdfFormatError('loop in cross-reference sections')
+            visited.add(offset)
+            (trailer, is_stream) = self._read_section(offset)
+            if self._xref_stream is None:
+                self._xref_stream = is_stream
+                self._size = trailer.get('Size')
+            if 'XRefStm' in trailer:
+                # A hybrid file: the stream has the compressed objects.
+                self._read_section(_offset_value(trailer['XRefStm']))
+            for (key, value) in trailer.items():
+                self._trailer.setdefault(key, value)
+            offset = trailer.get('Prev')
+            if offset is not None:
+                offset = _offset_value(offset)
+        if 'Encrypt' in self._trailer:
+            raise PdfFormatError('file is encrypted')
+        if not isinstance(self._size, int) or 'Root' not in self._trailer:
+            raise PdfFormatError('trailer lacks Size or Root')
+
+        self._info_ref = self._trailer.get('Info')
+        info = self._object(self._info_ref) if self._info_ref else {}
+        if not isinstance(info, dict):
+            raise PdfFormatError('Info is not a dictionary')
+        self._info = info
+        # Whether the Info is an object of its own, rather than being in an
+        # object stream or directly in the trailer.
+        self._info_alone = (isinstance(self._info_ref, Ref)
+                            and (self._entry(self._info_ref.num) or (0,))[0] == 1)
+
+
+    def _read_section(self, offset):
+        '''Notes the cross-reference section at "offset"; returns its trailer.'''
+        data = self._data
+        if data[offset : offset + 4] == b'xref':
+            # Entries in tables are exactly 20 bytes long, so the table can be
+            # skipped over, after checking that the entries have that length.
+            subsections = []
+            pos = offset + 4
+            while True:
+                pos = _skip_space(data, pos)
+                if data[pos : pos + 7] == b'trailer':
+                    (trailer, _) = _parse(data, pos + 7)
+                    if not isinstance(trailer, dict):
+                        raise PdfFormatError(f'bad trailer at {pos}')
+                    self._sections.append(('table', subsections))
+                    return (trailer, False)
+                match = _SUBSECTION.match(data, pos)
+                if not match:
+                    raise PdfFormatError(f'bad xref subsection at {pos}')
+                (first, count) = (int(match.group(1)), int(match.group(2)))
+                pos = _skip_space(data, match.end())
+                if count and not (_TABLE_ENTRY.match(data, pos) and
+                                  _TABLE_ENTRY.match(data, pos + 20 * (count - 1))):
+                    raise PdfFormatError(f'bad xref entries at {pos}')
+                subsections.append((first, count, pos))
+                pos += 20 * count
+        (_, value, start) = self._indirect(offset)
+        if not isinstance(value, dict) or value.get('Type') != 'XRef' or start is None:
+            raise PdfFormatError(f'no cross-reference section at {offset}')
+        widths = value.get('W')
+        index = value.get('Index', [0, value.get('Size')])
+        if not (_int_list(widths) and len(widths) == 3 and sum(widths) > 0
+                and _int_list(index) and len(index) % 2 == 0):
+            raise PdfFormatError(f'bad cross-reference stream at {offset}')
+        self._sections.append(('stream', (value, start)))
+        return (value, True)
+
+
+    def _entry(self, num):
+        '''Returns the current cross-reference entry of object "num", or None.
+
+        Entries are tuples (1, offset, generation) for objects stored on their
+        own, and (2, object stream number, index) for objects in object
+        streams. Free objects have no entries.
+        '''
+        for (kind, section) in self._sections:
+            if kind == 'table':
+                for (first, count, pos) in section:
+                    if first <= num < first + count:
+                        match = _TABLE_ENTRY.match(self._data, pos + 20 * (num - first))
+                        if not match:
+                            raise PdfFormatError(f'bad xref entry for object {num}')
+                        if match.group(3) == b'f':
+                            return None
+                        return (1, int(match.group(1)), int(match.group(2)))
+                continue
+            (value, start) = section
+            widths = value['W']
+            index = value.get('Index', [0, value['Size']])
+            row = 0
+            for (first, count) in zip(index[0::2], index[1::2]):
+                if first <= num < first + count:
+                    stream = self._stream(value, start)
+                    pos = (row + num - first) * sum(widths)
+                    if pos + sum(widths) > len(stream):
+                        raise PdfFormatError('cross-reference stream is too short')
+                    fields = []
+                    for width in widths:
+                        fields.append(int.from_bytes(stream[pos : pos + width], 'big'))
+                        pos += width
+                    if widths[0] == 0:
+                        fields[0] = 1
+                    return tuple(fields) if fields[0] in (1, 2) else None
+                row += count
+        return None
+
+
+    def _object(self, ref):
+        '''Returns the value of the object referenced by "ref".'''
+        if not isinstance(ref, Ref):
+            return ref
+        entry = self._entry(ref.num)
+        if entry is None:
+            return None
+        if entry[0] == 1:
+            (num, value, _) = self._indirect(entry[1])
+            if num != ref.num:
+                raise PdfFormatError(f'object {ref.num} is not at {entry[1]}')
+            return value
+        # The object is number entry[2] in the object stream entry[1].
+        (_, header, start) = self._indirect(self._offset(entry[1]))
+        if start is None:
+            raise PdfFormatError(f'object {entry[1]} is not a stream')
+        stream = self._stream(header, start)
+        numbers = header.get('N', 0)
+        first = header.get('First', 0)
+        if not isinstance(numbers, int) or not isinstance(first, int):
+            raise PdfFormatError(f'bad object stream {entry[1]}')
+        pos = 0
+        for _ in range(numbers):
+            match = _SUBSECTION.match(stream, pos)
+            if not match:
+                break
+            pos = match.end()
+            if int(match.group(1)) == ref.num:
+                (value, _) = _parse(stream, first + int(match.group(2)))
+                return value
+        raise PdfFormatError(f'object {ref.num} is not in its object stream')
+
+
+    def _offset(self, num):
+        entry = self._entry(num)
+        if not entry or entry[0] != 1:
+            raise PdfFormatError(f'object {num} has no file offset')
+        return entry[1]
+
+
+    def _indirect(self, offset):
+        '''Returns (object number, value, start of stream or None) at "offset".'''
+        data = self._data
+        match = _OBJ_HEADER.match(data, offset)
+        if not match:
+            raise PdfFormatError(f'no object at {offset}')
+        (value, pos) = _parse(data, match.end())
+        pos = _skip_space(data, pos)
+        if not isinstance(value, dict) or data[pos : pos + 6] != b'stream':
+            return (int(match.group(1)), value, None)
+        pos += 6
+        if data[pos : pos + 2] == b'\r\n':
+            pos += 2
+        elif data[pos : pos + 1] in (b'\r', b'\n'):
+            pos += 1
+        return (int(match.group(1)), value, pos)
+
+
+    def _stream(self, dictionary, start):
+        '''Returns the decoded contents of the stream that begins at "start".'''
+        if start not in self._streams:
+            length = dictionary.get('Length')
+            if isinstance(length, Ref):
+                (_, length, _) = self._indirect(self._offset(length.num))
+            if not isinstance(length, int) or start + length > len(self._data):
+                raise PdfFormatError(f'bad stream length at {start}')
+            self._streams[start] = _decoded(bytes(self._data[start : start + length]),
+                                            dictionary)
+        return self._streams[start]
+
+
+    def _update(self, start, info):
+        '''Returns the bytes of an incremental update that replaces the Info.'''
+        size = self._size
+        if self._info_alone and not self._xref_stream:
+            info_ref = self._info_ref
+        else:
+            # Some readers (e.g., pdfrw) don't let a newer cross-reference
+            # stream replace an object defined in an older one, so use a new
+            # object instead.
+            info_ref = Ref(size, 0)
+            size += 1
+        trailer = {key: value for (key, value) in self._trailer.items()
+                   if key not in _SECTION_KEYS}
+        trailer[Name('Info')] = info_ref
+        trailer[Name('Prev')] = self._startxref
+
+        update = b'' if self._ends_with_eol else b'\n'
+        info_offset = start + len(update)
+        update += b'%d %d obj\n' % info_ref + _serialized(info) + b'\nendobj\n'
+        xref_offset = start + len(update)
+        if not self._xref_stream:
+            trailer[Name('Size')] = size
+            update += b'xref\n%d 1\n%010d %05d n\r\n' % (info_ref.num, info_offset,
+                                                         info_ref.gen)
+            update += b'trailer\n' + _serialized(trailer)
+        else:
+            # A file that uses cross-reference streams gets a new one, which
+            # lists itself as well as the Info dictionary.
+            xref_num = size
+            trailer[Name('Size')] = size + 1
+            width = 4 if xref_offset < 2**32 else 8
+            entries = [(info_offset, info_ref.gen), (xref_offset, 0)]
+            stream = b''.join(b'\x01' + offset.to_bytes(width, 'big')
+                              + gen.to_bytes(2, 'big') for (offset, gen) in entries)
+            trailer.update({Name('Type'): Name('XRef'), Name('W'): [1, width, 2],
+                            Name('Index'): [info_ref.num, 1, xref_num, 1],
+                            Name('Length'): len(stream)})
+            update += (b'%d 0 obj\n' % xref_num + _serialized(trailer)
+                       + b'\nstream\r\n' + stream + b'\r\nendstream\nendobj')
+        update += b'\nstartxref\n%d\n%%%%EOF\n' % xref_offset
+        return update
+
+
+# Internal classes.
+# .............................................................................
+
+class _RewrittenDocument():
+    '''Same interface as PdfDocument, but using pdfrw to rewrite the file.'''
+
+    def __init__(self, file):
+        self.file = file
+        self._trailer = PdfReader(file)
+
+
+    def info_text(self, key):
+        info = self._trailer.Info
+        value = info[PdfName(key)] if info else None
+        return value.to_unicode() if isinstance(value, PdfString) else None
+
+
+    def update_info(self, changes):
+        if not self._trailer.Info:
+            self._trailer.Info = PdfDict()
+        for (key, text) in changes.items():
+            self._trailer.Info[PdfName(key)] = PdfString.from_unicode(text)
+        if __debug__: log(f'rewriting {antiformat(self.file)} using pdfrw')
+        PdfWriter(self.file, trailer = self._trailer).write()
+
+
+# Parsing and writing PDF objects.
+# .............................................................................
+# Values are represented as follows: dictionaries as dicts with Name keys,
+# arrays as lists, strings as the bytes they contain, names as Name, numbers
+# as int or float, booleans as bool, null as None, and references as Ref.
+# When writing, a str value is written as a PDF text string.
+
+def _skip_space(data, pos):
+    while pos < len(data):
+        if data[pos] in _WHITESPACE:
+            pos += 1
+        elif data[pos] == ord('%'):
+            while pos < len(data) and data[pos] not in b'\r\n':
+                pos += 1
+        else:
+            break
+    return pos
+
+
+def _token_end(data, pos):
+    while pos < len(data) and data[pos] not in _SEPARATORS:
+        pos += 1
+    return pos
+
+
+def _parse(data, pos):
+    '''Parses the object at "pos" in "data"; returns (value, position after).'''
+    try:
+        return _parse_object(data, _skip_space(data, pos))
+    except (IndexError, KeyError, ValueError, TypeError) as ex:
+        raise PdfFormatError(f'unable to parse object at {pos}: {str(ex)}')
+
+
+def _parse_object(data, pos):
+    char = data[pos : pos + 1]
+    if data[pos : pos + 2] == b'<<':
+        result = {}
+        pos = _skip_space(data, pos + 2)
+        while data[pos : pos + 2] != b'>>':
+            (key, pos) = _parse_object(data, pos)
+            if not isinstance(key, Name):
+                raise ValueError('dictionary key is not a name')
+            (result[key], pos) = _parse_object(data, _skip_space(data, pos))
+            pos = _skip_space(data, pos)
+            if pos >= len(data):
+                raise IndexError('unterminated dictionary')
+        return (result, pos + 2)
+    if char == b'[':
+        result = []
+        pos = _skip_space(data, pos + 1)
+        while data[pos : pos + 1] != b']':
+            (value, pos) = _parse_object(data, pos)
+            result.append(value)
+            pos = _skip_space(data, pos)
+            if pos >= len(data):
+                raise IndexError('unterminated array')
+        return (result, pos + 1)
+    if char == b'/':
+        end = _token_end(data, pos + 1)
+        name = re.sub(rb'#([0-9A-Fa-f]{2})', lambda m: bytes([int(m.group(1), 16)]),
+                      bytes(data[pos + 1 : end]))
+        return (Name(name.decode('latin-1')), end)
+    if char == b'(':
+        return _parse_literal(data, pos + 1)
+    if char == b'<':
+        end = data.find(b'>', pos)
+        if end < 0:
+            raise IndexError('unterminated hex string')
+        digits = re.sub(rb'[^0-9A-Fa-f]', b'', bytes(data[pos + 1 : end]))
+        if len(digits) % 2:
+            digits += b'0'
+        return (bytes.fromhex(digits.decode()), end + 1)
+    end = _token_end(data, pos)
+    token = bytes(data[pos : end])
+    if token.isdigit():
+        # It may be the start of a reference, "num gen R".
+        match = _REF_TAIL.match(data, end)
+        if match:
+            return (Ref(int(token), int(match.group(1))), match.end())
+        return (int(token), end)
+    if _NUMBER.match(token):
+        return ((float(token) if b'.' in token else int(token)), end)
+    if token in (b'true', b'false'):
+        return (token == b'true', end)
+    if token == b'null':
+        return (None, end)
+    raise ValueError(f'unexpected token {token[:20]!r}')
+
+
+_ESCAPES = {ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t', ord('b'): b'\b',
+            ord('f'): b'\f', ord('('): b'(', ord(')'): b')', ord('\\'): b'\\'}
+
+
+def _parse_literal(data, pos):
+    result = bytearray()
+    depth = 0
+    while True:
+        char = data[pos]
+        pos += 1
+        if char == ord('\\'):
+            char = data[pos]
+            pos += 1
+            if char in _ESCAPES:
+                result += _ESCAPES[char]
+            elif ord('0') <= char <= ord('7'):
+                digits = bytes([char])
+                while len(digits) < 3 and ord('0') <= data[pos] <= ord('7'):
+                    digits += bytes([data[pos]])
+                    pos += 1
+                result.append(int(digits, 8) & 0xff)
+            elif char == ord('\r'):
+                if data[pos] == ord('\n'):
+                    pos += 1
+            elif char != ord('\n'):
+                result.append(char)
+        elif char == ord('('):
+            depth += 1
+            result.append(char)
+        elif char == ord(')'):
+            if depth == 0:
+                return (bytes(result), pos)
+            depth -= 1
+            result.append(char)
+        else:
+            result.append(char)
+
+
+def _serialized(value):
+    '''Returns the bytes representing "value" in a PDF file.'''
+    if isinstance(value, Name):
+        name = value.encode('latin-1')
+        return b'/' + b''.join(bytes([c]) if 0x21 <= c <= 0x7e and c not in b'#()<>[]{}/%'
+                               else b'#%02X' % c for c in name)
+    if isinstance(value, str):
+        if value.isascii():
+            return _serialized(value.encode('ascii'))
+        return b'<FEFF' + value.encode('utf-16-be').hex().upper().encode() + b'>'
+    if isinstance(value, bytes):
+        escaped = b''.join(b'\\' + bytes([c]) if c in b'()\\'
+                           else bytes([c]) if 0x20 <= c <= 0x7e
+                           else b'\\%03o' % c for c in value)
+        return b'(' + escaped + b')'
+    if isinstance(value, bool):
+        return b'true' if value else b'false'
+    if isinstance(value, int):
+        return b'%d' % value
+    if isinstance(value, float):
+        return (b'%f' % value).rstrip(b'0').rstrip(b'.')
+    if value is None:
+        return b'null'
+    if isinstance(value, Ref):
+        return b'%d %d R' % value
+    if isinstance(value, list):
+        return b'[' + b' '.join(_serialized(item) for item in value) + b']'
+    if isinstance(value, dict):
+        return b'<<' + b''.join(_serialized(Name(key)) + b' ' + _serialized(item)
+                                for (key, item) in value.items()) + b'>>'
+    raise ValueError(f'cannot write {value!r} in a PDF file')
+
+
+# Miscellaneous utilities.
+# .............................................................................
+
+def _mapped(fd):
+    if os.fstat(fd).st_size == 0:
+        raise PdfFormatError('file is empty')
+    return mmap.mmap(fd, 0, access = mmap.ACCESS_READ)
+
+
+def _text(value):
+    '''Decodes a PDF text string.'''
+    if value.startswith(b'\xfe\xff'):
+        return value[2:].decode('utf-16-be', errors = 'replace')
+    if value.startswith(b'\xef\xbb\xbf'):
+        return value[3:].decode('utf-8', errors = 'replace')
+    # PDFDocEncoding is the same as Latin-1 for all but a few characters.
+    return value.decode('latin-1')
+
+
+def _offset_value(value):
+    if not isinstance(value, int) or value < 0:
+        raise PdfFormatError(f'bad file offset {value}')
+    return value
+
+
+def _int_list(value):
+    return isinstance(value, list) and all(isinstance(v, int) and v >= 0 for v in value)
+
+
+def _decoded(stream, dictionary):
+    '''Returns the contents of a stream with its filters undone.'''
+    filters = dictionary.get('Filter') or []
+    params = dictionary.get('DecodeParms') or []
+    if not isinstance(filters, list):
+        filters = [filters]
+    if not isinstance(params, list):
+        params = [params]
+    for (index, name) in enumerate(filters):
+        if name != 'FlateDecode':
+            raise PdfFormatError(f'unsupported stream filter {name}')
+        try:
+            stream = zlib.decompress(stream)
+        except zlib.error as ex:
+            raise PdfFormatError(f'unable to decompress stream: {str(ex)}')
+        param = params[index] if index < len(params) else None
+        if not isinstance(param, (dict, type(None))):
+            raise PdfFormatError('bad stream decoding parameters')
+        if param and param.get('Predictor', 1) > 1:
+            stream = _unpredicted(stream, param)
+    return stream
+
+
+def _unpredicted(data, params):
+    '''Undoes the PNG predictors applied to "data".'''
+    if params.get('Predictor') < 10:
+        raise PdfFormatError('unsupported TIFF predictor')
+    bpp = max(1, params.get('Colors', 1) * params.get('BitsPerComponent', 8) // 8)
+    width = (params.get('Columns', 1) * params.get('Colors', 1)
+             * params.get('BitsPerComponent', 8) + 7) // 8
+    result = bytearray()
+    previous = bytearray(width)
+    for start in range(0, len(data), width + 1):
+        kind = data[start]
+        row = bytearray(data[start + 1 : start + 1 + width])
+        for i in range(len(row)):
+            left = row[i - bpp] if i >= bpp else 0
+            up = previous[i]
+            if kind == 1:
+                row[i] = (row[i] + left) & 0xff
+            elif kind == 2:
+                row[i] = (row[i] + up) & 0xff
+            elif kind == 3:
+                row[i] = (row[i] + (left + up) // 2) & 0xff
+            elif kind == 4:
+                corner = previous[i - bpp] if i >= bpp else 0
+                guess = left + up - corner
+                (pa, pb, pc) = (abs(guess - left), abs(guess - up), abs(guess - corner))
+                nearest = left if pa <= pb and pa <= pc else up if pb <= pc else corner
+                row[i] = (row[i] + nearest) & 0xff
+        result += row
+        previous = row
+    return bytes(result)
@@ -0,0 +1,160 @@
+'''
+pipeline.py: run stages of work concurrently, connected by bounded queues
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2020 by Michael Hucka and the California Institute of Technology.
+This code is open-source software released under a 3-clause BSD license.
+Please see the file "LICENSE" for more information.
+'''
+
+from   queue import Queue, Empty, Full
+from   threading import Event, Thread
+
+if __debug__:
+    from sidetrack import log
+
+
+# Internal constants.
+# .............................................................................
+
+_PIPE_SIZE = 100
+'''Maximum number of items waiting in a pipe between two stages.'''
+
+_WAIT = 0.5
+'''Seconds to wait on a pipe before checking whether to stop.'''
+
+_END = object()
+'''Value put in a pipe after the last item.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class Pipeline():
+    '''Stages of work running in threads, connected by Pipes.
+
+    Each stage is a function that reads items from its input (usually a Pipe)
+    and puts results into its output Pipe. The last stage is the code using
+    the Pipeline, which iterates over the output of the stage before it. A
+    Pipeline is a context manager; when the context is left, the stages are
+    stopped and waited for, and the first exception raised in any of them
+    is raised again in the calling thread.
+
+    The stages also stop when the Event "stopped" is set.
+    '''
+
+    def __init__(self, stopped):
+        self._stopped = stopped
+        self._halted = Event()
+        self._stages = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._halted.set()
+        for stage in self._stages:
+            stage.join()
+        if exc_type is None:
+            for stage in self._stages:
+                if stage.exception:
+                    raise stage.exception
+        return False
+
+
+    def pipe(self, size = _PIPE_SIZE):
+        '''Returns a new Pipe that can hold up to "size" items.'''
+        return Pipe(self, size)
+
+
+    def start(self, function, *args, output):
+        '''Runs function(*args, output) in a new thread.
+
+        The Pipe "output" is closed when the function returns or fails.
+        '''
+        stage = _Stage(function, args, output)
+        self._stages.append(stage)
+        stage.start()
+
+
+    def halted(self):
+        return self._halted.is_set() or self._stopped.is_set()
+
+
+class Pipe():
+    '''A bounded queue between two stages of a Pipeline.
+
+    Iterating over a Pipe produces the items put in it until it's closed or
+    the Pipeline is halted. If the Pipeline is halted while put() is waiting
+    for room, put() raises PipelineHalted.
+    '''
+
+    def __init__(self, pipeline, size):
+        self._pipeline = pipeline
+        self._queue = Queue(maxsize = size)
+
+
+    def __iter__(self):
+        while not self._pipeline.halted():
+            try:
+                item = self._queue.get(timeout = _WAIT)
+            except Empty:
+                continue
+            if item is _END:
+                return
+            yield item
+
+
+    def put(self, item):
+        while not self._pipeline.halted():
+            try:
+                self._queue.put(item, timeout = _WAIT)
+                return
+            except Full:
+                continue
+        raise PipelineHalted()
+
+
+    def close(self):
+        try:
+            self.put(_END)
+        except PipelineHalted:
+            pass
+
+
+class PipelineHalted(Exception):
+    '''The pipeline was halted while a stage was waiting to put an item.'''
+    pass
+
+
+# Internal classes.
+# .............................................................................
+
+class _Stage(Thread):
+    def __init__(self, function, args, output):
+        super().__init__(name = function.__name__, daemon = True)
+        self._function = function
+        self._args = args
+        self._output = output
+        self.exception = None
+
+
+    def run(self):
+        try:
+            self._function(*self._args, self._output)
+        except PipelineHalted:
+            if __debug__: log(f'stage {self.name} halted')
+        except BaseException as ex:
+            if __debug__: log(f'exception in stage {self.name}: {str(ex)}')
+            self.exception = ex
+        finally:
+            self._output.close()
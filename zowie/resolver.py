@@ -0,0 +1,319 @@
+'''
+resolver.py: base class for finding the Zotero records of attachment files
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2020 by Michael Hucka and the California Institute of Technology.
+This code is open-source software released under a 3-clause BSD license.
+Please see the file "LICENSE" for more information.
+'''
+
+from abc import ABC, abstractmethod
+from collections import deque
+from commonpy.interrupt import raise_for_interrupts
+from commonpy.string_utils import antiformat
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from os import path
+import re
+
+from .exceptions import RequestFailure
+
+if __debug__:
+    from sidetrack import log
+
+
+# Data definitions.
+# .............................................................................
+
+class ZoteroRecord():
+    '''Zotero data about a local file
+      'key' is the Zotero key for the file attachment
+      'parent_key' is the top-level record that contains the file attachment
+      'file' is the path to the file on the local file system
+      'libtype' is the type of library holding the item ("user" or "group")
+      'libid' is the id of the library holding the item, as a string
+      'record' is the entire record from Zotero, or None if the data came from
+         the index built by Resolver.prefetch() or Resolver.resolve_keys()
+    The Zotero select link of the form "zotero://select/..." is 'link'.
+    '''
+
+    # Runs can involve a very large number of files, so records are kept
+    # small: no per-instance dict, and the link is only made when asked for.
+    __slots__ = ('key', 'parent_key', 'file', 'libtype', 'libid', 'record')
+
+    def __init__(self, key, parent_key, file, libtype, libid, record = None):
+        self.key = key
+        self.parent_key = parent_key
+        self.file = file
+        self.libtype = libtype
+        self.libid = libid
+        self.record = record
+
+
+    def __repr__(self):
+        return (f'ZoteroRecord(key={self.key!r}, parent_key={self.parent_key!r},'
+                f' file={self.file!r}, libtype={self.libtype!r}, libid={self.libid!r})')
+
+
+    @property
+    def link(self):
+        return select_link(self.libtype, self.libid, self.parent_key)
+
+
+_BATCH_SIZE = 50
+'''Default number of distinct item keys that records() resolves at a time.'''
+
+_ITEM_KEY = re.compile('[23456789ABCDEFGHIJKLMNPQRSTUVWXYZ]{8}$')
+'''Zotero item keys are 8 characters long, from a set without 0, 1 and O.'''
+
+_POLL_INTERVAL = 0.5
+'''Seconds between checks for interrupts while waiting for worker threads.'''
+
+
+# Class definitions.
+# .............................................................................
+
+class Resolver(ABC):
+    '''Base class for objects that find the Zotero records of local files.
+
+    Subclasses fill in an index mapping item keys to tuples (library type,
+    library id, parent key), either all at once in prefetch() or on demand
+    in resolve_keys(). This class answers lookups for files from the index.
+    '''
+
+    def __init__(self, jobs = 1):
+        # Keys that resolve_keys() could not find in any library go into
+        # _missing. If prefetching has been done, a key that is not in the
+        # index does not exist in any library.
+        self._index = {}
+        self._missing = set()
+        self._prefetched = False
+
+        # Number of groups of keys that records() resolves concurrently. If
+        # it's more than 1, resolve_keys() must be safe to call from threads.
+        self._jobs = jobs
+
+        # Maximum number of distinct keys that records() gives resolve_keys()
+        # in one call. Subclasses that can do more at once can increase it.
+        self._keys_per_group = _BATCH_SIZE
+
+        # Number of groups of files that records() could not look up because
+        # of failed network requests.
+        self.request_failures = 0
+
+
+    @abstractmethod
+    def prefetch(self):
+        '''Put the data for all attachments of all libraries in the index.'''
+        pass
+
+
+    @abstractmethod
+    def resolve_keys(self, keys):
+        '''Look up the given item keys and add what's found to the index.'''
+        pass
+
+
+    @abstractmethod
+    def changed_attachments(self, versions):
+        '''Finds the attachments that changed after the given library versions.
+
+        The value of "versions" is a dict mapping tuples (library type,
+        library id) to versions previously returned by this method; libraries
+        that are not in it are treated as entirely new. Returns a tuple
+        (keys, versions), where "keys" lists the item keys of the attachments
+        that were added or changed, and "versions" is a dict of the current
+        versions of all the libraries. The records of the attachments are put
+        in the index.
+        '''
+        pass
+
+
+    def refresh(self):
+        '''Forget what's known to be missing, so that new items can be found.
+
+        This is for long-running uses in which items may be added to Zotero
+        after they were looked up. The index is kept, because the records in
+        it don't change in ways that matter here.
+        '''
+        self._missing = set()
+        self._prefetched = False
+
+
+    def close(self):
+        '''Release any resources held by this resolver.'''
+        pass
+
+
+    def records(self, files):
+        '''Generator yielding a tuple (file, record, failure) for each file.
+
+        The files are looked up in groups, using resolve_keys() to retrieve
+        the records for a group in as few operations as possible. If this
+        resolver was created with jobs > 1, that many groups are resolved
+        concurrently in a pool of threads. Either way, the results are
+        yielded in the same order as the files. The values of record and
+        failure are as returned by record_for_file().
+        '''
+        if self._jobs <= 1:
+            for group in _groups(files, self._keys_per_group):
+                try:
+                    self.resolve_keys(_keys(group))
+                except RequestFailure as ex:
+                    yield from self._failed_records(group, ex)
+                    continue
+                yield from self._group_records(group)
+            return
+
+        # Keep up to 2 groups per thread in flight, so that workers don't sit
+        # idle while the caller is busy with the results of a finished group.
+        if __debug__: log(f'resolving keys using {self._jobs} threads')
+        pending = deque()
+        with ThreadPoolExecutor(max_workers = self._jobs) as executor:
+            try:
+                for group in _groups(files, self._keys_per_group):
+                    future = executor.submit(self.resolve_keys, _keys(group))
+                    pending.append((group, future))
+                    if len(pending) >= 2 * self._jobs:
+                        yield from self._finished_records(*pending.popleft())
+                while pending:
+                    yield from self._finished_records(*pending.popleft())
+            finally:
+                # If we're stopping early (e.g., due to ^C), don't start the
+                # remaining work. Threads check for interrupts on their own.
+                for (_, future) in pending:
+                    future.cancel()
+
+
+    def _finished_records(self, group, future):
+        # Wait in short intervals so that interrupts are noticed promptly.
+        while True:
+            try:
+                future.result(timeout = _POLL_INTERVAL)
+                break
+            except TimeoutError:
+                raise_for_interrupts()
+            except RequestFailure as ex:
+                yield from self._failed_records(group, ex)
+                return
+        yield from self._group_records(group)
+
+
+    def _failed_records(self, group, error):
+        # A failed request only fails the files whose keys it was looking up.
+        # The rest of the run goes on; the governor stops it if the server
+        # keeps failing.
+        if __debug__: log(f'lookup of {len(group)} files failed: {str(error)}')
+        self.request_failures += 1
+        for file in group:
+            itemkey = item_key(file)
+            if not valid_key(itemkey):
+                yield (file, None, _not_in_storage(file))
+            elif self._is_known(itemkey):
+                yield (file, *self._record_from_index(itemkey, file))
+            else:
+                f = antiformat(file)
+                yield (file, None, f'Unable to retrieve Zotero record for {f}: {error}')
+
+
+    def _group_records(self, group):
+        for file in group:
+            (record, failure) = self.record_for_file(file)
+            yield (file, record, failure)
+
+
+    def record_for_file(self, file):
+        '''Returns a tuple (record, failure) for the given local file.
+
+        If a record is found, the first value is a ZoteroRecord and the second
+        value is None; otherwise, the first value is None and the second is a
+        string describing the reason for the failure.
+        '''
+        if not path.exists(file):
+            # The file should always exist, because of how the list of files is
+            # gathered, so something is wrong but we don't know what. Give up.
+            raise ValueError(f'File not found: {antiformat(file)}')
+        itemkey = item_key(file)
+        if not valid_key(itemkey):
+            return (None, _not_in_storage(file))
+        if not self._is_known(itemkey):
+            self.resolve_keys([itemkey])
+        return self._record_from_index(itemkey, file)
+
+
+    def _is_known(self, itemkey):
+        return (self._prefetched or itemkey in self._index
+                or itemkey in self._missing)
+
+
+    def _record_from_index(self, itemkey, file):
+        f = antiformat(file)
+        if itemkey not in self._index:
+            if __debug__: log(f'item key "{itemkey}" is not in the index')
+            return (None, f'Unable to retrieve Zotero record for {f}')
+        (libtype, libid, parentkey) = self._index[itemkey]
+        if not parentkey:
+            if __debug__: log(f'file not associated with a parent record: {f}')
+            return (None, f'File lacks a parent Zotero record: {f}')
+        if __debug__: log(f'{parentkey} is parent of {itemkey} for {f} (indexed)')
+        r = ZoteroRecord(key = itemkey, parent_key = parentkey, file = file,
+                         libtype = libtype, libid = libid)
+        return (r, None)
+
+
+# Miscellaneous utilities.
+# .............................................................................
+
+def _groups(files, size):
+    '''Generator yielding lists of files that have at most "size" keys.'''
+    files = iter(files)
+    while True:
+        group = []
+        keys = set()
+        for file in files:
+            group.append(file)
+            keys.add(item_key(file))
+            if len(keys) >= size:
+                break
+        if not group:
+            return
+        yield group
+
+
+def _keys(files):
+    '''Returns the item keys of the files, leaving out keys that can't exist.'''
+    return [key for key in map(item_key, files) if valid_key(key)]
+
+
+def _not_in_storage(file):
+    return f'File is not in a Zotero storage folder: {antiformat(file)}'
+
+
+def valid_key(key):
+    '''Returns True if "key" has the form of a Zotero item key.'''
+    return bool(_ITEM_KEY.match(key))
+
+
+def item_key(file):
+    '''Returns the Zotero item key for a file in Zotero's storage directory.'''
+    # Zotero stores content in the subdirectory like .../storage/N743ZXDF.
+    # The item key is the alphanumeric directory name.
+    return path.basename(path.dirname(file))
+
+
+# For the format of the URIs, see these discussions in the Zotero forums:
+# https://forums.zotero.org/discussion/comment/335046/#Comment_335046
+# https://forums.zotero.org/discussion/78312/zotero-uri-vs-select-item
+
+def select_link(libtype, libid, parentkey):
+    '''Returns a Zotero select link for an item in the given library.'''
+    if libtype == 'user':
+        return f'zotero://select/library/items/{parentkey}'
+    else:
+        return f'zotero://select/groups/{libid}/items/{parentkey}'
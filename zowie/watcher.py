@@ -0,0 +1,259 @@
+'''
+watcher.py: notice new files in a Zotero storage folder as they appear
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2020 by Michael Hucka and the California Institute of Technology.
+This code is open-source software released under a 3-clause BSD license.
+Please see the file "LICENSE" for more information.
+'''
+
+from   commonpy.interrupt import raise_for_interrupts
+from   commonpy.string_utils import antiformat
+import ctypes
+import ctypes.util
+import os
+from   os import path
+import select
+import struct
+import sys
+import time
+
+from .resolver import valid_key
+
+if __debug__:
+    from sidetrack import log
+
+
+# Internal constants.
+# .............................................................................
+
+_SETTLE_TIME = 3
+'''Seconds without changes to a file after which it's considered complete.'''
+
+_POLL_INTERVAL = 10
+'''Seconds between scans of the storage folder when inotify isn't available.'''
+
+_WAIT = 1
+'''Seconds to wait for changes before checking whether to stop.'''
+
+# Values from /usr/include/linux/inotify.h.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO    = 0x00000080
+_IN_CREATE      = 0x00000100
+_IN_Q_OVERFLOW  = 0x00004000
+_IN_IGNORED     = 0x00008000
+_IN_ISDIR       = 0x40000000
+_IN_NONBLOCK    = 0o4000
+_IN_CLOEXEC     = 0o2000000
+
+_IN_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+
+_EVENT = struct.Struct('iIII')
+'''Layout of struct inotify_event, not counting the name that follows it.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class Watcher():
+    '''Reports the files added to a Zotero storage folder, in batches.
+
+    New attachments in Zotero get new item folders in the storage folder, so
+    the watcher looks for new item folders and for files written in them. On
+    Linux, it uses inotify; elsewhere, it scans the storage folder at regular
+    intervals. A file is reported once there have been no changes to it for
+    a few seconds, so that files still being written are not reported.
+    '''
+
+    def __init__(self, storage, settle = _SETTLE_TIME, interval = _POLL_INTERVAL):
+        self._settle = settle
+        # Files waiting to be reported, mapped to the time when they can be.
+        self._pending = {}
+        self._source = None
+        if sys.platform.startswith('linux'):
+            try:
+                self._source = _Inotify(storage)
+            except (OSError, AttributeError) as ex:
+                if __debug__: log(f'unable to use inotify: {str(ex)}')
+        if not self._source:
+            self._source = _Poller(storage, interval)
+
+
+    def batches(self, stopped):
+        '''Generator yielding lists of new files until "stopped" is set.
+
+        The value of "stopped" must be a threading.Event.
+        '''
+        while not stopped.is_set():
+            raise_for_interrupts()
+            for file in self._source.changes(_WAIT):
+                if __debug__: log(f'change in {antiformat(file)}')
+                self._pending[file] = time.monotonic() + self._settle
+            now = time.monotonic()
+            ready = sorted(file for (file, when) in self._pending.items()
+                           if when <= now)
+            for file in ready:
+                del self._pending[file]
+            ready = [file for file in ready if path.isfile(file)]
+            if ready:
+                yield ready
+
+
+    def requeue(self, file, delay):
+        '''Reports the file again after "delay" seconds.'''
+        self._pending[file] = time.monotonic() + delay
+
+
+    def close(self):
+        self._source.close()
+
+
+# Internal classes.
+# .............................................................................
+
+class _Inotify():
+    '''Source of changes using the Linux inotify API.'''
+
+    def __init__(self, storage):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        self._add_watch = libc.inotify_add_watch
+        self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._storage = storage
+        self._folders = {}
+        if not self._watch(storage):
+            os.close(self._fd)
+            raise OSError(ctypes.get_errno(), f'unable to watch {storage}')
+        if __debug__: log(f'watching {antiformat(storage)} using inotify')
+
+
+    def changes(self, timeout):
+        '''Returns a list of files created or written, waiting up to "timeout".'''
+        (readable, _, _) = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, _, length) = _EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + _EVENT.size :
+                                    offset + _EVENT.size + length].rstrip(b'\0'))
+            offset += _EVENT.size + length
+            if mask & _IN_Q_OVERFLOW:
+                if __debug__: log('inotify queue overflowed; events were lost')
+                continue
+            if mask & _IN_IGNORED:
+                self._folders.pop(wd, None)
+                continue
+            folder = self._folders.get(wd)
+            if not folder:
+                continue
+            item = path.join(folder, name)
+            if folder == self._storage:
+                if mask & _IN_ISDIR and valid_key(name) and self._watch(item):
+                    # Files may have been put in the folder before the watch
+                    # on it started, so look for them now.
+                    try:
+                        with os.scandir(item) as scanner:
+                            changed += [entry.path for entry in scanner
+                                        if entry.is_file()]
+                    except OSError as ex:
+                        # The folder was removed or renamed in the meantime.
+                        if __debug__: log(f'unable to read {antiformat(item)}:'
+                                          f' {str(ex)}')
+            elif not mask & _IN_ISDIR:
+                changed.append(item)
+        return changed
+
+
+    def close(self):
+        os.close(self._fd)
+
+
+    def _watch(self, folder):
+        wd = self._add_watch(self._fd, os.fsencode(folder), _IN_MASK)
+        if wd < 0:
+            if __debug__: log(f'unable to watch {antiformat(folder)}: errno'
+                              f' {ctypes.get_errno()}')
+            return False
+        self._folders[wd] = folder
+        return True
+
+
+class _Poller():
+    '''Source of changes that scans the storage folder periodically.'''
+
+    def __init__(self, storage, interval):
+        self._storage = storage
+        self._interval = interval
+        self._last_scan = time.monotonic()
+        # Modification times of item folders, and (size, modification time)
+        # of files seen recently.
+        self._folders = self._scan()
+        self._recent = {}
+        if __debug__: log(f'watching {antiformat(storage)} by polling')
+
+
+    def changes(self, timeout):
+        '''Returns a list of files created or written since the last scan.'''
+        time.sleep(timeout)
+        if time.monotonic() - self._last_scan < self._interval:
+            return []
+        self._last_scan = time.monotonic()
+        folders = self._scan()
+        changed = []
+        # A folder's modification time changes when files are added to it.
+        for folder in [f for (f, mtime) in folders.items()
+                       if self._folders.get(f) != mtime]:
+            try:
+                with os.scandir(folder) as scanner:
+                    for entry in scanner:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            self._recent[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                            changed.append(entry.path)
+            except OSError as ex:
+                # The folder was removed or renamed since the scan found it.
+                if __debug__: log(f'unable to read {antiformat(folder)}: {str(ex)}')
+        self._folders = folders
+        # Files that are being written change in size or modification time,
+        # not their folder's modification time, so check the recent ones.
+        for (file, signature) in list(self._recent.items()):
+            if file in changed:
+                continue
+            try:
+                stat = os.stat(file)
+            except OSError:
+                del self._recent[file]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) == signature:
+                del self._recent[file]
+            else:
+                self._recent[file] = (stat.st_size, stat.st_mtime_ns)
+                changed.append(file)
+        return changed
+
+
+    def close(self):
+        pass
+
+
+    def _scan(self):
+        folders = {}
+        with os.scandir(self._storage) as scanner:
+            for entry in scanner:
+                if entry.is_dir() and valid_key(entry.name):
+                    folders[entry.path] = entry.stat().st_mtime_ns
+        return folders
@@ -17,69 +17,90 @@ Please see the file "LICENSE" for more information.
 from bun import inform, warn, alert, alert_fatal
 from commonpy.interrupt import raise_for_interrupts
 from commonpy.string_utils import antiformat
-from collections import namedtuple
-from os import path as path
 from pyzotero import zotero, zotero_errors
+import requests
+from requests.adapters import HTTPAdapter
+import sys
+import threading
+import time
+from urllib.parse import urlparse
 
-from .exceptions import CannotProceed
+from .exceptions import CannotProceed, RequestFailure
 from .exit_codes import ExitCode
+from .governor import Governor
 from .keyring_utils import keyring_credentials, save_keyring_credentials
 from .keyring_utils import validated_input
+from .resolver import Resolver, select_link
 
 if __debug__:
     from sidetrack import log
 
 
-# Data definitions.
+# Exported constants.
 # .............................................................................
 
-ZoteroRecord = namedtuple('ZoteroRecord', 'key parent_key file link record')
-ZoteroRecord.__doc__ = '''Zotero data about a local file
-  'key' is the Zotero key for the file attachment
-  'parent_key' is the top-level record that contains the file attachment
-  'file' is the path to the file on the local file system
-  'link' is a Zotero select link of the form "zotero://select/..."
-  'record' is the entire record from Zotero
-'''
+WEB_API = 'https://api.zotero.org'
+'''Base URL of the Zotero web API.'''
+
+LOCAL_API = 'http://localhost:23119/api'
+'''Base URL of the local API offered by the Zotero desktop application.'''
+
+
+# Internal constants.
+# .............................................................................
+
+_PAGE_SIZE = 100
+'''Maximum number of items that the Zotero API returns per page of results.'''
+
+_BATCH_SIZE = 50
+'''Maximum number of item keys that can be given in one itemKey parameter.'''
+
+_POOL_SIZE = 10
+'''Number of HTTP connections kept open for reuse.'''
 
 
 # Exported classes.
 # .............................................................................
 
-# maybe this should be a subclass of the pytoztero class?
-
-class Zotero():
+class Zotero(Resolver):
     '''Zotero interface class.'''
 
-    def __init__(self, key, user_id, use_keyring):
-        if key and (not key.isalnum() or len(key) < 20):
-            alert_fatal(f'"{key}" does not appear to be a valid API key.')
-            raise CannotProceed(ExitCode.bad_arg)
-        if user_id and not user_id.isdigit():
-            alert_fatal(f'"{user_id}" does not appear to be a Zotero user ID.')
-            raise CannotProceed(ExitCode.bad_arg)
+    def __init__(self, key, user_id, use_keyring, cache = None, endpoint = None,
+                 jobs = 1):
+        '''Connect to Zotero and find the libraries the user can access.
 
-        # If the user supplied all the values on the command line, those are
-        # the values used.  If none were supplied by the user on the command
-        # line, all the values are retrieved from the user's keyring.  If
-        # some were supplied and others missing, they're filled in from
-        # either the keyring or by prompting the user.
-
-        if __debug__: log('keyring ' + ('enabled' if use_keyring else 'disabled'))
-        if key is None and user_id is None and use_keyring:
-            # We weren't given a key and id, but we can look in the keyring.
-            if __debug__: log(f'getting id & key from keyring')
-            key, user_id = keyring_credentials()
-        if not key:
-            key = validated_input('API key', key, lambda x: x.isalnum())
-        if not user_id:
-            user_id = validated_input('User ID', user_id, lambda x: x.isdigit())
-        if use_keyring:
-            if __debug__: log('saving credentials to keyring')
-            save_keyring_credentials(key, user_id)
+        If "endpoint" is None, the Zotero web API is used, with the given
+        credentials. Otherwise, "endpoint" is the base URL of a server that
+        implements the same API without needing credentials, such as the
+        local API of the Zotero desktop application (LOCAL_API). The value
+        of "jobs" is the number of lookups that records() performs at once.
+        '''
+        super().__init__(jobs)
+        if endpoint:
+            # The local API doesn't use keys and always calls the user "0".
+            (key, user_id) = (None, '0')
+        else:
+            (key, user_id) = zotero_credentials(key, user_id, use_keyring)
+            endpoint = WEB_API
 
         self._key = key
         self._user_id = user_id
+        self._endpoint = endpoint
+
+        # All requests go through one HTTP session, so that connections to the
+        # server are kept open and reused instead of made anew for every call.
+        self._session = requests.Session()
+        pool_size = max(_POOL_SIZE, jobs)
+        self._session.mount(endpoint, HTTPAdapter(pool_maxsize = pool_size))
+
+        # Requests from all threads are paced by one governor, which adapts
+        # to how fast the server responds and to what the server asks for.
+        self._governor = Governor(maximum = jobs)
+
+        # pyzotero objects keep the state of the last request in the object,
+        # so they can't be shared between threads. Worker threads used by
+        # records() get their own copies of the objects in self._libraries.
+        self._thread_data = threading.local()
 
         # Get connected and store the Zotero conection object for the user
         # library first, then look up the group libraries that the user can
@@ -89,7 +110,7 @@ class Zotero():
         self._libraries = []
         try:
             if __debug__: log(f'connecting to Zotero as user {user_id}')
-            user = zotero.Zotero(user_id, 'user', key)
+            user = self._library(user_id, 'user')
             # pyzotero will return an object but that doesn't mean the user
             # actually gave valid credentials. Need to try an operation.
             user.count_items()
@@ -105,13 +126,17 @@ class Zotero():
             raise
         except Exception as ex:
             if __debug__: log(f'failed to create Zotero user object: str(ex)')
+            if endpoint != WEB_API:
+                alert_fatal(f'Unable to connect to the Zotero API at {endpoint}.',
+                            'Is Zotero running, with its local API enabled?')
+                raise CannotProceed(ExitCode.server_error)
             alert_fatal('Unable to connect to Zotero API.')
             raise
 
         try:
             for group in user.groups():
                 if __debug__: log(f'user can access group id {group["id"]}')
-                self._libraries.append(zotero.Zotero(group['id'], 'group', key))
+                self._libraries.append(self._library(group['id'], 'group'))
                 raise_for_interrupts()
         except KeyboardInterrupt as ex:
             if __debug__: log(f'got exception {str(ex)}')
@@ -120,72 +145,138 @@ class Zotero():
             if __debug__: log(f'failed to create Zotero group object: str(ex)')
             alert('Unable to retrieve Zotero group library; proceeding anyway.')
 
+        # Rather than ask every library about every key, lookups are sent to
+        # the library that owns the key. _owners maps attachment keys to the
+        # position of their library in self._libraries; it's filled in from
+        # the key lists of the libraries on first use. If that's not possible,
+        # libraries are tried in order of how many keys were found in them.
+        self._owners = None
+        self._owners_lock = threading.Lock()
+        # After refresh(), keys may have been added to Zotero since the key
+        # lists were retrieved. Keys not in the lists are then searched for.
+        self._owners_current = True
+        self._hits = [0] * len(self._libraries)
 
-    def record_for_file(self, file):
-        '''Returns a ZoteroRecord corresponding to the given local PDF file.'''
-        f = antiformat(file)
-        if not path.exists(file):
-            # The file should always exist, because of how the list of files is
-            # gathered, so something is wrong but we don't know what. Give up.
-            raise ValueError(f'File not found: {f}')
-
-        # Zotero stores content in the subdirectory like .../storage/N743ZXDF.
-        # The item key is the alphanumeric directory name.
-        # Given the key, there's no way to know whether the record is in a user
-        # library or a group library, so we have to iterate over the options.
-        itemkey = path.basename(path.dirname(file))
-        record = None
+        # If we have a persistent cache, it's consulted before the network
+        # and it's kept up to date by asking only for what changed since the
+        # library versions recorded at the end of the previous sync.
+        self._cache = cache
+        if cache:
+            self._sync_cache()
+
+
+    def prefetch(self):
+        '''Download the attachment records of all libraries into an index.
+
+        This pages through every attachment item in the user's library and
+        the group libraries, 100 items per request, and stores only the item
+        key, library and parent key of each. Subsequent calls to
+        record_for_file() are answered from the index without network access.
+        '''
         for library in self._libraries:
-            try:
-                record = library.item(itemkey)
-                if __debug__: log(f'{itemkey} found in library {library.library_id}')
-                break
-            except zotero_errors.ResourceNotFound:
-                if __debug__: log(f'{itemkey} not found in library {library.library_id}')
-                continue
-            except KeyboardInterrupt as ex:
-                if __debug__: log(f'interrupted: {str(ex)}')
-                raise
-            except Exception as ex:
-                if __debug__: log(f'got exception {str(ex)}')
-                raise
-            # pyzotero calls urllib3 for network connections. The latter uses
-            # try-except clauses that broadly catch all Exceptions but don't
-            # check for for KeyboardInterrupt. Thus, ^C during a network call
-            # will show up as a failure to return data, not a KeyboardInterrupt.
-            raise_for_interrupts()
-        if not record:
-            if __debug__: log(f'could not find a record for item key "{itemkey}"')
-            return (None, f'Unable to retrieve Zotero record for {f}')
+            if __debug__: log(f'prefetching attachments in {library.library_id}')
+            for page in self._pages(library, itemType = 'attachment'):
+                entries = [self._add_to_index(record) for record in page]
+                if self._cache:
+                    self._cache.put(entries)
+        self._prefetched = True
+        if __debug__: log(f'index now has {len(self._index)} entries')
+
+
+    def changed_attachments(self, versions):
+        '''Finds the attachments changed after the given library versions.
+
+        This uses the "since" parameter of the Zotero API, so the number of
+        requests depends on how many attachments changed, not on the size of
+        the libraries. See Resolver.changed_attachments().
+        '''
+        keys = []
+        current = {}
+        for library in self._libraries:
+            spec = _library_spec(library)
+            since = versions.get(spec) or 0
+            if __debug__: log(f'getting attachments of {spec} changed since {since}')
+            version = None
+            for page in self._pages(library, itemType = 'attachment', since = since):
+                if version is None:
+                    # As in _sync_cache(), use the version of the first response.
+                    version = library.request.headers.get('last-modified-version')
+                entries = [self._add_to_index(record) for record in page]
+                keys += [key for (key, _, _, _) in entries]
+                if self._cache:
+                    self._cache.put(entries)
+            current[spec] = int(version) if version else since
+        if __debug__: log(f'{len(keys)} attachments changed')
+        return (keys, current)
 
-        # If the PDF isn't associated with a bib record, it won't have a parent.
-        parentkey = self.parent_key(record, file)
-        if not parentkey:
-            if __debug__: log(f'file not associated with a parent record: {f}')
-            return (None, f'File lacks a parent Zotero record: {f}')
 
-        # We have an item record and a parent. We are happy campers.
-        if __debug__: log(f'{parentkey} is parent of {itemkey} for {f}')
-        r = ZoteroRecord(key = itemkey, parent_key = parentkey, file = file,
-                         link = self.item_link(record, file), record = record)
-        return (r, None)
+    def refresh(self):
+        '''Forget what's known to be missing.
 
+        The key lists of the libraries are kept, because retrieving them
+        takes time proportional to the size of the libraries. Keys that are
+        not in them are looked for in all the libraries from now on.
+        '''
+        super().refresh()
+        self._owners_current = False
+
+
+    def resolve_keys(self, keys):
+        '''Look up the given item keys in batches and add them to the index.
+
+        Keys are sent to the Zotero API up to 50 at a time using the API's
+        itemKey parameter, each to the library that owns it. If the owners
+        of keys are not known, the keys not found in one library are carried
+        over to the batches sent to the next library. Keys that are not
+        found in any library are remembered as missing.
+        '''
+        pending = [k for k in dict.fromkeys(keys)
+                   if k not in self._index and k not in self._missing]
+        if self._prefetched or not pending:
+            return
+        if self._cache:
+            for key in pending:
+                cached = self._cache.get(key)
+                if cached:
+                    self._index[key] = cached
+            pending = [k for k in pending if k not in self._index]
+        if not pending:
+            return
+        libraries = self._thread_libraries()
+        owners = self._key_owners()
+        if owners is not None:
+            routes = {}
+            for key in pending:
+                if key in owners:
+                    routes.setdefault(owners[key], []).append(key)
+            for (index, routed) in routes.items():
+                self._lookup(index, libraries[index], routed)
+            if not self._owners_current:
+                # Keys that are new since the key lists were retrieved.
+                unrouted = [k for k in pending if k not in owners]
+                for index in self._by_affinity():
+                    if not unrouted:
+                        break
+                    self._lookup(index, libraries[index], unrouted)
+                    unrouted = [k for k in unrouted if k not in self._index]
+        else:
+            for index in self._by_affinity():
+                if not pending:
+                    break
+                self._lookup(index, libraries[index], pending)
+                pending = [k for k in pending if k not in self._index]
+        pending = [k for k in pending if k not in self._index]
+        if __debug__: log(f'{len(pending)} keys not found in any library')
+        self._missing.update(pending)
 
-    # For the format of the URIs, see these discussions in the Zotero forums:
-    # https://forums.zotero.org/discussion/comment/335046/#Comment_335046
-    # https://forums.zotero.org/discussion/78312/zotero-uri-vs-select-item
 
     def item_link(self, record, file):
         '''Given a record, returns an item link (i.e., "zotero://select/...)'''
-        libtype = record['library']['type']
         parentkey = self.parent_key(record, file)
         if not parentkey:
             return None
-        if libtype == 'user':
-            return f'zotero://select/library/items/{parentkey}'
-        else:
-            groupid = record['library']['id']
-            return f'zotero://select/groups/{groupid}/items/{parentkey}'
+        return select_link(record['library']['type'], record['library']['id'],
+                           parentkey)
 
 
     def parent_key(self, record, file):
@@ -198,3 +289,258 @@ class Zotero():
             if __debug__: log(f'unexpected record for {f}: ' + str(record["data"]))
             return None
         return record['data']['parentItem']
+
+
+    def _library(self, library_id, library_type):
+        return _Library(library_id, library_type, self._key, self._endpoint,
+                        self._session, self._governor)
+
+
+    def _thread_libraries(self):
+        '''Returns the list of library objects for use in the current thread.'''
+        if threading.current_thread() is threading.main_thread():
+            return self._libraries
+        libraries = getattr(self._thread_data, 'libraries', None)
+        if libraries is None:
+            specs = [_library_spec(library) for library in self._libraries]
+            libraries = [self._library(libid, libtype) for (libtype, libid) in specs]
+            self._thread_data.libraries = libraries
+        return libraries
+
+
+    def _add_to_index(self, record):
+        '''Adds the record to the index and returns a tuple for the cache.'''
+        (key, libtype, libid, parentkey) = index_entry(record)
+        self._index[key] = (libtype, libid, parentkey)
+        return (key, libtype, libid, parentkey)
+
+
+    def _lookup(self, index, library, keys):
+        '''Looks up the keys in the library and adds the results to the index.'''
+        if __debug__: log(f'looking up {len(keys)} keys in {library.library_id}')
+        for start in range(0, len(keys), _BATCH_SIZE):
+            batch = keys[start : start + _BATCH_SIZE]
+            try:
+                found = library.items(itemKey = ','.join(batch), limit = len(batch))
+            except KeyboardInterrupt as ex:
+                if __debug__: log(f'interrupted: {str(ex)}')
+                raise
+            except Exception as ex:
+                if __debug__: log(f'got exception {str(ex)}')
+                raise
+            entries = [self._add_to_index(record) for record in found]
+            # Updates from different threads may race; the counts only
+            # decide the order in which libraries are tried.
+            self._hits[index] += len(entries)
+            if self._cache:
+                self._cache.put(entries)
+            # pyzotero calls urllib3 for network connections. The latter uses
+            # try-except clauses that broadly catch all Exceptions but don't
+            # check for for KeyboardInterrupt. Thus, ^C during a network call
+            # will show up as a failure to return data, not a KeyboardInterrupt.
+            raise_for_interrupts()
+
+
+    def _by_affinity(self):
+        '''Returns the positions of the libraries, most productive first.'''
+        return sorted(range(len(self._libraries)), key = lambda i: -self._hits[i])
+
+
+    def _key_owners(self):
+        '''Returns a dict mapping attachment keys to library positions, or None.
+
+        The dict is built the first time this is called, by asking each
+        library for the list of its attachment keys (one request per library).
+        If there's only one library, or a list can't be retrieved, None is
+        returned and the libraries have to be searched.
+        '''
+        if len(self._libraries) < 2:
+            return None
+        with self._owners_lock:
+            if self._owners is None:
+                owners = {}
+                for (index, library) in enumerate(self._thread_libraries()):
+                    if __debug__: log(f'getting attachment keys of {library.library_id}')
+                    try:
+                        keys = library.items(format = 'keys', itemType = 'attachment',
+                                             limit = None)
+                    except KeyboardInterrupt:
+                        raise
+                    except Exception as ex:
+                        if __debug__: log(f'unable to get keys: {str(ex)}')
+                        owners = False
+                        break
+                    if not isinstance(keys, bytes):
+                        # pyzotero returns text formats as bytes. Anything else
+                        # means the server doesn't support the format.
+                        if __debug__: log('server did not return a list of keys')
+                        owners = False
+                        break
+                    for key in _parse_keys(keys):
+                        owners[key] = index
+                    raise_for_interrupts()
+                if __debug__: log(f'owners of {len(owners or {})} keys are known')
+                self._owners = owners
+                self._owners_current = True
+            return self._owners if self._owners is not False else None
+
+
+    def _pages(self, library, **params):
+        '''Generator yielding successive pages of results of library.items().
+
+        The first page is always yielded, even if it's empty, so that callers
+        can read the response headers of the first request.
+        '''
+        page = library.items(limit = _PAGE_SIZE, **params)
+        yield page
+        # See the comment about interrupts in _lookup().
+        raise_for_interrupts()
+        while library.links and library.links.get('next'):
+            yield library.follow()
+            raise_for_interrupts()
+
+
+    def _sync_cache(self):
+        '''Brings the persistent cache up to date with the Zotero libraries.'''
+        known = [_library_spec(library) for library in self._libraries]
+        for (libtype, libid) in self._cache.libraries():
+            if (libtype, libid) not in known:
+                # The user no longer has access to this library.
+                self._cache.forget_library(libtype, libid)
+        for library in self._libraries:
+            (libtype, libid) = _library_spec(library)
+            since = self._cache.version(libtype, libid)
+            if since is None:
+                # Nothing is cached for this library yet. Records will be cached
+                # as they're looked up, and they will be at least this current.
+                version = library.last_modified_version()
+                if __debug__: log(f'starting cache of {libtype} {libid} at {version}')
+                self._cache.set_version(libtype, libid, version)
+                continue
+            if __debug__: log(f'updating cache of {libtype} {libid} since {since}')
+            version = None
+            for page in self._pages(library, itemType = 'attachment', since = since):
+                if version is None:
+                    # Use the version reported in the first response, so that
+                    # changes made while we're paging are picked up next time.
+                    version = library.request.headers.get('last-modified-version')
+                self._cache.put(index_entry(record) for record in page)
+            deleted = library.deleted(since = since)
+            self._cache.delete(deleted.get('items', []))
+            if __debug__: log(f'cache of {libtype} {libid} now at version {version}')
+            self._cache.set_version(libtype, libid, version or since)
+
+
+# Internal classes.
+# .............................................................................
+
+# This subclass of the pyzotero class changes only how HTTP requests are
+# made: pyzotero creates a new connection for every request, whereas this
+# uses a session shared by all the libraries, and it allows the base URL of
+# the API to have a path component (e.g., "http://localhost:23119/api").
+# Requests are paced by a Governor and retried when the server is overloaded.
+
+class _Library(zotero.Zotero):
+    '''pyzotero Zotero object that uses a shared HTTP session.'''
+
+    def __init__(self, library_id, library_type, api_key, endpoint, session,
+                 governor):
+        super().__init__(library_id, library_type, api_key)
+        self.endpoint = endpoint
+        self._session = session
+        self._governor = governor
+        self._prefix = urlparse(endpoint).path.rstrip('/')
+
+
+    def _retrieve_data(self, request = None, params = None):
+        # The links used by follow() include the path prefix of the endpoint.
+        if self._prefix and request.startswith(self._prefix + '/'):
+            request = request[len(self._prefix):]
+        self.self_link = request
+        url = self.endpoint.rstrip('/') + request
+        # The governor decides when each attempt may go out; it also takes
+        # care of Backoff and Retry-After, so pyzotero's backoff isn't used.
+        attempt = 0
+        while True:
+            attempt += 1
+            self._governor.acquire()
+            start = time.monotonic()
+            try:
+                self.request = self._session.get(url, params = params,
+                                                 headers = self.default_headers(),
+                                                 timeout = zotero.timeout)
+            except requests.exceptions.RequestException as ex:
+                if __debug__: log(f'attempt {attempt} of GET {request} failed: {ex}')
+                self._governor.release(time.monotonic() - start)
+                if self._governor.retry(attempt):
+                    continue
+                raise RequestFailure(f'Unable to reach {self.endpoint}: {ex}')
+            status = self.request.status_code
+            self._governor.release(time.monotonic() - start, status,
+                                   self.request.headers)
+            if status == 429 or status >= 500:
+                if __debug__: log(f'attempt {attempt} of GET {request} got {status}')
+                if self._governor.retry(attempt, status):
+                    continue
+                raise RequestFailure(f'Zotero server responded with status {status}')
+            break
+        self.request.encoding = 'utf-8'
+        try:
+            self.request.raise_for_status()
+        except requests.exceptions.HTTPError:
+            zotero.error_handler(self, self.request)
+        return self.request
+
+
+# Miscellaneous utilities.
+# .............................................................................
+
+def zotero_credentials(key, user_id, use_keyring):
+    '''Returns a tuple (API key, user id), asking the user if necessary.'''
+    if key and (not key.isalnum() or len(key) < 20):
+        alert_fatal(f'"{key}" does not appear to be a valid API key.')
+        raise CannotProceed(ExitCode.bad_arg)
+    if user_id and not user_id.isdigit():
+        alert_fatal(f'"{user_id}" does not appear to be a Zotero user ID.')
+        raise CannotProceed(ExitCode.bad_arg)
+
+    # If the user supplied all the values on the command line, those are
+    # the values used.  If none were supplied by the user on the command
+    # line, all the values are retrieved from the user's keyring.  If
+    # some were supplied and others missing, they're filled in from
+    # either the keyring or by prompting the user.
+
+    if __debug__: log('keyring ' + ('enabled' if use_keyring else 'disabled'))
+    if key is None and user_id is None and use_keyring:
+        # We weren't given a key and id, but we can look in the keyring.
+        if __debug__: log(f'getting id & key from keyring')
+        key, user_id = keyring_credentials()
+    if not key:
+        key = validated_input('API key', key, lambda x: x.isalnum())
+    if not user_id:
+        user_id = validated_input('User ID', user_id, lambda x: x.isdigit())
+    if use_keyring:
+        if __debug__: log('saving credentials to keyring')
+        save_keyring_credentials(key, user_id)
+    return (key, user_id)
+
+
+def _parse_keys(content):
+    '''Returns the list of keys in a response in the "keys" format.'''
+    return [sys.intern(key) for key in content.decode('utf-8').split()]
+
+
+def _library_spec(library):
+    '''Returns a tuple (library type, library id) for a pyzotero object.'''
+    libtype = 'user' if library.library_type == 'users' else 'group'
+    return (libtype, str(library.library_id))
+
+
+def index_entry(record):
+    '''Returns a tuple (key, library type, library id, parent key).'''
+    # Strings are interned because the same few library types and ids are
+    # repeated in every entry of what can be a very large index.
+    libtype = sys.intern(record['library']['type'])
+    libid = sys.intern(str(record['library']['id']))
+    parentkey = record.get('data', {}).get('parentItem')
+    return (sys.intern(record['key']), libtype, libid, parentkey)
@@ -0,0 +1,368 @@
+'''
+zotero_async.py: look up Zotero records using concurrent asynchronous requests
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2020 by Michael Hucka and the California Institute of Technology.
+This code is open-source software released under a 3-clause BSD license.
+Please see the file "LICENSE" for more information.
+'''
+
+import asyncio
+from   bun import alert, alert_fatal
+from   commonpy.interrupt import raise_for_interrupts
+import httpx
+import sys
+import time
+
+from .exceptions import CannotProceed, RequestFailure
+from .exit_codes import ExitCode
+from .governor import Governor
+from .resolver import Resolver
+from .zotero import WEB_API, index_entry, zotero_credentials
+
+if __debug__:
+    from sidetrack import log
+
+
+# Internal constants.
+# .............................................................................
+
+_PAGE_SIZE = 100
+'''Maximum number of items that the Zotero API returns per page of results.'''
+
+_BATCH_SIZE = 50
+'''Maximum number of item keys that can be given in one itemKey parameter.'''
+
+_LIMIT = 8
+'''Default maximum number of requests in progress at the same time.'''
+
+_TIMEOUT = 30
+'''Seconds to wait for a response from the server.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class AsyncZotero(Resolver):
+    '''Zotero interface that sends many requests at the same time.
+
+    This is an alternative to the Zotero class. It uses asyncio and a pool of
+    kept-alive HTTP connections to have up to "limit" requests in progress at
+    once (default: 8). Each batch of keys is sent to all libraries at the
+    same time, rather than to one library after another. The methods of this
+    class are ordinary (blocking) methods that run an event loop internally,
+    so that callers can use it in the same way as the other resolvers.
+    '''
+
+    def __init__(self, key, user_id, use_keyring, cache = None, endpoint = None,
+                 limit = None):
+        super().__init__()
+        if endpoint:
+            # The local API doesn't use keys and always calls the user "0".
+            (key, user_id) = (None, '0')
+        else:
+            (key, user_id) = zotero_credentials(key, user_id, use_keyring)
+            endpoint = WEB_API
+        self._key = key
+        self._endpoint = endpoint.rstrip('/')
+        self._limit = limit or _LIMIT
+        self._cache = cache
+
+        # Hand records() enough keys at a time to keep all connections busy.
+        self._keys_per_group = _BATCH_SIZE * self._limit
+
+        # The governor limits how many requests are in progress at once, and
+        # lowers the limit if the server slows down or asks us to back off.
+        self._governor = Governor(maximum = self._limit)
+
+        # The HTTP client belongs to the event loop, so it's created by the
+        # first request made inside the loop.
+        self._loop = asyncio.new_event_loop()
+        self._client = None
+
+        self._libraries = self._run(self._connect(user_id))
+
+        # Maps attachment keys to the library that owns them, so that each
+        # batch of keys is sent only where it can be found. It's filled in
+        # from the key lists of the libraries the first time it's needed.
+        self._owners = None
+        # See the same attribute in zotero.Zotero.
+        self._owners_current = True
+        if cache:
+            self._run(self._sync_cache())
+
+
+    def close(self):
+        if self._client:
+            self._run(self._client.aclose())
+        self._loop.close()
+
+
+    def prefetch(self):
+        '''Put the data for all attachments of all libraries in the index.'''
+        async def prefetch_all():
+            pages = [self._all_pages(library, itemType = 'attachment')
+                     for library in self._libraries]
+            for responses in await asyncio.gather(*pages):
+                for response in responses:
+                    self._add_records(response.json())
+        self._run(prefetch_all())
+        self._prefetched = True
+        if __debug__: log(f'index now has {len(self._index)} entries')
+
+
+    def changed_attachments(self, versions):
+        '''Finds the attachments changed after the given library versions.'''
+        async def changes(library):
+            since = versions.get(library) or 0
+            responses = await self._all_pages(library, itemType = 'attachment',
+                                              since = since)
+            version = responses[0].headers.get('last-modified-version')
+            return (responses, int(version) if version else since)
+        async def all_changes():
+            return await asyncio.gather(*[changes(library)
+                                          for library in self._libraries])
+        keys = []
+        current = {}
+        results = self._run(all_changes())
+        for (library, (responses, version)) in zip(self._libraries, results):
+            for response in responses:
+                records = response.json()
+                self._add_records(records)
+                keys += [sys.intern(record['key']) for record in records]
+            current[library] = version
+        if __debug__: log(f'{len(keys)} attachments changed')
+        return (keys, current)
+
+
+    def refresh(self):
+        '''Forget what's known to be missing, but keep the key lists.
+
+        Keys that are not in the key lists of the libraries are looked for
+        in all the libraries from now on.
+        '''
+        super().refresh()
+        self._owners_current = False
+
+
+    def resolve_keys(self, keys):
+        '''Look up the given item keys and add what's found to the index.'''
+        pending = [k for k in dict.fromkeys(keys) if not self._is_known(k)]
+        if self._cache:
+            for key in pending:
+                cached = self._cache.get(key)
+                if cached:
+                    self._index[key] = cached
+            pending = [k for k in pending if k not in self._index]
+        if not pending:
+            return
+        if __debug__: log(f'looking up {len(pending)} keys asynchronously')
+        self._run(self._resolve(pending))
+        pending = [k for k in pending if k not in self._index]
+        if __debug__: log(f'{len(pending)} keys not found in any library')
+        self._missing.update(pending)
+
+
+    def _run(self, coroutine):
+        return self._loop.run_until_complete(coroutine)
+
+
+    async def _get(self, path, **params):
+        '''Sends a GET request for the API path and returns the response.
+
+        Requests are paced by the governor, and retried if the server is
+        overloaded or unreachable. RequestFailure is raised if all attempts
+        fail; other HTTP errors raise httpx.HTTPStatusError.
+        '''
+        if self._client is None:
+            headers = {'Zotero-API-Version': '3'}
+            if self._key:
+                headers['Authorization'] = f'Bearer {self._key}'
+            limits = httpx.Limits(max_connections = self._limit,
+                                  max_keepalive_connections = self._limit)
+            self._client = httpx.AsyncClient(headers = headers, limits = limits,
+                                             timeout = _TIMEOUT)
+        attempt = 0
+        while True:
+            attempt += 1
+            await self._governor.acquire_async()
+            if __debug__: log(f'GET {path} {params}')
+            start = time.monotonic()
+            try:
+                response = await self._client.get(self._endpoint + path,
+                                                  params = params)
+            except httpx.TransportError as ex:
+                self._governor.release(time.monotonic() - start)
+                if self._governor.retry(attempt):
+                    continue
+                raise RequestFailure(f'Unable to reach {self._endpoint}: {ex}')
+            status = response.status_code
+            self._governor.release(time.monotonic() - start, status,
+                                   response.headers)
+            raise_for_interrupts()
+            if status == 429 or status >= 500:
+                if __debug__: log(f'attempt {attempt} of GET {path} got {status}')
+                if self._governor.retry(attempt, status):
+                    continue
+                raise RequestFailure(f'Zotero server responded with status {status}')
+            response.raise_for_status()
+            return response
+
+
+    async def _connect(self, user_id):
+        '''Returns a list of (library type, library id) the user can access.'''
+        try:
+            if __debug__: log(f'connecting to Zotero as user {user_id}')
+            await self._get(f'/users/{user_id}/items', limit = 1)
+        except httpx.HTTPStatusError as ex:
+            if __debug__: log(f'got exception {str(ex)}')
+            if ex.response.status_code in [401, 403]:
+                alert_fatal('Unable to connect to Zotero: invalid ID and/or API key.',
+                            'The Zotero servers rejected attempts to connect.')
+                raise CannotProceed(ExitCode.bad_arg)
+            raise
+        except RequestFailure as ex:
+            if __debug__: log(f'got exception {str(ex)}')
+            alert_fatal(f'Unable to connect to the Zotero API at {self._endpoint}.')
+            raise CannotProceed(ExitCode.server_error)
+
+        libraries = [('user', user_id)]
+        try:
+            response = await self._get(f'/users/{user_id}/groups')
+            for group in response.json():
+                if __debug__: log(f'user can access group id {group["id"]}')
+                libraries.append(('group', str(group['id'])))
+        except (httpx.HTTPError, RequestFailure) as ex:
+            if __debug__: log(f'failed to get list of groups: {str(ex)}')
+            alert('Unable to retrieve Zotero group library; proceeding anyway.')
+        return libraries
+
+
+    async def _resolve(self, keys):
+        '''Looks up the keys in batches, sent to their libraries concurrently.
+
+        If it's not known which library owns a key, the key is sent to all
+        libraries at the same time.
+        '''
+        owners = await self._key_owners()
+        routes = {}
+        for key in keys:
+            if owners is None or (key not in owners and not self._owners_current):
+                for library in self._libraries:
+                    routes.setdefault(library, []).append(key)
+            elif key in owners:
+                routes.setdefault(owners[key], []).append(key)
+        lookups = [self._get(_items_path(library), itemKey = ','.join(batch),
+                             limit = len(batch))
+                   for (library, routed) in routes.items()
+                   for batch in _batches(routed)]
+        # Keep what was found even if some of the lookups failed.
+        failure = None
+        for result in await asyncio.gather(*lookups, return_exceptions = True):
+            if isinstance(result, Exception):
+                failure = failure or result
+            else:
+                self._add_records(result.json())
+        if failure:
+            raise failure
+
+
+    async def _key_owners(self):
+        '''Returns a dict mapping attachment keys to libraries, or None.'''
+        if len(self._libraries) < 2:
+            return None
+        if self._owners is None:
+            lists = [self._get(_items_path(library), format = 'keys',
+                               itemType = 'attachment')
+                     for library in self._libraries]
+            results = await asyncio.gather(*lists, return_exceptions = True)
+            if any(isinstance(result, Exception)
+                   or not result.headers.get('content-type', '').startswith('text/plain')
+                   for result in results):
+                if __debug__: log('unable to get key lists; searching all libraries')
+                self._owners = False
+            else:
+                self._owners = {sys.intern(key): library
+                                for (library, result) in zip(self._libraries, results)
+                                for key in result.text.split()}
+                if __debug__: log(f'owners of {len(self._owners)} keys are known')
+                self._owners_current = True
+        return self._owners if self._owners is not False else None
+
+
+    async def _all_pages(self, library, **params):
+        '''Returns the responses for all pages of items matching "params".
+
+        The first page reports the total number of results, after which the
+        remaining pages are all requested at the same time.
+        '''
+        path = _items_path(library)
+        first = await self._get(path, limit = _PAGE_SIZE, **params)
+        total = int(first.headers.get('total-results', 0))
+        rest = [self._get(path, limit = _PAGE_SIZE, start = start, **params)
+                for start in range(_PAGE_SIZE, total, _PAGE_SIZE)]
+        return [first] + list(await asyncio.gather(*rest))
+
+
+    async def _sync_cache(self):
+        '''Brings the persistent cache up to date with the Zotero libraries.'''
+        for (libtype, libid) in self._cache.libraries():
+            if (libtype, libid) not in self._libraries:
+                # The user no longer has access to this library.
+                self._cache.forget_library(libtype, libid)
+        await asyncio.gather(*[self._sync_library(library)
+                               for library in self._libraries])
+
+
+    async def _sync_library(self, library):
+        (libtype, libid) = library
+        since = self._cache.version(libtype, libid)
+        if since is None:
+            # Nothing is cached for this library yet. Records will be cached
+            # as they're looked up, and they will be at least this current.
+            response = await self._get(_items_path(library), limit = 1)
+            version = response.headers.get('last-modified-version', 0)
+            if __debug__: log(f'starting cache of {libtype} {libid} at {version}')
+            self._cache.set_version(libtype, libid, version)
+            return
+        if __debug__: log(f'updating cache of {libtype} {libid} since {since}')
+        responses = await self._all_pages(library, itemType = 'attachment',
+                                          since = since)
+        # Use the version reported in the first response, so that changes
+        # made while we're paging are picked up next time.
+        version = responses[0].headers.get('last-modified-version') or since
+        for response in responses:
+            self._cache.put(index_entry(record) for record in response.json())
+        path = _items_path(library).replace('/items', '/deleted')
+        deleted = (await self._get(path, since = since)).json()
+        self._cache.delete(deleted.get('items', []))
+        if __debug__: log(f'cache of {libtype} {libid} now at version {version}')
+        self._cache.set_version(libtype, libid, version)
+
+
+    def _add_records(self, records):
+        entries = [index_entry(record) for record in records]
+        for (key, libtype, libid, parentkey) in entries:
+            self._index[key] = (libtype, libid, parentkey)
+        if self._cache:
+            self._cache.put(entries)
+
+
+# Miscellaneous utilities.
+# .............................................................................
+
+def _batches(keys):
+    return [keys[start : start + _BATCH_SIZE]
+            for start in range(0, len(keys), _BATCH_SIZE)]
+
+
+def _items_path(library):
+    (libtype, libid) = library
+    return f'/{libtype}s/{libid}/items'
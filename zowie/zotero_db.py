@@ -0,0 +1,167 @@
+'''
+zotero_db.py: look up Zotero records in the local Zotero database file
+
+Authors
+-------
+
+Michael Hucka <mhucka@caltech.edu> -- Caltech Library
+
+Copyright
+---------
+
+Copyright (c) 2020 by Michael Hucka and the California Institute of Technology.
+This code is open-source software released under a 3-clause BSD license.
+Please see the file "LICENSE" for more information.
+'''
+
+from   bun import alert_fatal
+from   commonpy.string_utils import antiformat
+from   os import path
+import sqlite3
+import sys
+from   urllib.parse import quote
+
+from .exceptions import CannotProceed
+from .exit_codes import ExitCode
+from .resolver import Resolver
+
+if __debug__:
+    from sidetrack import log
+
+
+# Internal constants.
+# .............................................................................
+
+# Attachments are items that have a row in the itemAttachments table. Their
+# parents (if any) are other items, and each item belongs to a library that
+# is either the user's library, a group library, or a feed. Feeds don't have
+# files in Zotero's storage directory, so they're left out.
+
+_QUERY = '''
+SELECT items.key, libraries.type, groups.groupID, parents.key
+FROM items
+JOIN itemAttachments ON itemAttachments.itemID = items.itemID
+JOIN libraries ON libraries.libraryID = items.libraryID
+LEFT JOIN groups ON groups.libraryID = items.libraryID
+LEFT JOIN items AS parents ON parents.itemID = itemAttachments.parentItemID
+WHERE libraries.type IN ('user', 'group')
+'''
+
+# The database doesn't record library versions for changes that haven't been
+# synced, so the largest item id of the attachments in a library stands in
+# for its version. SQLite gives new rows ids larger than any existing one.
+
+_LAST_IDS = '''
+SELECT libraries.type, groups.groupID, max(items.itemID)
+FROM items
+JOIN itemAttachments ON itemAttachments.itemID = items.itemID
+JOIN libraries ON libraries.libraryID = items.libraryID
+LEFT JOIN groups ON groups.libraryID = items.libraryID
+WHERE libraries.type IN ('user', 'group')
+GROUP BY items.libraryID
+'''
+
+_MAX_PARAMS = 500
+'''Number of keys put in one query; SQLite limits the number of parameters.'''
+
+
+# Exported classes.
+# .............................................................................
+
+class ZoteroDatabase(Resolver):
+    '''Resolver that reads the zotero.sqlite database file of Zotero desktop.
+
+    The database is opened read-only in SQLite's immutable mode, which makes
+    it possible to read it even while Zotero is running and holding a lock on
+    it. No network access or Zotero credentials are needed.
+    '''
+
+    def __init__(self, file):
+        super().__init__()
+        f = antiformat(file)
+        if not path.isfile(file):
+            alert_fatal(f'Cannot find Zotero database file "{f}".')
+            raise CannotProceed(ExitCode.file_error)
+        self._uri = 'file:' + quote(path.abspath(file)) + '?immutable=1'
+        if __debug__: log(f'opening {self._uri}')
+        try:
+            self._db = self._connect()
+            self._db.execute('SELECT count(*) FROM itemAttachments')
+        except sqlite3.Error as ex:
+            if __debug__: log(f'got exception {str(ex)}')
+            alert_fatal(f'Unable to read Zotero database file "{f}".')
+            raise CannotProceed(ExitCode.file_error)
+
+
+    def prefetch(self):
+        '''Put the data for all attachments of all libraries in the index.'''
+        self._add_rows(self._db.execute(_QUERY))
+        self._prefetched = True
+        if __debug__: log(f'index now has {len(self._index)} entries')
+
+
+    def resolve_keys(self, keys):
+        '''Look up the given item keys and add what's found to the index.'''
+        pending = [k for k in dict.fromkeys(keys) if not self._is_known(k)]
+        for start in range(0, len(pending), _MAX_PARAMS):
+            batch = pending[start : start + _MAX_PARAMS]
+            marks = ','.join('?' * len(batch))
+            query = _QUERY + f' AND items.key IN ({marks})'
+            self._add_rows(self._db.execute(query, batch))
+        pending = [k for k in pending if k not in self._index]
+        if __debug__: log(f'{len(pending)} keys not found in database')
+        self._missing.update(pending)
+
+
+    def changed_attachments(self, versions):
+        '''Finds the attachments added after the given library versions.
+
+        The versions used here are item ids, so only new attachments are
+        found, not attachments that were modified.
+        '''
+        current = {}
+        keys = []
+        for (libtype, groupid, last) in self._db.execute(_LAST_IDS):
+            spec = (sys.intern(libtype), sys.intern(str(groupid)) if groupid else '')
+            current[spec] = last
+            since = versions.get(spec) or 0
+            if last <= since:
+                continue
+            # Limiting by libraries.type isn't enough to pick out one library.
+            if groupid:
+                query = _QUERY + ' AND items.itemID > ? AND groups.groupID = ?'
+                rows = self._db.execute(query, (since, groupid)).fetchall()
+            else:
+                query = _QUERY + " AND items.itemID > ? AND libraries.type = 'user'"
+                rows = self._db.execute(query, (since,)).fetchall()
+            self._add_rows(rows)
+            keys += [key for (key, _, _, _) in rows]
+        if __debug__: log(f'{len(keys)} attachments added')
+        return (keys, current)
+
+
+    def refresh(self):
+        '''Forget what's known to be missing, and reopen the database.
+
+        In immutable mode, SQLite assumes the file doesn't change, so a
+        connection may not see what Zotero has added since it was opened.
+        '''
+        super().refresh()
+        self._db.close()
+        self._db = self._connect()
+
+
+    def close(self):
+        self._db.close()
+
+
+    def _connect(self):
+        # Lookups are done in a thread other than the one creating this
+        # object. The database is read-only and used by one thread at a time.
+        return sqlite3.connect(self._uri, uri = True, check_same_thread = False)
+
+
+    def _add_rows(self, rows):
+        for (key, libtype, groupid, parentkey) in rows:
+            libid = sys.intern(str(groupid)) if groupid else ''
+            self._index[key] = (sys.intern(libtype), libid, parentkey)